@@ -0,0 +1,198 @@
+import sys, os, time, argparse, json, csv
+from collections import deque
+import multiprocessing
+import cv2
+
+import util, demo_full_pipeline
+
+"""
+USAGE:
+
+    $ python batch_process.py imgsdir [--out OUTFILE] [--format {jsonl,csv}]
+                              [--workers N] [--max_inflight M] [--seed S]
+                              [--calibdir DIR] [--reuse_calib] [--recalib]
+
+Headless batch mode of the lane-departure warning system (see
+demo_full_pipeline.py). Every image in imgsdir is run through the
+pipeline (lane detection -> closed-form lateral offset, see
+lateral_offset.py) on a pool of worker processes, and one record per frame is written to OUTFILE
+(default: stdout), in the same order as the images:
+    frame, imgpath          Frame index, image path.
+    line_left, line_right   Detected lanes (a, b, c), or null/empty.
+    xdist                   Distance (m) of the camera from the center of
+                            the lane, or null/empty if a lane is missing.
+    warning                 LEFT, RIGHT, or null/empty.
+    dur                     Processing time (s) of the frame.
+
+At most --max_inflight frames are queued to the pool at once, so memory
+use does not grow with the number of images. Since lane tracking needs
+the frames in order, batch mode always detects from scratch.
+
+The camera matrix K is determined once, as in demo_full_pipeline.py,
+from the calibration images of --calibdir (the result is cached, see
+calib_cache.py), and sent to each worker.
+"""
+
+CSV_FIELDS = ('frame', 'imgpath',
+              'left_a', 'left_b', 'left_c',
+              'right_a', 'right_b', 'right_c',
+              'xdist', 'warning', 'dur')
+
+_K = None  # The camera matrix of the worker (see init_worker)
+
+def init_worker(K=None):
+    global _K
+    # One OpenCV thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    _K = K
+
+def process_imgpath(i, imgpath, seed=None):
+    """ Runs the pipeline on the image at imgpath.
+    Input:
+        int i
+        str imgpath
+        int seed
+            If given, frame i's lanes are detected with the seed (seed, i),
+            so the output doesn't depend on which worker ran the frame.
+    Output:
+        dict record
+    The output record of frame i (see USAGE). xdist is computed in
+    closed form from the worker's K (see init_worker), as in
+    demo_full_pipeline.py.
+    """
+    t = time.time()
+    I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    if I is None:
+        raise Exception("Couldn't read image: {0}".format(imgpath))
+    res = demo_full_pipeline.process_frame(I, K=_K, seed=None if seed is None else (seed, i))
+    return dict(frame=i, imgpath=imgpath,
+                line_left=tolist(res['line1']),
+                line_right=tolist(res['line2']),
+                xdist=None if res['xdist'] is None else float(res['xdist']),
+                warning=res['warning'],
+                dur=time.time() - t)
+
+def tolist(line):
+    return None if line is None else [float(x) for x in line]
+
+def imap_bounded(pool, fn, argss, max_inflight):
+    """ Like pool.imap(fn, argss), but never has more than max_inflight
+    calls queued to the pool (pool.imap consumes argss eagerly).
+    Input:
+        Pool pool
+        function fn
+        iterable argss
+            Arguments tuples of each call.
+        int max_inflight
+    Output:
+        Generator of fn(*args), in the same order as argss.
+    """
+    inflight = deque()
+    for args in argss:
+        if len(inflight) >= max_inflight:
+            yield inflight.popleft().get()
+        inflight.append(pool.apply_async(fn, args))
+    while inflight:
+        yield inflight.popleft().get()
+
+def write_records(records, f, fmt):
+    """ Writes each record to the file f as soon as it is available.
+    Input:
+        iterable records
+        file f
+        str fmt: 'jsonl' or 'csv'
+    Output:
+        int nb_records
+    """
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+    nb_records = 0
+    for rec in records:
+        if fmt == 'csv':
+            writer.writerow(record_to_row(rec))
+        else:
+            f.write(json.dumps(rec, sort_keys=True) + '\n')
+        f.flush()
+        nb_records += 1
+    return nb_records
+
+def record_to_row(rec):
+    """ Flattens a record into a CSV row (see CSV_FIELDS). Missing values
+    are empty.
+    """
+    row = [rec['frame'], rec['imgpath']]
+    for key in ('line_left', 'line_right'):
+        row.extend(rec[key] if rec[key] is not None else ['', '', ''])
+    row.append(rec['xdist'] if rec['xdist'] is not None else '')
+    row.append(rec['warning'] or '')
+    row.append("{0:.4f}".format(rec['dur']))
+    return row
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("imgsdir",
+                        help="Directory of test images.")
+    parser.add_argument("--out",
+                        help="Output file (default: stdout).")
+    parser.add_argument("--format", choices=('jsonl', 'csv'), default='jsonl',
+                        help="Output format.")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("--max_inflight", type=int,
+                        help="Max. number of frames queued to the workers \
+(default: 4 per worker).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed the lane detection (reproducible output).")
+    parser.add_argument("--n", type=int, help="Number of images to use.")
+    parser.add_argument("--calibdir", default=demo_full_pipeline.IMGSDIR_CALIB,
+                        help="Directory of camera calibration images.")
+    parser.add_argument("--reuse_calib", action='store_true', default=False,
+                        help="Use a precomputed camera calibration matrix, \
+rather than re-computing it.")
+    parser.add_argument("--recalib", action='store_true', default=False,
+                        help="Re-compute the camera calibration, even if it \
+is cached (see calib_cache.py).")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.imgsdir):
+        print >>sys.stderr, "(ERROR) Image directory not found: {0}".format(args.imgsdir)
+        exit(1)
+    if not args.reuse_calib and not os.path.isdir(args.calibdir):
+        print >>sys.stderr, "(ERROR) Calibration images not found: {0}".format(args.calibdir)
+        exit(1)
+    # (The calibration's progress goes to stderr: stdout may be the output)
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        imgpaths_calib = util.get_imgpaths(args.calibdir) if not args.reuse_calib else []
+        K, distCoeffs = demo_full_pipeline.get_camera_model(imgpaths_calib,
+                                                            reuse_calib=args.reuse_calib,
+                                                            recalib=args.recalib)
+    finally:
+        sys.stdout = stdout
+    imgpaths = util.get_imgpaths(args.imgsdir, n=args.n)
+    max_inflight = args.max_inflight or 4*args.workers
+    f = open(args.out, 'w') if args.out else sys.stdout
+    t = time.time()
+    pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(K,))
+    try:
+        argss = ((i, imgpath, args.seed) for i, imgpath in enumerate(imgpaths))
+        records = imap_bounded(pool, process_imgpath, argss, max_inflight)
+        nb_records = write_records(records, f, args.format)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if f is not sys.stdout:
+            f.close()
+    dur = time.time() - t
+    print >>sys.stderr, "(Info) Processed {0} frames with {1} workers ({2:.4f}s, {3:.1f} fps)".format(
+        nb_records, args.workers, dur, nb_records / max(dur, 1e-9))
+
+if __name__ == '__main__':
+    main()
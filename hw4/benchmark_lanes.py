@@ -0,0 +1,450 @@
+import sys, os, time, argparse, hashlib
+import numpy as np, cv2
+
+import util, detect_lanes, estimate_line, hough_line, estimate_curve
+
+"""
+USAGE:
+
+    $ python benchmark_lanes.py [imgsdir] [--bench BENCH [BENCH ...]]
+
+Micro-benchmarks for the lane detection stage. The left/right search
+windows of every image in imgsdir (default: imgs_sample/) are run
+through the Canny edge detector, and the resulting edgemaps are fed
+to the line estimators being compared.
+
+Benchmarks:
+    scoring
+        Per-pixel Python loop (estimate_line_naive) vs. the vectorized
+        hypothesis scoring of estimate_line.
+    adaptive
+        Fixed iteration budget vs. confidence-based early termination
+        (estimate_line with ADAPTIVE=True).
+    sampling
+        Uniform vs. PROSAC (gradient-ranked) sampling: number of
+        hypotheses until the final model was found.
+    hough
+        RANSAC vs. the Hough accumulator backend (hough_line): latency
+        (median/max) and agreement of the detected lines.
+    curve
+        Straight-line vs. parabola (estimate_curve) RANSAC, both with
+        adaptive termination: on the image windows, and on a synthetic
+        sequence of increasingly curved lanes (see make_curved_edgemap),
+        where the models' errors w.r.t. the true lane are known.
+    determinism
+        Runs seeded lane detection (detect_lanes_multi) over every image
+        several times, serially and on threads: checks that the lines
+        are byte-identical across runs, and reports the spread of the
+        per-run timings. Then checks that unseeded detection still runs.
+    refine
+        estimate_line without/with the incremental inlier refinement
+        (REFINE_ITERS, see estimate_line.refine_line): inliers and
+        latency on the windows, and the error w.r.t. the true line on
+        synthetic straight lanes.
+
+All benchmarks draw their RANSAC samples from --seed, so that two runs
+(e.g. before/after a change) try the same hypotheses.
+"""
+
+IMGSDIR_SAMPLE = 'imgs_sample'
+
+WIN_LEFT = (0.4, 0.60, 0.2, 0.25)
+WIN_RIGHT = (0.62, 0.60, 0.2, 0.25)
+VANISHING_PT = (0.5, 0.4)
+MARKING_W = 4   # Lane marking width (pixels) of the synthetic curved lanes
+
+def load_edge_windows(imgpaths, wins, threshold1=100, threshold2=200,
+                      apertureSize=3):
+    """ Runs Canny on each search window of each image.
+    Input:
+        list imgpaths
+        tuple wins: (win_1, win_2, ...)
+            Each win is (float x, float y, float width, float height).
+    Output:
+        list edgewins: [(str name, nparray edgemap, tuple grad, float angle), ...]
+    Where grad is the (gx, gy) gradients of the window, and angle is the
+    guessed lane direction (see detect_lanes.guess_lane_angle).
+    """
+    edgewins = []
+    for imgpath in imgpaths:
+        I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+        h, w = I.shape[0:2]
+        for i, win in enumerate(wins):
+            x0, y0, x1, y1 = detect_lanes.get_window_bounds(win, w, h)
+            Iwin = I[y0:y1, x0:x1]
+            edgemap = cv2.Canny(Iwin, threshold1, threshold2,
+                                apertureSize=apertureSize)
+            grad = detect_lanes.compute_gradients(Iwin, apertureSize=apertureSize)
+            angle = detect_lanes.guess_lane_angle(win, VANISHING_PT, w, h)
+            name = "{0}[win{1}]".format(util.get_filename(imgpath), i+1)
+            edgewins.append((name, edgemap, grad, angle))
+    return edgewins
+
+def time_it(fn, nb_reps):
+    """ Calls fn() nb_reps times.
+    Output:
+        (list durs, result)
+    Where durs are the wall-clock durations (in seconds) of each call,
+    and result is the output of the last call.
+    """
+    durs = []
+    result = None
+    for _ in xrange(nb_reps):
+        t = time.time()
+        result = fn()
+        durs.append(time.time() - t)
+    return durs, result
+
+def bench_scoring(edgewins, args):
+    """ Per-pixel loop vs. vectorized RANSAC hypothesis scoring. """
+    print("==== scoring: estimate_line_naive vs. estimate_line ====")
+    params = dict(MAX_ITERS=args.max_iters, ALPHA=4, T=1.0)
+    tot_naive, tot_vec = 0.0, 0.0
+    for name, edgemap, grad, angle in edgewins:
+        nb_edges = np.count_nonzero(edgemap == 255)
+        durs_naive, _ = time_it(lambda: estimate_line.estimate_line_naive(edgemap, **params),
+                                args.reps_naive)
+        durs_vec, _ = time_it(lambda: estimate_line.estimate_line(edgemap, **params),
+                              args.reps)
+        dur_naive = np.median(durs_naive)
+        dur_vec = np.median(durs_vec)
+        tot_naive += dur_naive
+        tot_vec += dur_vec
+        print("    {0}: N={1:5d}  naive={2:8.2f}ms  vectorized={3:7.2f}ms  ({4:.1f}x)".format(
+            name, nb_edges, dur_naive*1e3, dur_vec*1e3, dur_naive / dur_vec))
+    print("    Total: naive={0:.3f}s  vectorized={1:.3f}s  ({2:.1f}x)".format(
+        tot_naive, tot_vec, tot_naive / tot_vec))
+
+def bench_adaptive(edgewins, args):
+    """ Fixed iteration budget vs. adaptive early-termination RANSAC. """
+    print("==== adaptive: MAX_ITERS={0} fixed vs. adaptive (confidence={1}) ====".format(
+        args.max_iters, args.confidence))
+    params = dict(MAX_ITERS=args.max_iters, ALPHA=4, T=1.0)
+    tot_fixed, tot_adapt = 0.0, 0.0
+    for name, edgemap, grad, angle in edgewins:
+        stats = {}
+        durs_fixed, res_fixed = time_it(lambda: estimate_line.estimate_line(edgemap, **params),
+                                        args.reps)
+        durs_adapt, res_adapt = time_it(lambda: estimate_line.estimate_line(edgemap, ADAPTIVE=True,
+                                                                            CONFIDENCE=args.confidence,
+                                                                            stats=stats, **params),
+                                        args.reps)
+        dur_fixed = np.median(durs_fixed)
+        dur_adapt = np.median(durs_adapt)
+        tot_fixed += dur_fixed
+        tot_adapt += dur_adapt
+        nb_fixed = 0 if res_fixed is None or res_fixed[1] is None else len(res_fixed[1])
+        nb_adapt = 0 if res_adapt is None or res_adapt[1] is None else len(res_adapt[1])
+        print("    {0}: fixed={1:6.2f}ms ({2} inliers)  adaptive={3:6.2f}ms ({4} inliers, {5} iters)  ({6:.1f}x)".format(
+            name, dur_fixed*1e3, nb_fixed, dur_adapt*1e3, nb_adapt, stats['nb_iters'],
+            dur_fixed / dur_adapt))
+    print("    Total: fixed={0:.3f}s  adaptive={1:.3f}s  ({2:.1f}x)".format(
+        tot_fixed, tot_adapt, tot_fixed / tot_adapt))
+
+def bench_sampling(edgewins, args):
+    """ Uniform vs. PROSAC sampling, measured in hypotheses-to-convergence:
+    the first iteration at which a hypothesis with at least 90% of the
+    inliers of a reference model (best of a few long uniform runs) was
+    drawn.
+    """
+    print("==== sampling: uniform vs. prosac (MAX_ITERS={0}, {1} trials) ====".format(
+        args.max_iters, args.reps))
+    params = dict(ALPHA=4, T=1.0)
+    results = {'uniform': [], 'prosac': []}
+    for name, edgemap, grad, angle in edgewins:
+        nb_ref = 0
+        for _ in xrange(5):
+            res = estimate_line.estimate_line(edgemap, MAX_ITERS=10*args.max_iters, **params)
+            if res is not None and res[1] is not None:
+                nb_ref = max(nb_ref, len(res[1]))
+        line_out = "    {0}: ref={1:3d} inliers".format(name, nb_ref)
+        for sampler in ('uniform', 'prosac'):
+            convs = []
+            for _ in xrange(args.reps):
+                stats = {}
+                estimate_line.estimate_line(edgemap, MAX_ITERS=args.max_iters,
+                                            SAMPLER=sampler, grad=grad, LANE_ANGLE=angle,
+                                            PROSAC_TN=args.prosac_tn, stats=stats, **params)
+                hits = np.flatnonzero(stats['scores'] >= 0.9*nb_ref)
+                if len(hits) > 0:
+                    convs.append(hits[0] + 1)
+                else:
+                    convs.append(np.inf) # Didn't converge within MAX_ITERS
+            results[sampler].extend(convs)
+            line_out += "  {0}: median={1:6.1f} iters ({2:3d}% converged)".format(
+                sampler, np.median(convs), intpct(np.isfinite(convs)))
+        print(line_out)
+    for sampler in ('uniform', 'prosac'):
+        convs = results[sampler]
+        print("    Total {0}: median={1:.1f} iters, {2}% converged".format(
+            sampler, np.median(convs), intpct(np.isfinite(convs))))
+
+def bench_hough(edgewins, args):
+    """ RANSAC vs. Hough backends: latency, and line agreement. """
+    print("==== hough: estimate_line (RANSAC) vs. estimate_line_hough ====")
+    params = dict(ALPHA=4, T=1.0)
+    durs_all = {'ransac': [], 'hough': []}
+    for name, edgemap, grad, angle in edgewins:
+        durs_r, res_r = time_it(lambda: estimate_line.estimate_line(edgemap, MAX_ITERS=args.max_iters,
+                                                                    **params),
+                                args.reps)
+        durs_h, res_h = time_it(lambda: hough_line.estimate_line_hough(edgemap, **params),
+                                args.reps)
+        durs_all['ransac'].extend(durs_r)
+        durs_all['hough'].extend(durs_h)
+        line_r = res_r[0] if res_r is not None else None
+        line_h = res_h[0] if res_h is not None else None
+        if line_r is None or line_h is None:
+            agreement = "(no line)"
+        else:
+            dangle, dist = line_agreement(line_r, line_h, edgemap.shape)
+            agreement = "dangle={0:5.2f}deg  dist={1:5.2f}px".format(dangle, dist)
+        print("    {0}: ransac={1:6.2f}ms (max {2:6.2f})  hough={3:6.2f}ms (max {4:6.2f})  {5}".format(
+            name, np.median(durs_r)*1e3, np.max(durs_r)*1e3,
+            np.median(durs_h)*1e3, np.max(durs_h)*1e3, agreement))
+    for key in ('ransac', 'hough'):
+        durs = np.array(durs_all[key]) * 1e3
+        print("    Total {0}: median={1:.2f}ms  p95={2:.2f}ms  max={3:.2f}ms  std={4:.2f}ms".format(
+            key, np.median(durs), np.percentile(durs, 95), np.max(durs), np.std(durs)))
+
+def bench_curve(edgewins, args):
+    """ Straight-line vs. curved lane model: hypotheses tried (with
+    adaptive termination), latency, and (on synthetic curved lanes) the
+    max. horizontal error of the model w.r.t. the true lane (either edge
+    of the marking).
+    """
+    print("==== curve: estimate_line vs. estimate_curve (MAX_ITERS={0}, adaptive) ====".format(
+        args.max_iters))
+    params = dict(MAX_ITERS=args.max_iters, ALPHA=4, T=1.0, ADAPTIVE=True,
+                  CONFIDENCE=args.confidence)
+    def run(edgemap):
+        out = {}
+        for key, fn in (('line', estimate_line.estimate_line),
+                        ('curve', estimate_curve.estimate_curve)):
+            stats = {}
+            durs, res = time_it(lambda: fn(edgemap, stats=stats, **params), args.reps)
+            out[key] = (np.median(durs), stats['nb_iters'], res)
+        return out
+    def report(name, out, errs=None):
+        line_out = "    {0}:".format(name)
+        for key in ('line', 'curve'):
+            dur, nb_iters, res = out[key]
+            nb_inliers = 0 if res is None or res[1] is None else len(res[1])
+            line_out += "  {0}={1:6.2f}ms ({2:3d} iters, {3:4d} inliers".format(
+                key, dur*1e3, nb_iters, nb_inliers)
+            if errs is not None:
+                line_out += ", err={0:6.2f}px".format(errs[key])
+            line_out += ")"
+        print(line_out)
+    for name, edgemap, grad, angle in edgewins:
+        report(name, run(edgemap))
+    print("    -- Synthetic curved lanes --")
+    errs_all = {'line': [], 'curve': []}
+    for i, curvature in enumerate(np.linspace(0.0, 0.01, 6)):
+        edgemap, curve_true = make_curved_edgemap(curvature, marking_w=MARKING_W)
+        out = run(edgemap)
+        errs = {}
+        ys = np.arange(edgemap.shape[0], dtype='float64')
+        xs_true = estimate_curve.compute_curve_x(curve_true, ys)
+        for key in ('line', 'curve'):
+            res = out[key][2]
+            if res is None or res[0] is None:
+                errs[key] = np.inf
+                errs_all[key].append(errs[key])
+                continue
+            if key == 'line':
+                line = res[0]
+                xs = (-line[1]*ys - line[2]) / line[0]
+            else:
+                xs = estimate_curve.compute_curve_x(res[0], ys)
+            errs[key] = min(np.max(np.abs(xs - xs_true)),
+                            np.max(np.abs(xs - xs_true - MARKING_W)))
+            errs_all[key].append(errs[key])
+        report("curved{0}[a={1:.4f}]".format(i, curvature), out, errs)
+    for key in ('line', 'curve'):
+        print("    Total {0}: median err={1:.2f}px  max err={2:.2f}px".format(
+            key, np.median(errs_all[key]), np.max(errs_all[key])))
+
+def bench_refine(edgewins, args):
+    """ estimate_line without/with the incremental inlier refinement
+    (REFINE_ITERS): inliers and latency on the windows, and the error
+    w.r.t. the true line on synthetic straight lanes.
+    """
+    print("==== refine: estimate_line REFINE_ITERS=0 vs. {0} ====".format(args.refine_iters))
+    keys = (0, args.refine_iters)
+    def run(edgemap, seed):
+        out = {}
+        for nb_iters in keys:
+            params = dict(MAX_ITERS=args.max_iters, ALPHA=4, T=1.0, REFINE_ITERS=nb_iters)
+            durs, res = time_it(lambda: estimate_line.estimate_line(edgemap, rng=seed, **params),
+                                args.reps)
+            out[nb_iters] = (np.median(durs), res)
+        return out
+    for name, edgemap, grad, angle in edgewins:
+        out = run(edgemap, args.seed)
+        line_out = "    {0}:".format(name)
+        for nb_iters in keys:
+            dur, res = out[nb_iters]
+            nb_inliers = 0 if res is None or res[1] is None else len(res[1])
+            line_out += "  refine={0}: {1:6.2f}ms ({2:4d} inliers)".format(nb_iters, dur*1e3, nb_inliers)
+        print(line_out)
+    print("    -- Synthetic straight lanes (max. horizontal error w.r.t. the true line) --")
+    errs_all = dict((nb_iters, []) for nb_iters in keys)
+    for i in xrange(args.nb_synth):
+        edgemap, curve_true = make_curved_edgemap(0.0, marking_w=0, nb_clutter=600, seed=i)
+        ys = np.arange(edgemap.shape[0], dtype='float64')
+        xs_true = estimate_curve.compute_curve_x(curve_true, ys)
+        out = run(edgemap, (args.seed, i))
+        for nb_iters in keys:
+            line = out[nb_iters][1][0]
+            if line is None:
+                errs_all[nb_iters].append(np.inf)
+                continue
+            xs = (-line[1]*ys - line[2]) / line[0]
+            errs_all[nb_iters].append(np.max(np.abs(xs - xs_true)))
+    for nb_iters in keys:
+        errs = np.array(errs_all[nb_iters])
+        print("    refine={0}: median err={1:.3f}px  mean err={2:.3f}px  max err={3:.3f}px".format(
+            nb_iters, np.median(errs), np.mean(errs), np.max(errs)))
+    nb_better = np.sum(np.array(errs_all[keys[1]]) < np.array(errs_all[keys[0]]) - 1e-9)
+    nb_worse = np.sum(np.array(errs_all[keys[1]]) > np.array(errs_all[keys[0]]) + 1e-9)
+    print("    refine={0} vs. 0: better on {1}/{3}, worse on {2}/{3}".format(
+        args.refine_iters, nb_better, nb_worse, args.nb_synth))
+
+def make_curved_edgemap(curvature, shape=(121, 129), marking_w=4, nb_clutter=150, seed=0):
+    """ Synthesizes the edgemap of a curved lane marking (its two edges,
+    marking_w pixels apart) plus random clutter edges.
+    Input:
+        float curvature
+            The a of the lane x = a*(y - y_c)^2 + b*(y - y_c) + x_c, y_c
+            being the middle row.
+    Output:
+        (nparray edgemap, nparray curve)
+    Where curve is the (left edge of the) lane, as (a, b, c).
+    """
+    rng = np.random.RandomState(seed)
+    h, w = shape
+    y_c = (h - 1) / 2.0
+    ys = np.arange(h, dtype='float64')
+    # x = a*(y - y_c)^2 + b*(y - y_c) + x_c, expanded
+    a, b, x_c = curvature, -0.7, w / 2.0
+    curve = np.array([a, b - 2*a*y_c, a*y_c*y_c - b*y_c + x_c])
+    edgemap = np.zeros(shape, dtype='uint8')
+    for dx in (0, marking_w):
+        xs = np.round(estimate_curve.compute_curve_x(curve, ys) + dx).astype('int')
+        keep = (xs >= 0) & (xs < w)
+        edgemap[ys[keep].astype('int'), xs[keep]] = 255
+    edgemap[rng.randint(0, h, nb_clutter), rng.randint(0, w, nb_clutter)] = 255
+    return edgemap, curve
+
+def bench_determinism(edgewins, args):
+    """ Seeded detect_lanes_multi: identical lines across runs and
+    thread counts, and run-to-run timing spread. Also runs unseeded
+    detect_lanes, which draws from np.random.
+    """
+    print("==== determinism: seeded detect_lanes_multi ({0} runs, seed={1}) ====".format(
+        args.reps, args.seed))
+    imgpaths = util.get_imgpaths(args.imgsdir, n=args.n)
+    Is = [cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE) for imgpath in imgpaths]
+    wins = (('left', WIN_LEFT), ('right', WIN_RIGHT))
+    digests = {}
+    for nb_threads in (1, len(wins)):
+        for estimator in ('ransac', 'curve'):
+            durs = []
+            for _ in xrange(args.reps):
+                sha = hashlib.sha1()
+                t = time.time()
+                for i, I in enumerate(Is):
+                    results = detect_lanes.detect_lanes_multi(I, wins, threshold1=100, threshold2=200,
+                                                              estimator=estimator,
+                                                              nb_threads=nb_threads,
+                                                              seed=(args.seed, i))
+                    for res in results:
+                        sha.update(res.line.tostring() if res.line is not None else 'None')
+                durs.append(time.time() - t)
+                digests.setdefault(estimator, set()).add(sha.hexdigest())
+            durs = np.array(durs) * 1e3
+            print("    {0} (threads={1}): median={2:.2f}ms  IQR={3:.2f}ms  min={4:.2f}ms  max={5:.2f}ms  lines={6}".format(
+                estimator, nb_threads, np.median(durs),
+                np.percentile(durs, 75) - np.percentile(durs, 25),
+                np.min(durs), np.max(durs), sha.hexdigest()[:12]))
+    for estimator in sorted(digests.keys()):
+        print("    {0}: {1}".format(estimator, "identical lines across all runs" if len(digests[estimator]) == 1
+                                     else "NOT deterministic ({0} distinct outputs)".format(len(digests[estimator]))))
+    # Unseeded (seed=None) detection must still work, from np.random
+    nb_found = 0
+    for I in Is:
+        for sampler in ('uniform', 'prosac'):
+            line1, line2 = detect_lanes.detect_lanes(I, win1=WIN_LEFT, win2=WIN_RIGHT,
+                                                     threshold1=100, threshold2=200,
+                                                     sampler=sampler)
+            nb_found += line1 is not None and line2 is not None
+    print("    unseeded (seed=None): both lanes found in {0}/{1} detections".format(
+        nb_found, 2*len(Is)))
+
+def line_agreement(line1, line2, shape):
+    """ Compares two lines found within a window of size shape.
+    Output:
+        (float dangle, float dist)
+    Where dangle is the angle between the lines (in degrees), and dist is
+    the distance from line2 to the point of line1 closest to the window
+    center.
+    """
+    l1 = line1 / np.hypot(line1[0], line1[1])
+    l2 = line2 / np.hypot(line2[0], line2[1])
+    dangle = np.rad2deg(np.arccos(min(abs(np.dot(l1[0:2], l2[0:2])), 1.0)))
+    ctr = np.array([shape[1] / 2.0, shape[0] / 2.0])
+    pt = ctr - (np.dot(l1[0:2], ctr) + l1[2]) * l1[0:2]
+    dist = abs(np.dot(l2[0:2], pt) + l2[2])
+    return dangle, dist
+
+def intpct(flags):
+    """ Percentage of True values in flags, as an int. """
+    return int(round(100.0 * np.mean(flags)))
+
+BENCHMARKS = {'scoring': bench_scoring,
+              'adaptive': bench_adaptive,
+              'sampling': bench_sampling,
+              'hough': bench_hough,
+              'curve': bench_curve,
+              'determinism': bench_determinism,
+              'refine': bench_refine}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("imgsdir", nargs='?', default=IMGSDIR_SAMPLE,
+                        help="Directory of street images.")
+    parser.add_argument("--bench", nargs='+', choices=sorted(BENCHMARKS.keys()),
+                        default=sorted(BENCHMARKS.keys()),
+                        help="Which benchmarks to run.")
+    parser.add_argument("--n", type=int, help="Number of images to use.")
+    parser.add_argument("--max_iters", type=int, default=300,
+                        help="RANSAC iterations per window.")
+    parser.add_argument("--confidence", type=float, default=0.99,
+                        help="Target confidence for adaptive RANSAC.")
+    parser.add_argument("--prosac_tn", type=int, default=1000,
+                        help="PROSAC_TN for PROSAC sampling.")
+    parser.add_argument("--reps", type=int, default=20,
+                        help="Repetitions per window (fast estimators).")
+    parser.add_argument("--reps_naive", type=int, default=1,
+                        help="Repetitions per window (naive estimator).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the RANSAC samples.")
+    parser.add_argument("--refine_iters", type=int, default=3,
+                        help="REFINE_ITERS compared to no refinement (refine).")
+    parser.add_argument("--nb_synth", type=int, default=50,
+                        help="Number of synthetic lanes (refine).")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    imgpaths = util.get_imgpaths(args.imgsdir, n=args.n)
+    edgewins = load_edge_windows(imgpaths, (WIN_LEFT, WIN_RIGHT))
+    print("(Info) {0} edge windows from {1} images".format(len(edgewins), len(imgpaths)))
+    for bench in args.bench:
+        np.random.seed(args.seed) # Each benchmark is reproducible on its own
+        BENCHMARKS[bench](edgewins, args)
+    print("Done.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+import sys, os, time, json, argparse, platform
+import numpy as np, cv2
+
+import util, util_camera, detect_lanes, estimate_line, ipm, calibrate_camera
+import estimate_planar_homography as eph
+import demo_planar_homography as dph
+
+"""
+USAGE:
+
+    $ python benchmark_pipeline.py [--out results.json] [--compare baseline.json]
+
+Per-stage latency benchmark of the perception pipeline. Each stage is
+run --reps times on every input, and its p50/p95 latency and
+throughput (calls/sec, i.e. frames/sec for the per-frame stages) are
+printed, and written as JSON to --out.
+
+Suites (--suites):
+    lanes
+        The street images of --imgsdir (default: imgs_sample/), with the
+        Caltech Lanes camera:
+            detect_lanes        detect_lanes.detect_lanes (both windows)
+            canny               detect_lanes.EdgeMap over both windows (one
+                                cv2.Canny pass), and the windows' views
+            ransac              estimate_line.estimate_line on both windows
+            fit_line            The least-squares fit of the RANSAC inliers
+                                (the last step of ransac)
+            estimate_planar_homography
+                                The road-plane homography (batch solver)
+            decompose_H         util_camera.decompose_H of the road plane
+            warp                Bird's-eye view (ipm.IPMRenderer)
+            pipeline            detect_lanes + estimate_planar_homography
+                                + decompose_H + warp, per frame
+    calib
+        calibrate_camera        calibrate_camera_model on --calibdir
+                                (default: calibrate_ek_small/), no cache
+    koopa
+        Two views of the planar poster in --koopadir (default:
+        planar_koopa_small/), with the hand-picked correspondences of
+        demo_planar_homography.py and the K of --calibdir:
+            koopa_homography    cv2.findHomography between the views
+            koopa_decompose_H   util_camera.decompose_H of that homography
+            koopa_warp          cv2.warpPerspective of view 1 onto view 2
+
+The lanes are detected from --seed, so that two runs (e.g. before/after
+a change) do the same work.
+
+To check a change for regressions, save a baseline first, then compare:
+
+    $ python benchmark_pipeline.py --out baseline.json
+    (...change things...)
+    $ python benchmark_pipeline.py --out new.json --compare baseline.json
+
+A stage regresses if its p50 or p95 grew by more than --tolerance (as a
+fraction of the baseline), and by more than --min_delta ms (to ignore
+jitter of the sub-millisecond stages). The exit status is 1 if any stage
+regressed. Baselines are only comparable on the same (otherwise idle)
+machine: on shared/virtualized machines, raise --tolerance.
+"""
+
+IMGSDIR_SAMPLE = 'imgs_sample'
+IMGSDIR_CALIB = 'calibrate_ek_small'
+IMGSDIR_KOOPA = 'planar_koopa_small'
+
+# Same setup as estimate_planar_homography.main (Caltech Lanes)
+WIN_LEFT = (0.4, 0.60, 0.2, 0.25)
+WIN_RIGHT = (0.62, 0.60, 0.2, 0.25)
+WINS = (WIN_LEFT, WIN_RIGHT)
+THRESHOLD1, THRESHOLD2 = 100, 200
+LANE_W = 3.66 # 3.66 meters
+
+CALIB_ROWS, CALIB_COLS, CALIB_BOXDIM = 9, 6, 0.023
+
+IPM_SIZE = (1000, 700)  # Bird's-eye view (w, h)
+IPM_SCALE = 50.0        # Bird's-eye view pixels per meter
+
+FORMAT_VERSION = 1
+
+def time_it(fn, nb_reps):
+    """ Calls fn() nb_reps times.
+    Output:
+        (list durs, result)
+    Where durs are the wall-clock durations (in seconds) of each call,
+    and result is the output of the last call.
+    """
+    durs = []
+    result = None
+    for _ in xrange(nb_reps):
+        t = time.time()
+        result = fn()
+        durs.append(time.time() - t)
+    return durs, result
+
+def silenced(fn):
+    """ Calls fn() with stdout discarded (e.g. for calibrate_camera's
+    progress output).
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return fn()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+class DefaultList(dict):
+    """ dict whose missing entries are empty lists. """
+    def __missing__(self, key):
+        self[key] = []
+        return self[key]
+
+def summarize(durs):
+    """ Summarizes the durations (in seconds) of a stage.
+    Output:
+        dict stats
+    With keys n, p50_ms, p95_ms, mean_ms, max_ms, and fps (calls/sec at
+    the mean latency).
+    """
+    durs_ms = np.asarray(durs, dtype='float64') * 1e3
+    mean_ms = float(np.mean(durs_ms))
+    return dict(n=len(durs_ms),
+                p50_ms=float(np.percentile(durs_ms, 50)),
+                p95_ms=float(np.percentile(durs_ms, 95)),
+                mean_ms=mean_ms,
+                max_ms=float(np.max(durs_ms)),
+                fps=1e3 / mean_ms if mean_ms > 0 else float('inf'))
+
+def get_ipm_homography(H):
+    """ Outputs the homography mapping the image to the bird's-eye view
+    (IPM_SIZE, IPM_SCALE pixels per meter, camera at the bottom center),
+    given the homography H mapping the road plane (X, Z, 1) to the image
+    (see estimate_planar_homography).
+    """
+    w_out, h_out = IPM_SIZE
+    S = np.array([[IPM_SCALE, 0.0, w_out / 2.0],
+                  [0.0, -IPM_SCALE, h_out],
+                  [0.0, 0.0, 1.0]])
+    return np.dot(S, np.linalg.inv(H))
+
+def bench_lanes(args, durs):
+    """ The lane pipeline stages, on each image of args.imgsdir. The
+    reps loop over all images (rather than repeating each image), so
+    that the stages see changing inputs, as on a drive (e.g. warp
+    rebuilds its tables whenever H moves). A first, untimed pass warms
+    up the caches (e.g. detect_lanes's thread pool).
+    """
+    imgpaths = util.get_imgpaths(args.imgsdir, n=args.n)
+    Is = [cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE) for imgpath in imgpaths]
+    Irgbs = [cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_COLOR) for imgpath in imgpaths]
+    K = eph.K_CALTECH
+    renderer = ipm.IPMRenderer(IPM_SIZE)
+    line_estimator, params = detect_lanes.get_line_estimator('ransac')
+    print("(Info) lanes: {0} images from {1}".format(len(Is), args.imgsdir))
+    nb_missed = 0
+    durs_all = durs
+    for rep in xrange(-1, args.reps):
+        durs = durs_all if rep >= 0 else DefaultList()
+        for i, I in enumerate(Is):
+            h, w = I.shape[0:2]
+            seed = (args.seed, i)
+            t_frame = time.time()
+            t = time.time()
+            line1, line2 = detect_lanes.detect_lanes(I, win1=WIN_LEFT, win2=WIN_RIGHT,
+                                                     threshold1=THRESHOLD1, threshold2=THRESHOLD2,
+                                                     seed=seed)
+            durs['detect_lanes'].append(time.time() - t)
+            if line1 is None or line2 is None:
+                nb_missed += rep >= 0
+                continue
+            t = time.time()
+            H = eph.estimate_planar_homography_batch((w, h), line1[np.newaxis], line2[np.newaxis],
+                                                     K, WIN_LEFT, WIN_RIGHT, LANE_W)[0]
+            durs['estimate_planar_homography'].append(time.time() - t)
+            # The road plane w.r.t. the camera: normalized so sigma_2 = 1
+            Hplane = np.dot(np.linalg.inv(K), H)
+            Hplane = Hplane / np.linalg.svd(Hplane, compute_uv=False)[1]
+            t = time.time()
+            util_camera.decompose_H(Hplane)
+            durs['decompose_H'].append(time.time() - t)
+            H_ipm = get_ipm_homography(H)
+            t = time.time()
+            renderer.render(Irgbs[i], H_ipm)
+            durs['warp'].append(time.time() - t)
+            durs['pipeline'].append(time.time() - t_frame)
+
+            # The lane detection, stage by stage, as in detect_lanes_multi:
+            # one EdgeMap over both windows, then each window's view of it
+            bounds_all = [detect_lanes.get_window_bounds(win, w, h) for win in WINS]
+            t = time.time()
+            edgemap = detect_lanes.EdgeMap(I, detect_lanes.get_union_bounds(bounds_all),
+                                           THRESHOLD1, THRESHOLD2, apertureSize=3)
+            edges_all = [edgemap.window(bounds)[0] for bounds in bounds_all]
+            dur_canny = time.time() - t
+            dur_ransac, dur_fit = 0.0, 0.0
+            for k, edges in enumerate(edges_all):
+                rng = np.random.RandomState(np.append(seed, k))
+                t = time.time()
+                res = line_estimator(edges, rng=rng, **params)
+                dur_ransac += time.time() - t
+                if res is None or res[0] is None:
+                    continue
+                pts = estimate_line.get_edge_pts(edges)[res[1]]
+                t = time.time()
+                estimate_line.fit_line(pts)
+                dur_fit += time.time() - t
+            durs['canny'].append(dur_canny)
+            durs['ransac'].append(dur_ransac)
+            durs['fit_line'].append(dur_fit)
+    if nb_missed:
+        print("(Warning) lanes: no lanes found on {0}/{1} frames (excluded from the downstream stages)".format(
+            nb_missed, args.reps * len(Is)))
+    print("(Info) lanes: the warp tables were built {0} times".format(renderer.nb_builds))
+
+def calibrate(args):
+    """ Outputs the camera model of args.calibdir (not cached). """
+    imgpaths = util.get_imgpaths(args.calibdir)
+    return silenced(lambda: calibrate_camera.calibrate_camera_model(imgpaths, CALIB_ROWS, CALIB_COLS,
+                                                                    CALIB_BOXDIM, nb_workers=1))
+
+def bench_calib(args, durs):
+    """ Camera calibration, from scratch (no calib_cache). """
+    print("(Info) calib: {0} images from {1}".format(len(util.get_imgpaths(args.calibdir)),
+                                                      args.calibdir))
+    durs_calib, _ = time_it(lambda: calibrate(args), args.calib_reps)
+    durs['calibrate_camera'].extend(durs_calib)
+
+def bench_koopa(args, durs):
+    """ Homography between two views of the planar poster, its
+    decomposition, and the warp of one view onto the other.
+    """
+    K, distCoeffs, reproj_err = calibrate(args)
+    I1 = cv2.imread(os.path.join(args.koopadir, dph.KOOPA_IMG1), cv2.CV_LOAD_IMAGE_COLOR)
+    I2 = cv2.imread(os.path.join(args.koopadir, dph.KOOPA_IMG2), cv2.CV_LOAD_IMAGE_COLOR)
+    if I1 is None or I2 is None:
+        raise Exception("Couldn't read {0}, {1} from: {2}".format(dph.KOOPA_IMG1, dph.KOOPA_IMG2,
+                                                                  args.koopadir))
+    print("(Info) koopa: {0}, {1} from {2}".format(dph.KOOPA_IMG1, dph.KOOPA_IMG2, args.koopadir))
+    pts1_norm = util_camera.normalize_coords(dph.tup2nparray(dph.KOOPA_PTS1), K)
+    pts2_norm = util_camera.normalize_coords(dph.tup2nparray(dph.KOOPA_PTS2), K)
+    time_it(lambda: dph.estimate_planar_homography(pts1_norm, pts2_norm), 1) # Warm-up
+    durs_H, H_ = time_it(lambda: dph.estimate_planar_homography(pts1_norm, pts2_norm), args.reps)
+    durs['koopa_homography'].extend(durs_H)
+    H = H_ / np.linalg.svd(H_, compute_uv=False)[1]
+    durs_decomp, _ = time_it(lambda: util_camera.decompose_H(H), args.reps)
+    durs['koopa_decompose_H'].extend(durs_decomp)
+    Hpix = np.dot(K, np.dot(H_, np.linalg.inv(K)))
+    dsize = (I2.shape[1], I2.shape[0])
+    durs_warp, _ = time_it(lambda: cv2.warpPerspective(I1, Hpix, dsize), args.reps)
+    durs['koopa_warp'].extend(durs_warp)
+
+SUITES = {'lanes': bench_lanes,
+          'calib': bench_calib,
+          'koopa': bench_koopa}
+
+def run_benchmarks(args):
+    """ Output:
+        dict results
+    The JSON-able results: {'meta': {...}, 'stages': {name: stats, ...}}
+    (see summarize).
+    """
+    durs = {}
+    for suite in args.suites:
+        durs_suite = DefaultList()
+        np.random.seed(args.seed)
+        SUITES[suite](args, durs_suite)
+        durs.update(durs_suite)
+    stages = dict((name, summarize(durs_stage)) for name, durs_stage in durs.items()
+                  if len(durs_stage) > 0)
+    meta = dict(version=FORMAT_VERSION,
+                created=time.strftime("%Y-%m-%d %H:%M:%S"),
+                host=platform.node(),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                opencv=cv2.__version__,
+                suites=list(args.suites),
+                reps=args.reps,
+                calib_reps=args.calib_reps,
+                seed=args.seed,
+                imgsdir=args.imgsdir,
+                calibdir=args.calibdir,
+                koopadir=args.koopadir)
+    return dict(meta=meta, stages=stages)
+
+def print_results(results):
+    print("==== Per-stage latency ====")
+    print("    {0:28s} {1:>6s} {2:>10s} {3:>10s} {4:>10s}".format("stage", "n", "p50 (ms)", "p95 (ms)", "fps"))
+    for name, stats in sorted(results['stages'].items()):
+        print("    {0:28s} {1:6d} {2:10.3f} {3:10.3f} {4:10.1f}".format(
+            name, stats['n'], stats['p50_ms'], stats['p95_ms'], stats['fps']))
+
+def compare_results(results, baseline, tolerance=0.2, min_delta=0.05):
+    """ Compares the stages of results to those of baseline.
+    Input:
+        dict results, baseline
+            As output by run_benchmarks.
+        float tolerance
+            Max. allowed relative increase of p50/p95 (e.g. 0.2 for +20%).
+        float min_delta
+            Increases of at most min_delta ms are never regressions.
+    Output:
+        list regressions: [(str stage, str key, float base_ms, float new_ms), ...]
+    """
+    stages, stages_base = results['stages'], baseline['stages']
+    regressions = []
+    print("==== Comparison with the baseline ({0}) ====".format(baseline['meta'].get('created')))
+    for name in sorted(set(stages.keys()) | set(stages_base.keys())):
+        if name not in stages_base:
+            print("    {0:28s} (new stage)".format(name))
+            continue
+        elif name not in stages:
+            print("    {0:28s} (not run)".format(name))
+            continue
+        flags = []
+        for key in ('p50_ms', 'p95_ms'):
+            base_ms, new_ms = stages_base[name][key], stages[name][key]
+            if new_ms > base_ms * (1.0 + tolerance) and new_ms - base_ms > min_delta:
+                regressions.append((name, key, base_ms, new_ms))
+                flags.append("REGRESSION({0})".format(key[:3]))
+        ratio = stages[name]['p50_ms'] / stages_base[name]['p50_ms'] if stages_base[name]['p50_ms'] > 0 else float('inf')
+        print("    {0:28s} p50: {1:9.3f} -> {2:9.3f}ms ({3:5.2f}x)  p95: {4:9.3f} -> {5:9.3f}ms  {6}".format(
+            name, stages_base[name]['p50_ms'], stages[name]['p50_ms'], ratio,
+            stages_base[name]['p95_ms'], stages[name]['p95_ms'], ' '.join(flags)))
+    if regressions:
+        print("{0} regression(s) (tolerance=+{1:.0f}%, min_delta={2}ms)".format(
+            len(regressions), tolerance*100, min_delta))
+    else:
+        print("No regressions (tolerance=+{0:.0f}%, min_delta={1}ms)".format(tolerance*100, min_delta))
+    return regressions
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('meta', {}).get('version') != FORMAT_VERSION or 'stages' not in results:
+        raise Exception("Not a benchmark_pipeline.py results file (version {0}): {1}".format(
+            FORMAT_VERSION, path))
+    return results
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suites", nargs='+', choices=sorted(SUITES.keys()),
+                        default=sorted(SUITES.keys()),
+                        help="Which stages to benchmark.")
+    parser.add_argument("--imgsdir", default=IMGSDIR_SAMPLE,
+                        help="Directory of street images (lanes).")
+    parser.add_argument("--calibdir", default=IMGSDIR_CALIB,
+                        help="Directory of calibration images (calib, koopa).")
+    parser.add_argument("--koopadir", default=IMGSDIR_KOOPA,
+                        help="Directory of the planar poster images (koopa).")
+    parser.add_argument("--n", type=int, help="Number of street images to use.")
+    parser.add_argument("--reps", type=int, default=20,
+                        help="Repetitions of each stage, per input.")
+    parser.add_argument("--calib_reps", type=int, default=3,
+                        help="Repetitions of the camera calibration.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the RANSAC samples.")
+    parser.add_argument("--out", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="Flag regressions w.r.t. this (--out) JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative p50/p95 increase w.r.t. the baseline.")
+    parser.add_argument("--min_delta", type=float, default=0.05,
+                        help="Ignore p50/p95 increases of at most this many ms.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    baseline = load_results(args.compare) if args.compare else None
+    results = run_benchmarks(args)
+    print_results(results)
+    if args.out:
+        save_results(results, args.out)
+        print("(Info) Wrote results to: {0}".format(args.out))
+    if baseline is not None:
+        regressions = compare_results(results, baseline, tolerance=args.tolerance,
+                                      min_delta=args.min_delta)
+        if regressions:
+            sys.exit(1)
+    print("Done.")
+
+if __name__ == '__main__':
+    main()
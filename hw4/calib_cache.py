@@ -0,0 +1,139 @@
+"""
+On-disk cache of camera calibration results, so that the demos don't
+have to re-run calibrate_camera over the calibration images on every
+run.
+
+Each calibration is stored in:
+    <cachedir>/<key>.npz        K, distCoeffs, reproj_err
+and listed in:
+    <cachedir>/manifest.json    {key: {imgsdir, nb_imgs, rows, cols, ...}}
+where key is a hash of the contents of the calibration images, the
+pattern size and the box dimension. Thus, if any of these change, the
+old result is simply not found. When the images of a directory change,
+its old entry (same pattern, box dimension and corner search mode) is
+dropped as the new result is saved; the directory's calibrations with
+other patterns are kept.
+"""
+
+import os, json, time, hashlib
+import numpy as np
+
+import calibrate_camera
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.calib_cache')
+CACHE_VERSION = 1   # Bump to invalidate all existing entries
+# Manifest fields that identify a calibration, besides the image contents
+CALIB_FIELDS = ('imgsdir', 'rows', 'cols', 'boxdim', 'coarse_size')
+
+def calib_key(imgpaths, rows, cols, boxdim, coarse_size=None):
+    """ Outputs the cache key of a calibration: the sha1 of the image
+    contents (in order), the pattern size, the box dimension and the
+    corner search mode.
+    """
+    sha = hashlib.sha1()
+    sha.update("v{0};{1}x{2};{3!r}".format(CACHE_VERSION, rows, cols, float(boxdim)))
+    if coarse_size is not None:
+        sha.update(";coarse={0}".format(coarse_size))
+    for imgpath in imgpaths:
+        sha.update(";")
+        with open(imgpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def load_calib(key, cachedir=CACHE_DIR):
+    """ Output:
+        (nparray K, nparray distCoeffs, float reproj_err), or None if key
+        isn't cached.
+    """
+    path = os.path.join(cachedir, key + '.npz')
+    if not os.path.exists(path):
+        return None
+    try:
+        data = np.load(path)
+        return data['K'], data['distCoeffs'], float(data['reproj_err'])
+    except (IOError, KeyError, ValueError):
+        return None # Corrupt entry: recompute it
+
+def save_calib(key, K, distCoeffs, reproj_err, info=None, cachedir=CACHE_DIR):
+    """ Stores a calibration result, and records it in the manifest.
+    Input:
+        str key
+        nparray K, distCoeffs
+        float reproj_err
+        dict info
+            Extra manifest fields. If info['imgsdir'] is given, then the
+            older entries of the same calibration (see same_calib) are
+            removed.
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    path_tmp = os.path.join(cachedir, key + '.tmp.npz')
+    np.savez(path_tmp, K=K, distCoeffs=distCoeffs, reproj_err=reproj_err)
+    os.rename(path_tmp, os.path.join(cachedir, key + '.npz'))
+    manifest = load_manifest(cachedir)
+    entry = dict(info or {})
+    entry['reproj_err'] = float(reproj_err)
+    entry['created'] = time.strftime("%Y-%m-%d %H:%M:%S")
+    if entry.get('imgsdir') is not None:
+        for key_old, entry_old in manifest.items():
+            if key_old != key and same_calib(entry_old, entry):
+                del manifest[key_old]
+                path_old = os.path.join(cachedir, key_old + '.npz')
+                if os.path.exists(path_old):
+                    os.remove(path_old)
+    manifest[key] = entry
+    save_manifest(manifest, cachedir)
+
+def same_calib(entry1, entry2):
+    """ Whether two manifest entries calibrate the same image directory
+    with the same pattern, box dimension and corner search mode (i.e.
+    differ at most by the image contents).
+    """
+    return all(entry1.get(field) == entry2.get(field)
+               for field in CALIB_FIELDS)
+
+def load_manifest(cachedir=CACHE_DIR):
+    path = os.path.join(cachedir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_manifest(manifest, cachedir=CACHE_DIR):
+    path = os.path.join(cachedir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def get_camera_calibration(imgpaths, rows, cols, boxdim, use_cache=True,
+                           cachedir=CACHE_DIR, SHOW_CB=False, nb_workers=None,
+                           coarse_size=None):
+    """ Same as calibrate_camera.calibrate_camera_model, but reuses the
+    cached result if the calibration images, pattern and box dimension
+    are unchanged.
+    Input:
+        bool use_cache
+            If False, always recalibrate (the result is still cached).
+    Output:
+        (nparray K, nparray distCoeffs, float reproj_err)
+    """
+    key = calib_key(imgpaths, rows, cols, boxdim, coarse_size=coarse_size)
+    if use_cache and not SHOW_CB:
+        res = load_calib(key, cachedir=cachedir)
+        if res is not None:
+            print "(Info) Reusing cached camera calibration ({0})".format(key[:10])
+            return res
+    K, distCoeffs, reproj_err = calibrate_camera.calibrate_camera_model(imgpaths, rows, cols, boxdim,
+                                                                        SHOW_CB=SHOW_CB,
+                                                                        nb_workers=nb_workers,
+                                                                        coarse_size=coarse_size)
+    imgsdirs = set(os.path.dirname(os.path.abspath(p)) for p in imgpaths)
+    info = dict(imgsdir=imgsdirs.pop() if len(imgsdirs) == 1 else None,
+                nb_imgs=len(imgpaths), rows=rows, cols=cols, boxdim=boxdim,
+                coarse_size=coarse_size)
+    save_calib(key, K, distCoeffs, reproj_err, info=info, cachedir=cachedir)
+    return K, distCoeffs, reproj_err
@@ -1,13 +1,29 @@
-import sys, os, pdb, argparse
+import sys, os, pdb, argparse, time
+import multiprocessing
 
 import util
 import numpy as np, cv, cv2
 
 from util import intrnd
 
-def calibrate_camera(imgpaths, rows, cols, boxdim, SHOW_CB=False):
+def calibrate_camera(imgpaths, rows, cols, boxdim, SHOW_CB=False, nb_workers=None,
+                     coarse_size=None):
     """ Determines intrinsic camera matrix K from a set of images of a
     calibration pattern (checkerboard pattern).
+    Input:
+        (See calibrate_camera_model)
+    Output:
+        nparray K
+    """
+    K, distCoeffs, reproj_err = calibrate_camera_model(imgpaths, rows, cols, boxdim,
+                                                       SHOW_CB=SHOW_CB, nb_workers=nb_workers,
+                                                       coarse_size=coarse_size)
+    return K
+
+def calibrate_camera_model(imgpaths, rows, cols, boxdim, SHOW_CB=False, nb_workers=None,
+                           coarse_size=None):
+    """ Determines the camera model (intrinsic matrix K and lens
+    distortion) from a set of images of a calibration pattern.
     Input:
         tuple imgpaths
         int rows, cols
@@ -17,30 +33,32 @@ def calibrate_camera(imgpaths, rows, cols, boxdim, SHOW_CB=False):
         boolean SHOW_CB
             If True, then we show the checkerboard results in an
             interactive manner.
+        int nb_workers
+            Number of processes searching for corners (see
+            find_all_corners).
+        int coarse_size
+            If given, search for the corners coarse-to-fine, starting at
+            this resolution (see find_corners_pyramid).
     Output:
-        nparray K
+        (nparray K, nparray distCoeffs, float reproj_err)
+    Where distCoeffs are the distortion coefficients (k1, k2, p1, p2, k3),
+    and reproj_err is the RMS reprojection error (in pixels).
     """
-    object_pts = []
     image_pts = []
-    w_img, h_img = None, None
-    for i, imgpath in enumerate(imgpaths):
-        I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-        if w_img == None:
-            w_img = I.shape[1]
-            h_img = I.shape[0]
-        # nparray corners: N x 1 x 2 matrix of coords for all N corners
-        retval, corners = cv2.findChessboardCorners(I, (rows, cols),
-                                                    flags=cv.CV_CALIB_CB_ADAPTIVE_THRESH | 
-                                                          cv.CV_CALIB_CB_NORMALIZE_IMAGE)
+    results = find_all_corners(imgpaths, rows, cols, nb_workers=nb_workers,
+                               coarse_size=coarse_size)
+    w_img, h_img = results[0][2]
+    for i, (retval, corners, imgsize, dur) in enumerate(results):
+        name = os.path.split(imgpaths[i])[1]
         if retval == 0:
-            if corners == None:
-                print "(i={0}) Warning: could not find any corners (0/{1})".format(i, rows*cols)
+            if corners is None:
+                print "(i={0}) Warning: could not find any corners (0/{1}) [{2}, {3:.3f}s]".format(i, rows*cols, name, dur)
             else:
-                print "(i={0}) Warning: could not find all corners ({1}/{2})".format(i, len(corners), rows*cols)
+                print "(i={0}) Warning: could not find all corners ({1}/{2}) [{3}, {4:.3f}s]".format(i, len(corners), rows*cols, name, dur)
         else:
-            pass
-            #print "(i={0}) Found all corners! ({1}/{1})".format(i, rows*cols)
+            print "(i={0}) Found all corners ({1}/{1}) [{2}, {3:.3f}s]".format(i, rows*cols, name, dur)
         if SHOW_CB:
+            I = cv2.imread(imgpaths[i], cv2.CV_LOAD_IMAGE_GRAYSCALE)
             Irgb = cv2.cvtColor(I, cv.CV_GRAY2RGB)
             cv2.drawChessboardCorners(Irgb, (rows, cols), corners, retval)
             cv2.namedWindow('display')
@@ -48,47 +66,146 @@ def calibrate_camera(imgpaths, rows, cols, boxdim, SHOW_CB=False):
             cv2.waitKey(0)
         if retval == 0:
             continue
-        cb_pts = compute_cb_pts(corners, rows, cols, boxdim)
-        object_pts.append(cb_pts)
         image_pts.append(corners)
-    print "Found all corners in {0}/{1} views".format(len(object_pts), len(imgpaths))
-    # object_mat: M x N x 1 x 3 (M is # of views, N is # of corners)
-    object_mat = np.zeros([len(object_pts), rows*cols, 1, 3])
+    print "Found all corners in {0}/{1} views".format(len(image_pts), len(imgpaths))
+    # object_mat: M x N x 1 x 3 (M is # of views, N is # of corners).
+    # Every view sees the same checkerboard.
+    object_mat = np.empty([len(image_pts), rows*cols, 1, 3], dtype='float32')
+    object_mat[...] = compute_cb_pts(None, rows, cols, boxdim)
     # image_mat: M x N x 1 x 2
-    image_mat = np.zeros([len(image_pts), rows*cols, 1, 2])
-    for i, objpts in enumerate(object_pts):
-        object_mat[i,:,:,:] = objpts
+    image_mat = np.empty([len(image_pts), rows*cols, 1, 2], dtype='float32')
     for i, imgpts in enumerate(image_pts):
-        image_mat[i,:,:,:] = imgpts
+        image_mat[i] = imgpts
     print "(Info) Calling cv2.calibrateCamera..."
-    retval_calib, K, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(object_mat.astype('float32'),
-                                                                    image_mat.astype('float32'),
-                                                                    (w_img, h_img))
+    retval_calib, K, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(object_mat, image_mat,
+                                                                    (w_img, h_img), None, None)
     print "retval_calib:", retval_calib
-    return K
+    return K, distCoeffs, retval_calib
         
+def find_corners(imgpath, rows, cols, coarse_size=None):
+    """ Searches for the checkerboard corners in one image.
+    Input:
+        str imgpath
+        int rows, cols
+        int coarse_size
+            If given (and the image is larger), search coarse-to-fine:
+            see find_corners_pyramid.
+    Output:
+        (bool retval, nparray corners, tuple imgsize, float dur)
+    Where corners is the N x 1 x 2 matrix of coords for all N corners
+    (or None), imgsize is (w, h), and dur is the search time.
+    """
+    t = time.time()
+    I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    if I is None:
+        raise Exception("Couldn't read image: {0}".format(imgpath))
+    if coarse_size is not None and max(I.shape) > coarse_size:
+        retval, corners = find_corners_pyramid(I, rows, cols, coarse_size)
+    else:
+        retval, corners = cv2.findChessboardCorners(I, (rows, cols),
+                                                    flags=cv.CV_CALIB_CB_ADAPTIVE_THRESH | 
+                                                          cv.CV_CALIB_CB_NORMALIZE_IMAGE)
+    return bool(retval), corners, (I.shape[1], I.shape[0]), time.time() - t
+
+def find_corners_pyramid(I, rows, cols, coarse_size):
+    """ Coarse-to-fine checkerboard search. The board is detected on a
+    copy of I downscaled to coarse_size pixels (along its larger side),
+    with a fast check that rejects images without a board early. The
+    upscaled corners are then refined with cv2.cornerSubPix at full
+    resolution, only within the bounding box of the board.
+    Output:
+        (bool retval, nparray corners)
+    Same as cv2.findChessboardCorners.
+    """
+    s = coarse_size / float(max(I.shape))
+    Ismall = cv2.resize(I, (intrnd(I.shape[1]*s), intrnd(I.shape[0]*s)),
+                        interpolation=cv2.INTER_AREA)
+    retval, corners = cv2.findChessboardCorners(Ismall, (rows, cols),
+                                                flags=cv.CV_CALIB_CB_ADAPTIVE_THRESH | 
+                                                      cv.CV_CALIB_CB_NORMALIZE_IMAGE |
+                                                      cv.CV_CALIB_CB_FAST_CHECK)
+    if not retval:
+        return retval, corners
+    # Pixel centers: x_full + 0.5 = (x_small + 0.5) / s
+    sx = I.shape[1] / float(Ismall.shape[1])
+    sy = I.shape[0] / float(Ismall.shape[0])
+    corners = corners.astype('float32')
+    corners[:, 0, 0] = (corners[:, 0, 0] + 0.5) * sx - 0.5
+    corners[:, 0, 1] = (corners[:, 0, 1] + 0.5) * sy - 0.5
+    # The search window must cover the upscaling error, yet stay within
+    # one checkerboard square.
+    grid = corners.reshape(cols, rows, 2)
+    spacing = min(np.min(np.hypot(*np.diff(grid, axis=1).reshape(-1, 2).T)),
+                  np.min(np.hypot(*np.diff(grid, axis=0).reshape(-1, 2).T)))
+    win = int(max(2, min(np.ceil(2.0 * max(sx, sy)), spacing / 3.0)))
+    # Refine within the board's bounding box only
+    margin = win + 2
+    x0 = max(0, int(np.floor(corners[:, 0, 0].min())) - margin)
+    y0 = max(0, int(np.floor(corners[:, 0, 1].min())) - margin)
+    x1 = min(I.shape[1], int(np.ceil(corners[:, 0, 0].max())) + margin + 1)
+    y1 = min(I.shape[0], int(np.ceil(corners[:, 0, 1].max())) + margin + 1)
+    corners -= np.array([x0, y0], dtype='float32')
+    cv2.cornerSubPix(I[y0:y1, x0:x1], corners, (win, win), (-1, -1),
+                     (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01))
+    corners += np.array([x0, y0], dtype='float32')
+    return retval, corners
+
+def find_all_corners(imgpaths, rows, cols, nb_workers=None, coarse_size=None):
+    """ Runs find_corners on every image, on a pool of nb_workers
+    processes (default: one per core). Only the corner arrays are sent
+    back, and the output is in the same order as imgpaths, so the result
+    is the same as a serial run's. For coarse_size, see find_corners.
+    Output:
+        list results: [(retval, corners, imgsize, dur), ...]
+    """
+    if nb_workers is None:
+        nb_workers = multiprocessing.cpu_count()
+    nb_workers = min(nb_workers, len(imgpaths))
+    if nb_workers <= 1:
+        return [find_corners(imgpath, rows, cols, coarse_size) for imgpath in imgpaths]
+    pool = multiprocessing.Pool(nb_workers, initializer=init_worker)
+    try:
+        asyncs = [pool.apply_async(find_corners, (imgpath, rows, cols, coarse_size))
+                  for imgpath in imgpaths]
+        results = [a.get() for a in asyncs]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def init_worker():
+    # One OpenCV thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+
+_CB_PTS = {}   # (rows, cols, boxdim) -> corners_world
+
 def compute_cb_pts(corners, rows, cols, boxdim):
     """ Given the pixel coords of the corners, output world coords,
     i.e. with Z = 0 (where we set the world frame onto the calibration
     plane, with the origin on the upper-left-corner-most corner.
+    Since this only depends on the checkerboard, it is computed once
+    per (rows, cols, boxdim), and the (read-only) result is reused.
     Input:
         nparray corners: N x 1 x 2
+            Unused (only the pattern size matters).
         float boxdim
     Output:
-        nparray corners_world: N x 1 x 3
+        nparray corners_world: N x 1 x 3 (float32)
     """
-    out = np.zeros([corners.shape[0], 1, 3])
-    for i in xrange(rows):
-        # Y axis points along columns
-        Y = i * boxdim
-        for j in xrange(cols):
-            # X axis points along rows
-            X = j * boxdim
-            idx = j + i*cols
-            imgpt = corners[idx]
-            out[idx, 0, 0] = X
-            out[idx, 0, 1] = Y
-            out[idx, 0, 2] = 0 # Z = 0
+    key = (rows, cols, float(boxdim))
+    out = _CB_PTS.get(key)
+    if out is None:
+        # Corner idx = j + i*cols lies at X = j*boxdim (X axis points
+        # along rows), Y = i*boxdim (Y axis points along columns), Z = 0
+        i, j = np.mgrid[0:rows, 0:cols]
+        out = np.zeros([rows*cols, 1, 3], dtype='float32')
+        out[:, 0, 0] = j.ravel() * boxdim
+        out[:, 0, 1] = i.ravel() * boxdim
+        out.setflags(write=False)
+        _CB_PTS[key] = out
     return out
 
 def parse_args():
@@ -105,6 +222,15 @@ metric units (in m)",
                         default=0.048)
     parser.add_argument("--show_cb", action='store_true', default=False,
                         help="Interactively display checkerboard.")
+    parser.add_argument("--workers", type=int,
+                        help="Number of processes searching for corners \
+(default: one per core).")
+    parser.add_argument("--coarse_size", type=int,
+                        help="Detect the checkerboard on images downscaled \
+to this size first, then refine the corners at full resolution (e.g. 500).")
+    parser.add_argument("--no_cache", action='store_true', default=False,
+                        help="Recalibrate, even if the calibration of these \
+images is cached.")
     return parser.parse_args()
 
 def main():
@@ -113,9 +239,16 @@ def main():
     imgpaths = util.get_imgpaths(imgsdir)
     print "(Info) Processing {0} images".format(len(imgpaths))
     rows, cols = args.patternsize
-    K = calibrate_camera(imgpaths, rows, cols, args.boxdim, SHOW_CB=args.show_cb)
+    import calib_cache # (Not at module level: calib_cache imports this module)
+    K, distCoeffs, reproj_err = calib_cache.get_camera_calibration(imgpaths, rows, cols, args.boxdim,
+                                                                   use_cache=not args.no_cache,
+                                                                   SHOW_CB=args.show_cb,
+                                                                   nb_workers=args.workers,
+                                                                   coarse_size=args.coarse_size)
     print "Computed K:"
     print K
+    print "Distortion coefficients:", distCoeffs.ravel()
+    print "Reprojection error: {0:.4f} pixels".format(reproj_err)
     print "Done."
 
 if __name__ == '__main__':
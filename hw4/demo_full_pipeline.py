@@ -2,9 +2,9 @@ import sys, os, pdb, argparse, time
 import util_camera, util
 import numpy as np, cv2, cv
 
-import calibrate_camera, detect_lanes
+import calib_cache, detect_lanes, lane_tracker, frame_source, ipm, undistort, lateral_offset
 from util import intrnd
-from util_camera import compute_x, compute_y, pt2homo, homo2pt
+from util_camera import compute_x, compute_y, pt2homo, homo2pt, sample_lane_pairs
 
 """
 USAGE:
@@ -36,14 +36,45 @@ WIN_RIGHT = (0.47, 0.55, 0.25, 0.1)
 
 LANE_W = 3.66 # 3.66 meters
 
+LEFT_THRESH = -1.0    # Stay within 1.0 meters of the center of the lane
+RIGHT_THRESH = 1.0
+TLC_THRESH = 1.0      # Warn if a lane will be crossed within 1.0 seconds
+
+# Precomputed camera matrix of the LDWS_calibrate_short/ camera (see
+# --reuse_calib)
+K_PRECOMPUTED = np.array([[ 674.07224154,    0.,          262.77722917],
+                          [   0.,          670.26875783,  330.21546389],
+                          [   0.,            0.,            1.        ]])
+CALIB_ROWS, CALIB_COLS, CALIB_BOXDIM = 8, 8, 0.048
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--imgsdir", default=IMGSDIR_TEST,
                         help="Directory of test images. Can be a single \
-image path.")
+image path, a video file, or '-' to read raw frames from stdin.")
+    parser.add_argument("--raw_size", nargs=2, type=int, metavar=("W", "H"),
+                        help="Frame size of the raw frames on stdin.")
+    parser.add_argument("--raw_channels", type=int, choices=(1, 3), default=3,
+                        help="Channels of the raw frames on stdin (1: gray, \
+3: BGR).")
     parser.add_argument("--reuse_calib", action='store_true', default=False,
                         help="Use a precomputed camera calibration matrix, \
 rather than re-computing it.")
+    parser.add_argument("--recalib", action='store_true', default=False,
+                        help="Re-compute the camera calibration, even if it \
+is cached (see calib_cache.py).")
+    parser.add_argument("--undistort", choices=('none', 'frame', 'points'), default='none',
+                        help="Correct lens distortion: 'frame' undistorts \
+each frame before lane detection, 'points' only undistorts the detected \
+lanes (see undistort.py), which is cheaper; the frames are then only \
+undistorted for display.")
+    parser.add_argument("--track", action='store_true', default=False,
+                        help="Track the lanes across frames (the images are \
+assumed to be consecutive video frames), rather than detecting them from \
+scratch in each image.")
+    parser.add_argument("--fps", type=float, default=30.0,
+                        help="Frame rate of the test images, for the lateral \
+velocity and time to line crossing estimates.")
     return parser.parse_args()
 
 def main():
@@ -52,90 +83,67 @@ def main():
         print "(ERROR) Calibration images not found. Please place \
 the LDWS_calibrate_short/ images in the current directory."
         exit(1)
-    if not os.path.exists(IMGSDIR_TEST):
+    if args.imgsdir != '-' and not os.path.exists(args.imgsdir):
         print "(ERROR) Test images not found. Please place the \
 LDWS_test_short/ images in the current directory."
         exit(1)
 
     imgpaths_calib = util.get_imgpaths(IMGSDIR_CALIB)
-    if not os.path.isdir(args.imgsdir):
-        imgpaths_test = [args.imgsdir]
-    else:
-        imgpaths_test  = util.get_imgpaths(args.imgsdir)
-    if args.reuse_calib:
-        print "(Reusing camera calibration matrix)"
-        K = np.array([[ 674.07224154,    0.,          262.77722917],
-                      [   0.,          670.26875783,  330.21546389],
-                      [   0.,            0.,            1.        ]])
-    else:
-        print "(Estimating camera matrix...)"
-        t = time.time()
-        K = calibrate_camera.calibrate_camera(imgpaths_calib, 8, 8, 0.048)
-        dur = time.time() - t
-        print "(Finished. {0:.4f})".format(dur)
+    frames = frame_source.open_frame_source(args.imgsdir, raw_size=args.raw_size,
+                                            raw_channels=args.raw_channels)
+    K, distCoeffs = get_camera_model(imgpaths_calib, reuse_calib=args.reuse_calib,
+                                     recalib=args.recalib)
 
-    for i, imgpath in enumerate(imgpaths_test):
-        print "\n==== ({0}/{1}) Detecting lanes... [{2}]====".format(i+1, len(imgpaths_test), os.path.split(imgpath)[1])
-        I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-        h, w = I.shape[0:2]
+    if args.undistort != 'none' and distCoeffs is None:
+        print "(Warning) No lens distortion coefficients with --reuse_calib, \
+not undistorting."
+        args.undistort = 'none'
+
+    tracker = None
+    if args.track:
+        tracker = lane_tracker.LaneTracker(WIN_LEFT, WIN_RIGHT,
+                                           threshold1=110, threshold2=220,
+                                           apertureSize=3)
+    offset_tracker = lateral_offset.LateralOffsetTracker(LANE_W)
+    ipm_renderer = ipm.IPMRenderer((1000, 700))
+    nb_frames = frames.nb_frames if frames.nb_frames is not None else '?'
+    for i, (name, Irgb) in enumerate(frames):
+        print "\n==== ({0}/{1}) Detecting lanes... [{2}]====".format(i+1, nb_frames, name)
         t = time.time()
-        line1, line2 = detect_lanes.detect_lanes(I, win1=WIN_LEFT, win2=WIN_RIGHT,
-                                                 threshold1=110, threshold2=220,
-                                                 apertureSize=3,
-                                                 show_edges=False)
-        dur = time.time() - t
-        print "    Finished detecting lanes ({0:.4f}s)".format(dur)
-        if line1 == None or line2 == None:
-            print "({0}/{1}) Error: Couldn't find lanes.".format(i+1, len(imgpaths_test))
+        undistorter = None
+        if args.undistort != 'none':
+            undistorter = undistort.get_undistorter(K, distCoeffs, (Irgb.shape[1], Irgb.shape[0]))
+        if args.undistort == 'frame':
+            Irgb = undistorter.undistort_image(Irgb)
+        I = cv2.cvtColor(Irgb, cv2.COLOR_BGR2GRAY)
+        h, w = I.shape[0:2]
+        res = process_frame(I, K=K, tracker=tracker,
+                            undistorter=undistorter if args.undistort == 'points' else None,
+                            offset_tracker=offset_tracker, dt=1.0 / args.fps)
+        print "    Finished processing frame ({0:.4f}s)".format(time.time() - t)
+        if res['xdist'] is None:
+            print "({0}/{1}) Error: Couldn't find lanes.".format(i+1, nb_frames)
             continue
-
-        # Choose 4 points on the lanes to estimate the planar homography
-        y1 = intrnd(0.45 * h)
-        y2 = intrnd(0.65 * h)
-        pts = np.array([[compute_x(line1, y1), y1],    # Left lane, far
-                        [compute_x(line2, y1), y1],    # Right lane, far
-                        [compute_x(line1, y2), y2],    # Left lane, close
-                        [compute_x(line2, y2), y2]])   # Right lane, close
-        # These world points have the origin at the middle of the lane,
-        # directly below the camera.
-        # Depths 5.0, 3.0 are chosen arbitrarily, as we don't have depth
-        # information. Thus, the computed H will only be accurate in the
-        # X axis.
-        pts_worldm = np.array([[-LANE_W/2.0, 5.0],           # Left lane, far
-                               [LANE_W/2.0, 5.0],            # Right lane, far
-                               [-LANE_W/2.0, 3.0],           # Left lane, close
-                               [LANE_W/2.0, 3.0]])           # Right lane, close
-        # These world points are scaled+translated to generate a 
-        # reasonably-sized image w/ perspective effects removed.
-        # Note: the origin here is not the same origin as in pts_worldm!
-        pts_world = np.array([[0.0, 0.0],
-                              [LANE_W*1e2, 0.0],
-                              [0.0, 500],
-                              [LANE_W*1e2, 500.0]])
-        pts_world[:,0] += LANE_W*1e2 # Let's see more of the horizontal image
-        pts_world[:,1] += 200 # Let's see more down the road
-        # H_metric := Homography mapping the image (pixel coords) to the 
-        #             world plane defined by pts_worldm
-        H_metric = cv2.getPerspectiveTransform(pts.astype('float32'), pts_worldm.astype('float32'))
-        H = cv2.getPerspectiveTransform(pts.astype('float32'), pts_world.astype('float32'))
-        
-        ## Estimate where the camera is w.r.t. the world ref. frame
-        R, T = estimate_extrinsic_parameters(H_metric)
-        xdist = T[0] - (LANE_W / 2.0)
+        line1, line2 = res['line1'], res['line2']
+        pts, H = res['pts'], res['H']
+        xdist = res['xdist']
         print "    Distance from center of lane: X={0:.2f} meters".format(xdist)
-        LEFT_THRESH = -1.0    # Stay within 1.0 meters of the center of the lane
-        RIGHT_THRESH = 1.0
-        if xdist >= RIGHT_THRESH:
+        if res['xvel'] is not None:
+            print "    Lateral velocity: {0:.2f} m/s (time to line crossing: {1:.2f}s)".format(
+                res['xvel'], res['tlc'])
+        if res['warning'] == 'RIGHT':
             print "        WARNING: Camera center is awfully close to the \
 RIGHT side of the lane!"
-        elif xdist <= LEFT_THRESH:
+        elif res['warning'] == 'LEFT':
             print "        WARNING: Camera center is awfully close to the \
 LEFT side of the lane!"
 
-        Irgb = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_COLOR)
-        Iipm = cv2.warpPerspective(Irgb.astype('float64'), H, (1000, 700))
+        if args.undistort == 'points':
+            # The lanes, pts and H are in undistorted coordinates
+            Irgb = undistorter.undistort_image(Irgb)
+        Iipm = ipm_renderer.render(Irgb, H)
         cv2.namedWindow("win2: Perspective-rectified image")
-        cv2.imshow("win2: Perspective-rectified image", Iipm.astype('uint8'))
+        cv2.imshow("win2: Perspective-rectified image", Iipm)
 
         Irgb = detect_lanes.draw_subwindow(Irgb, WIN_LEFT)
         Irgb = detect_lanes.draw_subwindow(Irgb, WIN_RIGHT)
@@ -143,21 +151,175 @@ LEFT side of the lane!"
             _pt = tuple([intrnd(x) for x in _pt])
             cv2.circle(Irgb, _pt, 3, (0, 0, 255))
 
-        print "    ({0}/{1}) Displaying detected lanes.".format(i+1, len(imgpaths_test))
+        print "    ({0}/{1}) Displaying detected lanes.".format(i+1, nb_frames)
         show_lanes(Irgb, line1, line2)
 
     print "Done."
 
+def get_camera_model(imgpaths_calib, reuse_calib=False, recalib=False):
+    """ Determines the camera model from the calibration images.
+    Input:
+        list imgpaths_calib
+        bool reuse_calib
+            Use K_PRECOMPUTED rather than calibrating.
+        bool recalib
+            Re-compute the calibration, even if it is cached.
+    Output:
+        (nparray K, nparray distCoeffs)
+    distCoeffs is None with reuse_calib.
+    """
+    if reuse_calib:
+        print "(Reusing camera calibration matrix)"
+        return K_PRECOMPUTED, None
+    print "(Estimating camera matrix...)"
+    t = time.time()
+    K, distCoeffs, reproj_err = calib_cache.get_camera_calibration(imgpaths_calib, CALIB_ROWS, CALIB_COLS,
+                                                                   CALIB_BOXDIM, use_cache=not recalib)
+    dur = time.time() - t
+    print "(Finished. {0:.4f})".format(dur)
+    return K, distCoeffs
+
+def process_frame(I, K=None, tracker=None, undistorter=None, offset_tracker=None, dt=None,
+                  seed=None):
+    """ Runs the lane-departure warning pipeline on one image.
+    Input:
+        nparray I
+            Grayscale street image.
+        nparray K
+            The 3x3 camera intrinsic matrix. If given, xdist is computed
+            in closed form from the lanes (see lateral_offset.py), rather
+            than by decomposing H_metric.
+        LaneTracker tracker
+            If given, then lanes are tracked with it (see lane_tracker.py),
+            rather than detected from scratch.
+        Undistorter undistorter
+            If given, then I is a distorted image, and the detected lanes
+            are undistorted (see undistort.py) before the homography is
+            estimated. (To undistort whole frames instead, undistort I
+            before calling process_frame.)
+        LateralOffsetTracker offset_tracker
+            If given (with the time dt (s) since the previous frame), then
+            xdist is filtered across frames, to estimate the lateral
+            velocity and the time to line crossing.
+        int seed
+            If given, the lanes are detected reproducibly (see
+            detect_lanes.detect_lanes). Not used with a tracker, which has
+            its own seed.
+    Output:
+        dict res
+    With keys:
+        line1, line2: The detected left/right lanes (or None).
+        pts: The 4 lane points used to estimate H (Nx2).
+        H: Homography mapping the image to the bird's-eye view.
+        H_metric: Homography mapping the image to the road plane (m).
+        xdist: Distance (m) of the camera from the center of the lane.
+        xvel: Lateral velocity (m/s) of the camera (with offset_tracker).
+        tlc: Time to line crossing (s) (with offset_tracker).
+        warning: 'LEFT', 'RIGHT' or None (see get_lane_warning).
+    If a lane was not found, then pts, H, H_metric, xdist are None. xvel
+    and tlc are None without an offset_tracker (or its first frame).
+    """
+    h, w = I.shape[0:2]
+    if tracker is not None:
+        line1, line2 = tracker.update(I)
+    else:
+        line1, line2 = detect_lanes.detect_lanes(I, win1=WIN_LEFT, win2=WIN_RIGHT,
+                                                 threshold1=110, threshold2=220,
+                                                 apertureSize=3,
+                                                 show_edges=False, seed=seed)
+    # Rows of the 4 points on the lanes used to estimate the homography
+    y1 = intrnd(0.45 * h)
+    y2 = intrnd(0.65 * h)
+    if undistorter is not None:
+        ys = np.linspace(y1, y2, 8)
+        line1 = undistorter.undistort_line(line1, ys)
+        line2 = undistorter.undistort_line(line2, ys)
+    res = dict(line1=line1, line2=line2, pts=None, H=None, H_metric=None,
+               xdist=None, xvel=None, tlc=None, warning=None)
+    if line1 is None or line2 is None:
+        if offset_tracker is not None:
+            offset_tracker.update(None, dt)
+        return res
+
+    # Choose 4 points on the lanes to estimate the planar homography
+    # Left lane far, right lane far, left lane close, right lane close
+    pts = sample_lane_pairs(line1, line2, (y1, y2)).reshape(4, 2)
+    # These world points have the origin at the middle of the lane,
+    # directly below the camera.
+    # Depths 5.0, 3.0 are chosen arbitrarily, as we don't have depth
+    # information. Thus, the computed H will only be accurate in the
+    # X axis.
+    pts_worldm = np.array([[-LANE_W/2.0, 5.0],           # Left lane, far
+                           [LANE_W/2.0, 5.0],            # Right lane, far
+                           [-LANE_W/2.0, 3.0],           # Left lane, close
+                           [LANE_W/2.0, 3.0]])           # Right lane, close
+    # These world points are scaled+translated to generate a 
+    # reasonably-sized image w/ perspective effects removed.
+    # Note: the origin here is not the same origin as in pts_worldm!
+    pts_world = np.array([[0.0, 0.0],
+                          [LANE_W*1e2, 0.0],
+                          [0.0, 500],
+                          [LANE_W*1e2, 500.0]])
+    pts_world[:,0] += LANE_W*1e2 # Let's see more of the horizontal image
+    pts_world[:,1] += 200 # Let's see more down the road
+    # H_metric := Homography mapping the image (pixel coords) to the 
+    #             world plane defined by pts_worldm
+    H_metric = cv2.getPerspectiveTransform(pts.astype('float32'), pts_worldm.astype('float32'))
+    H = cv2.getPerspectiveTransform(pts.astype('float32'), pts_world.astype('float32'))
+
+    ## Estimate where the camera is w.r.t. the world ref. frame
+    if K is not None:
+        xdist = lateral_offset.estimate_lateral_offset(line1, line2, K, LANE_W)
+    else:
+        R, T = estimate_extrinsic_parameters(H_metric)
+        xdist = T[0] - (LANE_W / 2.0)
+    xvel, tlc = None, None
+    if offset_tracker is not None:
+        _, xvel, tlc = offset_tracker.update(xdist, dt)
+    res.update(pts=pts, H=H, H_metric=H_metric, xdist=xdist, xvel=xvel, tlc=tlc,
+               warning=get_lane_warning(xdist, xvel=xvel, tlc=tlc) if xdist is not None else None)
+    return res
+
+def get_lane_warning(xdist, left_thresh=LEFT_THRESH, right_thresh=RIGHT_THRESH,
+                     xvel=None, tlc=None, tlc_thresh=TLC_THRESH):
+    """ Outputs 'LEFT' or 'RIGHT' if the camera is too close to that side
+    of the lane (or will cross it within tlc_thresh seconds), or None
+    otherwise.
+    Input:
+        float xdist
+            Distance (m) of the camera from the center of the lane.
+        float xvel, tlc
+            Lateral velocity (m/s) and time to line crossing (s), if known.
+    """
+    if xdist >= right_thresh:
+        return 'RIGHT'
+    elif xdist <= left_thresh:
+        return 'LEFT'
+    if tlc is not None and tlc <= tlc_thresh:
+        return 'RIGHT' if xvel > 0 else 'LEFT'
+    return None
+
 def estimate_extrinsic_parameters(H):
     """ Outputs the (R,T) relative to the world reference frame. """
+    Rs, Ts = estimate_extrinsic_parameters_batch(H[np.newaxis])
+    return Rs[0], Ts[0]
+
+def estimate_extrinsic_parameters_batch(Hs):
+    """ Same as estimate_extrinsic_parameters, for a stack of F
+    homographies (e.g. of a whole drive) at once.
+    Input:
+        nparray Hs: F x 3 x 3
+    Output:
+        (nparray Rs, nparray Ts)
+    Where Rs is F x 3 x 3, and Ts is F x 3.
+    """
     #### Normalize H := H / sigma_2(H_)
-    U, S, V = np.linalg.svd(H)
-    H = H / S[1]
+    S = np.linalg.svd(Hs, compute_uv=False)
+    Hs = Hs / S[:, 1, np.newaxis, np.newaxis]
 
-    decomps = util_camera.decompose_H(H)
-    R = decomps[0][0]
-    T = decomps[0][1]
-    return R, T / T[2]
+    Rs, Tss, Ns = util_camera.decompose_H_batch(Hs)
+    Ts = Tss[:, 0]
+    return Rs[:, 0], Ts / Ts[:, 2:3]
 
 def show_lanes(Irgb, line1, line2):
     Irgb = util_camera.draw_line(Irgb, line1)
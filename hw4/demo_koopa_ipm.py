@@ -1,9 +1,8 @@
 import sys, os, pdb, argparse
 import cv2, cv, numpy as np, scipy.misc
 
-import calibrate_camera, util, util_camera, transform_image
+import calib_cache, util, util_camera, transform_image
 from util import intrnd, tupint
-from util_camera import pt2homo, homo2pt
 
 """
 USAGE:
@@ -104,12 +103,12 @@ def test_koopa_singleimage(SHOW_EPIPOLAR=False):
                       [   0.,           28.53758493,  333.32239125],
                       [   0.,            0.,            1.        ]])
     else:
-        K = calibrate_camera.calibrate_camera(calib_imgpaths, 9, 6, 0.023)
+        K, distCoeffs, reproj_err = calib_cache.get_camera_calibration(calib_imgpaths, 9, 6, 0.023)
     print "Finished calibrating camera, K is:"
     print K
     Kinv = np.linalg.inv(K)
 
-    pts1_norm = normalize_coords(pts1, K)
+    pts1_norm = util_camera.normalize_coords(pts1, K)
     HL = estimate_planar_homography(pts1_norm, worldpts)
 
     print "Estimated homography, H is:"
@@ -121,53 +120,30 @@ def test_koopa_singleimage(SHOW_EPIPOLAR=False):
     #### Normalize H := H / sigma_2(H_)
     U, S, V = np.linalg.svd(HL)
     H = HL / S[1]
-    #### Enforce positive depth constraint
-    flag_flipped = False
-    for i, pt1 in enumerate(pts1_norm):
-        pt2 = worldpts[i]
-        val = np.dot(np.hstack((pt2, [1.0])), np.dot(H, np.hstack((pt1, [1.0]))))
-        if val < 0:
-            if flag_flipped:
-                print "WOAH, flipping twice?!"
-                pdb.set_trace()
-            print "FLIP IT! val_{0} was: {1}".format(i, val)
-            H = H * -1
-            flag_flipped = True
+    #### Enforce positive depth constraint: x2^T * H * x1 > 0
+    pts1_h = util_camera.pts2homo(pts1_norm)
+    pts2_h = util_camera.pts2homo(worldpts)
+    vals = np.sum(pts2_h * np.dot(pts1_h, H.T), axis=1)
+    if np.all(vals < 0):
+        print "FLIP IT! vals were: {0}".format(vals)
+        H = H * -1
+        vals = -vals
     # (Sanity check positive depth constraint)
-    for i, pt1 in enumerate(pts1_norm):
-        pt2 = worldpts[i]
-        val = np.dot(np.hstack((pt2, [1.0])), np.dot(H, np.hstack((pt1, [1.0]))))
-        if val < 0:
-            print "WOAH, positive depth constraint violated!?"
-            pdb.set_trace()
+    if np.any(vals < 0):
+        print "WOAH, positive depth constraint violated!? vals: {0}".format(vals)
+        pdb.set_trace()
     #### Check projection error from I1 -> I2.
-    errs = []
-    for i, pt1 in enumerate(pts1_norm):
-        pt1_h = np.hstack((pt1, np.array([1.0])))
-        pt2_h = np.hstack((worldpts[i], np.array([1.0])))
-        pt2_pred = np.dot(H, pt1_h)
-        pt2_pred = pt2_pred / pt2_pred[2]
-        errs.append(np.linalg.norm(pt2_h - pt2_pred))
+    errs = np.linalg.norm(util_camera.transform_pts(H, pts1_norm) - worldpts, axis=1)
     print "Projection error: {0} (Mean: {1} std: {2})".format(sum(errs), np.mean(errs), np.std(errs))
 
     #### Check if planar epipolar constraint is satisfied:
     ####     x2_hat * H * x1 = 0.0
-    errs = []
-    for i, pt1 in enumerate(pts1_norm):
-        pt1_h = np.hstack((pt1, [1.0]))
-        pt2_hat = util_camera.make_crossprod_mat(worldpts[i])
-        errs.append(np.linalg.norm(np.dot(pt2_hat, np.dot(H, pt1_h))))
+    errs = np.linalg.norm(np.cross(pts2_h, np.dot(pts1_h, H.T)), axis=1)
     print "Epipolar constraint error: {0} (Mean: {1} std: {2})".format(sum(errs), np.mean(errs), np.std(errs))
 
     #### Sanity-check that world points project to pixel points
     Hinv = np.linalg.inv(H)
-    errs = []
-    for i, worldpt in enumerate(worldpts):
-        pt_img = np.hstack((pts1[i], [1.0]))
-        p = np.dot(Hinv, np.hstack((worldpt, [1.0])))
-        p /= p[2]
-        p = np.dot(K, p)
-        errs.append(np.linalg.norm(pt_img - p))
+    errs = np.linalg.norm(util_camera.transform_pts(np.dot(K, Hinv), worldpts) - pts1, axis=1)
     print "world2img errors (in pixels): {0} (mean={1} std={2})".format(sum(errs), np.mean(errs), np.std(errs))
         
     #### Perform Inverse Perspective Mapping (undo perspective effects)
@@ -190,11 +166,8 @@ def test_koopa_singleimage(SHOW_EPIPOLAR=False):
                         [303.0, 321.0],    # Lowerleft of bluebox (x,y)
                         [695.0, 324.0]],   # Lowerright of greenbox (x,y)
                        )
-    pts_world = np.zeros([0, 2])
     # Populate pts_world via H (maps image plane -> world plane)
-    for pt_pix in pts_pix:
-        pt_world = homo2pt(np.dot(H, np.dot(Kinv, pt2homo(pt_pix))))
-        pts_world = np.vstack((pts_world, pt_world))
+    pts_world = util_camera.transform_pts(np.dot(H, Kinv), pts_pix)
     pts_world *= 1000.0 # Let's get a reasonable-sized image please!
     
     # These are hardcoded world coords, but, we can auto-gen them via
@@ -212,10 +185,10 @@ def test_koopa_singleimage(SHOW_EPIPOLAR=False):
     I = (2.0*I) + 40    # Up that contrast! Orig. images are super dark.
     h, w = I.shape[0:2]
     # Determine bounding box of IPM-corrected image
-    a = homo2pt(np.dot(IPM1, pt2homo([0.0, 0.0])))  # upper-left corner
-    b = homo2pt(np.dot(IPM1, pt2homo([w-1, 0.0])))  # upper-right corner
-    c = homo2pt(np.dot(IPM1, pt2homo([0.0, h-1])))  # lower-left corner
-    d = homo2pt(np.dot(IPM1, pt2homo([w-1, h-1])))  # lower-right corner
+    a, b, c, d = util_camera.transform_pts(IPM1, [[0.0, 0.0],    # upper-left corner
+                                                  [w-1, 0.0],    # upper-right corner
+                                                  [0.0, h-1],    # lower-left corner
+                                                  [w-1, h-1]])   # lower-right corner
     w_out = intrnd(max(b[0] - a[0], d[0] - c[0]))
     h_out = intrnd(max(c[1] - a[1], d[1] - b[1]))
     print "New image dimensions: ({0} x {1}) (Orig: {2} x {3})".format(w_out, h_out, w, h)
@@ -225,8 +198,7 @@ def test_koopa_singleimage(SHOW_EPIPOLAR=False):
     for pt in pts_pix:
         cv2.circle(I, tupint(pt), 5, (0, 255, 0))
     # Draw rectified-rectangle in Iwarp
-    a = homo2pt(np.dot(IPM1, pt2homo(pts_pix[0])))
-    b = homo2pt(np.dot(IPM1, pt2homo(pts_pix[3])))
+    a, b = util_camera.transform_pts(IPM1, pts_pix[[0, 3]])
     cv2.rectangle(Iwarp, tupint(a), tupint(b), (0, 255, 0))
     #Iwarp = transform_image.transform_image_forward(I, IPM)
     print "(Displaying before/after images, press <any key> to exit.)"
@@ -270,7 +242,7 @@ def compute_IPM(pts_pix, pts_world):
     IPM0 = cv2.getPerspectiveTransform(pts_pix, pts_world)
     # Determine where (0,0) lands in IPM0's image, and do an offset
     # to ensure that the entire image is displayed with IPM1
-    origin_new = homo2pt(np.dot(IPM0, pt2homo([0.0, 0.0])))
+    origin_new = util_camera.transform_pts(IPM0, np.zeros((1, 2)))[0]
     if origin_new[0] < 0:
         pts_world[:, 0] += abs(origin_new[0])
     if origin_new[1] < 0:
@@ -278,23 +250,6 @@ def compute_IPM(pts_pix, pts_world):
     IPM1 = cv2.getPerspectiveTransform(pts_pix, pts_world)
     return IPM0, IPM1
 
-def normalize_coords(pts, K):
-    """ Normalize pixel coordinates into image coordinates with
-    intrinsic matrix K.
-    Input:
-        nparray pts: N x 2
-    Output:
-        nparray pts_norm: N x 2
-    """
-    out = np.zeros(pts.shape, dtype=pts.dtype)
-    Kinv = np.linalg.inv(K)
-    for i, pt in enumerate(pts):
-        pt_h = np.hstack((pt, 1.0))
-        pt_norm_h = np.dot(Kinv, pt_h)
-        pt_norm = pt_norm_h[0:2]
-        out[i, :] = pt_norm
-    return out
-
 def parse_args():
     DESCRIPTION = """This is a demo about homographies relating a view(s)
 to planar scenes."""
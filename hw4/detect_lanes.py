@@ -1,14 +1,56 @@
 import sys, os, time, pdb, argparse
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np, cv2
 
-import util, util_camera
+import util, util_camera, frame_source
 
-from estimate_line import estimate_line
+from estimate_line import estimate_line, get_rng
+from hough_line import estimate_line_hough
+from estimate_curve import estimate_line_curve
 from util import intrnd
 
+# Line estimation backends: name -> (function, default params).
+# A backend is called as function(edgemap, rng=rng, **params), and must
+# output (line, inliers) like estimate_line.estimate_line, or None if the
+# edgemap has no edges. rng is a random number generator or seed (see
+# estimate_line.get_rng).
+LINE_ESTIMATORS = {
+    'ransac': (estimate_line, dict(MAX_ITERS=300, ALPHA=4, T=1.0)),
+    'hough': (estimate_line_hough, dict(ALPHA=4, T=1.0)),
+    # Curved lanes (parabolas), output as their tangent at the window center
+    'curve': (estimate_line_curve, dict(MAX_ITERS=300, ALPHA=4, T=1.0)),
+}
+
+# Search window sets for detect_lanes_multi: name -> ((lane name, win), ...)
+WINDOW_SETS = {
+    'ego': (('left', (0.4, 0.60, 0.2, 0.25)),
+            ('right', (0.62, 0.60, 0.2, 0.25))),
+    'adjacent': (('left2', (0.18, 0.60, 0.2, 0.25)),
+                 ('left', (0.4, 0.60, 0.2, 0.25)),
+                 ('right', (0.62, 0.60, 0.2, 0.25)),
+                 ('right2', (0.84, 0.60, 0.2, 0.25))),
+}
+
+# Output of detect_lanes_multi, per search window
+LaneResult = namedtuple('LaneResult', ['name', 'win', 'bounds', 'line', 'nb_edges', 'dur'])
+
+WINDOW_COLOURS = ((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
+                  (255, 0, 255), (0, 255, 255))
+
+_THREAD_POOLS = {}  # nb_threads -> ThreadPool
+
+MAX_PYR_LEVEL = 4   # Coarsest pyramid level for edge detection
+MIN_PYR_SIZE = 16   # Min. window width/height (pixels) at any level
+REFIT_BAND = 2.0    # Full-res refit band half-width (in coarse pixels)
+REFIT_ITERS = 50    # RANSAC iterations of the full-res refit
+
 def detect_lanes(I, win1=(0.4, 0.55, 0.2, 0.1), win2=(0.6, 0.55, 0.2, 0.1),
                  threshold1=50, threshold2=100, apertureSize=3,
-                 show_edges=False):
+                 show_edges=False, sampler='uniform', vanishing_pt=(0.5, 0.4),
+                 estimator='ransac', estimator_params=None,
+                 pyr_level=0, max_edges=None, seed=None):
     """ Given a street image I, detect the (parallel) road lanes
     in image coordinates.
     Input:
@@ -22,87 +64,461 @@ def detect_lanes(I, win1=(0.4, 0.55, 0.2, 0.1), win2=(0.6, 0.55, 0.2, 0.1),
             Canny. threshold2 is high-threshold.
         int apertureSize
             One of (1,3,5,7). Size of the Sobel filter.
+        str sampler
+            RANSAC sampling strategy, 'uniform' or 'prosac' (see
+            estimate_line).
+        tuple vanishing_pt: (float x, float y)
+            Rough location of the lanes' vanishing point, in percentages
+            of image size. Used by sampler='prosac' to guess the lane
+            direction within each window.
+        str estimator
+            Name of the line estimation backend to run on each window's
+            edgemap (a key of LINE_ESTIMATORS).
+        dict estimator_params
+            Overrides the default parameters of the estimator.
+        int pyr_level
+            Run edge detection+line estimation on each window downsampled
+            pyr_level times (by 2, see cv2.pyrDown), and refit the lines
+            at full resolution. Use on large (e.g. HD) frames, where the
+            number of edge pixels grows with the image area.
+        int max_edges
+            If given, the window is further downsampled (from pyr_level)
+            until it has at most max_edges edge pixels.
+        int seed
+            If given, the lines are reproducible: each window's estimator
+            draws from its own RandomState, seeded by (seed, window
+            index). Can also be a sequence of ints, e.g. (seed, frame).
     Output:
         (line1, line2)
     Where line1 = (a1, b1,c1) such that:
         a1x + b1y + c1 = 0
     Similarly, line2 = (a2, b2, c2).
     """
+    results = detect_lanes_multi(I, (('edgeleft', win1), ('edgeright', win2)),
+                                 threshold1=threshold1, threshold2=threshold2,
+                                 apertureSize=apertureSize, sampler=sampler,
+                                 vanishing_pt=vanishing_pt, estimator=estimator,
+                                 estimator_params=estimator_params,
+                                 pyr_level=pyr_level, max_edges=max_edges,
+                                 nb_threads=1, show_edges=show_edges, seed=seed)
+    return tuple(res.line for res in results)
+
+def detect_lanes_multi(I, wins, threshold1=50, threshold2=100, apertureSize=3,
+                       sampler='uniform', vanishing_pt=(0.5, 0.4),
+                       estimator='ransac', estimator_params=None,
+                       pyr_level=0, max_edges=None, nb_threads=None,
+                       show_edges=False, seed=None):
+    """ Same as detect_lanes, for any number of search windows (e.g.
+    the adjacent lanes' too, see WINDOW_SETS). Edges are detected once
+    over all windows (see EdgeMap), and the windows' lines are estimated
+    concurrently on a thread pool (the OpenCV/NumPy calls release the
+    GIL).
+    Input:
+        nparray I
+        list wins: [(str name, tuple win), ...]
+            The search windows (see detect_lanes), or the name of a
+            window set of WINDOW_SETS.
+        int nb_threads
+            Size of the thread pool (default: one thread per window, up
+            to the number of cores). If 1, the windows are processed on
+            the calling thread.
+        int seed
+            (See detect_lanes.) With a seed, the output doesn't depend on
+            how the windows are scheduled on the threads.
+        (See detect_lanes for the rest)
+    Output:
+        list results: [LaneResult res, ...]
+    One LaneResult per window, in the same order as wins, with:
+        name, win, bounds: The window (see get_window_bounds)
+        line: The detected line (image coords), or None.
+        nb_edges: Number of edge pixels in the window.
+        dur: Time (s) spent on the window's line estimation.
+    """
+    if isinstance(wins, basestring):
+        wins = WINDOW_SETS[wins]
     h, w = np.shape(I)[0:2]
-    
-    #edgemap = cv2.Canny(I, threshold1, threshold2, apertureSize=apertureSize)
-
-    # Compute left window dimensions
-    x_left = intrnd(win1[0]*w)
-    y_left = intrnd(win1[1]*h)
-    w_left = intrnd(win1[2]*w)
-    h_left = intrnd(win1[3]*h)
-    if w_left % 2 == 0:
-        w_left += 1
-    if h_left % 2 == 0:
-        h_left += 1
-    # Compute right window dimensions
-    x_right = intrnd(win2[0]*w)
-    y_right = intrnd(win2[1]*h)
-    w_right = intrnd(win2[2]*w)
-    h_right = intrnd(win2[3]*h)
-    if w_right % 2 == 0:
-        w_right += 1
-    if h_right % 2 == 0:
-        h_right += 1
-    
-    Iwin_left = I[(y_left-(h_left/2)):(y_left+(h_left/2)),
-                  (x_left-(w_left/2)):(x_left+(w_left/2))]
-    Iwin_rght = I[(y_right-(h_right/2)):(y_right+(h_right/2)),
-                  (x_right-(w_right/2)):(x_right+(w_right/2))]
-    edges_left = cv2.Canny(Iwin_left, threshold1, threshold2, apertureSize=apertureSize)
-    edges_right = cv2.Canny(Iwin_rght, threshold1, threshold2, apertureSize=apertureSize)
-    if show_edges:
-        cv2.namedWindow('edgeleft')
-        cv2.imshow('edgeleft', edges_left)
-        cv2.namedWindow('edgeright')
-        cv2.imshow('edgeright', edges_right)
-
-    '''
-    edges_left = edgemap[(y_left-(h_left/2)):(y_left+(h_left/2)),
-                         (x_left-(w_left/2)):(x_left+(w_left/2))]
-    edges_right = edgemap[(y_right-(h_right/2)):(y_right+(h_right/2)),
-                          (x_right-(w_right/2)):(x_right+(w_right/2))]
-    '''
-    # Find dominant line in each window
-    res1 = estimate_line(edges_left, MAX_ITERS=300, ALPHA=4, T=1.0)
-    res2 = estimate_line(edges_right, MAX_ITERS=300, ALPHA=4, T=1.0)
-    if res1 == None:
-        line1, inliers1 = None, None
-    else:
-        line1, inliers1 = res1
-    if res2 == None:
-        line2, inliers2 = None, None
-    else:
-        line2, inliers2 = res2
+    bounds_all = [get_window_bounds(win, w, h) for name, win in wins]
+    edgemap = None
+    if pyr_level == 0 and max_edges is None:
+        # One edge detection pass over all windows
+        edgemap = EdgeMap(I, get_union_bounds(bounds_all), threshold1, threshold2,
+                          apertureSize=apertureSize, gradients=(sampler == 'prosac'))
 
-    if line1 != None and line1[1] != 0:
-        line1_norm = np.array([line1[0] / line1[1], 1, line1[2] / line1[1]])
+    def detect_one(i):
+        name, win = wins[i]
+        rng = None if seed is None else np.random.RandomState(np.append(seed, i))
+        t = time.time()
+        line, edges = detect_window_line(I, bounds_all[i],
+                                         threshold1, threshold2, apertureSize,
+                                         estimator=estimator,
+                                         estimator_params=estimator_params,
+                                         sampler=sampler,
+                                         lane_angle=guess_lane_angle(win, vanishing_pt, w, h),
+                                         pyr_level=pyr_level, max_edges=max_edges,
+                                         edgemap=edgemap, rng=rng)
+        res = LaneResult(name, win, bounds_all[i], line, np.count_nonzero(edges),
+                         time.time() - t)
+        return res, edges
+
+    if nb_threads is None:
+        nb_threads = min(len(wins), cpu_count())
+    if nb_threads <= 1 or len(wins) <= 1:
+        outs = [detect_one(i) for i in xrange(len(wins))]
     else:
-        line1_norm = line1
-    if line2 != None and line2[1] != 0:
-        line2_norm = np.array([line2[0] / line2[1], 1, line2[2] / line2[1]])
+        outs = get_thread_pool(nb_threads).map(detect_one, xrange(len(wins)))
+    if show_edges:
+        for res, edges in outs:
+            cv2.namedWindow(res.name)
+            cv2.imshow(res.name, edges)
+    return [res for res, edges in outs]
+
+def get_thread_pool(nb_threads):
+    """ Outputs a ThreadPool of nb_threads threads, created on first use
+    only (and then kept alive for the next frames).
+    """
+    pool = _THREAD_POOLS.get(nb_threads)
+    if pool is None:
+        pool = ThreadPool(nb_threads)
+        _THREAD_POOLS[nb_threads] = pool
+    return pool
+
+def detect_window_line(I, bounds, threshold1, threshold2, apertureSize=3,
+                       estimator='ransac', estimator_params=None,
+                       sampler='uniform', lane_angle=None, mask=None,
+                       pyr_level=0, max_edges=None, edgemap=None, rng=None):
+    """ Finds the dominant line within a window of I.
+    Input:
+        nparray I
+        tuple bounds: (int x0, int y0, int x1, int y1)
+            The window is I[y0:y1, x0:x1] (see get_window_bounds).
+        float threshold1, threshold2
+        int apertureSize
+        str estimator
+        dict estimator_params
+        str sampler
+        float lane_angle
+            Expected lane direction, for sampler='prosac'.
+        nparray mask
+            If given, a boolean array the size of the window. Edges
+            outside of the mask are ignored.
+        int pyr_level, max_edges
+            (See detect_lanes)
+        EdgeMap edgemap
+            If given (and it covers bounds), then its edges/gradients are
+            used, rather than running Canny on the window. Ignored if
+            pyr_level > 0 or max_edges is given.
+        rng
+            Random number generator or seed, for the line estimator (see
+            estimate_line.get_rng).
+    Output:
+        (nparray line, nparray edges)
+    Where line is in image coordinates (None if no line was found), and
+    edges is the edgemap of the window (at the pyramid level the line
+    was estimated at).
+    """
+    x0, y0, x1, y1 = bounds
+    Iwin = I[y0:y1, x0:x1]
+    grad = None
+    if (edgemap is not None and pyr_level == 0 and max_edges is None
+            and edgemap.covers(bounds)):
+        level, Ilvl, edges_full = 0, Iwin, None
+        edges, grad = edgemap.window(bounds)
+        if mask is not None:
+            edges = np.where(mask, edges, 0).astype(edges.dtype) # Don't touch the shared map
     else:
-        line2_norm = line2
+        level, Ilvl, edges, edges_full = detect_edges_pyramid(Iwin, threshold1, threshold2,
+                                                              apertureSize, pyr_level=pyr_level,
+                                                              max_edges=max_edges, mask=mask)
+    line_estimator, params = get_line_estimator(estimator, estimator_params)
+    if estimator == 'ransac' and sampler == 'prosac':
+        if grad is None:
+            grad = compute_gradients(Ilvl, apertureSize=apertureSize)
+        params.update(SAMPLER=sampler,
+                      grad=grad,
+                      LANE_ANGLE=lane_angle)
+    rng = get_rng(rng)
+    res = line_estimator(edges, rng=rng, **params)
+    line = res[0] if res is not None else None
+    if line is not None and level > 0:
+        line = pyramid_to_full_line(line, level)
+        if edges_full is None:
+            # Only the band around the line is refit, so only run the
+            # full-res Canny there (padded s.t. the gradients and the
+            # non-maximum suppression within the band are unaffected by
+            # the crop)
+            bx0, by0, bx1, by1 = get_band_bounds(line, REFIT_BAND * 2**level, Iwin.shape,
+                                                 margin=apertureSize // 2 + 1)
+            edges_full = np.zeros(Iwin.shape[:2], dtype='uint8')
+            if bx1 > bx0 and by1 > by0:
+                edges_band = cv2.Canny(np.ascontiguousarray(Iwin[by0:by1, bx0:bx1]),
+                                       threshold1, threshold2, apertureSize=apertureSize)
+                if mask is not None:
+                    edges_band[~mask[by0:by1, bx0:bx1]] = 0
+                edges_full[by0:by1, bx0:bx1] = edges_band
+        # (Uniform sampling: the band is mostly inliers, and the PROSAC
+        # gradients are at the pyramid level)
+        line_estimator, params_refit = get_line_estimator(estimator, estimator_params)
+        if 'MAX_ITERS' in params_refit:
+            params_refit['MAX_ITERS'] = min(params_refit['MAX_ITERS'], REFIT_ITERS)
+        line = refit_line_band(edges_full, line, REFIT_BAND * 2**level,
+                               line_estimator, params_refit, rng=rng)
     # Fix line to be in image coordinate system (not window coord sys)
-    if line1_norm != None:
-        a1, b1, c1 = line1_norm
-        c1_out = -a1*(x_left-(w_left/2)) - b1*((y_left)-(h_left/2)) + c1
-        line1_out = np.array([a1, b1, c1_out])
-    else:
-        line1_out = None
-    if line2_norm != None:
-        a2, b2, c2 = line2_norm
-        c2_out = -a2*(x_right-(w_right/2)) - b2*((y_right)-(h_right/2)) + c2
-        line2_out = np.array([a2, b2, c2_out])
+    return window_to_image_line(line, x0, y0), edges
+
+class EdgeMap(object):
+    """ The Canny edges (and optionally, the gradients) of a region of
+    interest of a frame, computed once and shared by all of the search
+    windows within it: each window gets views into the shared arrays
+    (no copies), so adding windows adds no edge detection cost.
+    """
+    def __init__(self, I, roi, threshold1, threshold2, apertureSize=3, gradients=False):
+        """
+        Input:
+            nparray I
+            tuple roi: (int x0, int y0, int x1, int y1)
+                The region I[y0:y1, x0:x1], e.g. the union of the search
+                windows (see get_union_bounds).
+            float threshold1, threshold2
+            int apertureSize
+            bool gradients
+                Also compute the image gradients (for sampler='prosac').
+        """
+        self.roi = roi
+        x0, y0, x1, y1 = roi
+        Iroi = I[y0:y1, x0:x1]
+        self.edges = cv2.Canny(Iroi, threshold1, threshold2, apertureSize=apertureSize)
+        self.grad = compute_gradients(Iroi, apertureSize=apertureSize) if gradients else None
+
+    def covers(self, bounds):
+        x0, y0, x1, y1 = bounds
+        rx0, ry0, rx1, ry1 = self.roi
+        return rx0 <= x0 and ry0 <= y0 and x1 <= rx1 and y1 <= ry1
+
+    def window(self, bounds):
+        """ Outputs the edges/gradients of a window within the ROI.
+        Input:
+            tuple bounds: (int x0, int y0, int x1, int y1)
+        Output:
+            (nparray edges, tuple grad)
+        Where edges is a view of the window's edges, and grad the views
+        (gx, gy) of its gradients (None if not computed). The views must
+        not be modified.
+        """
+        x0, y0, x1, y1 = bounds
+        rx0, ry0 = self.roi[0:2]
+        sl = (slice(y0 - ry0, y1 - ry0), slice(x0 - rx0, x1 - rx0))
+        if self.grad is None:
+            return self.edges[sl], None
+        return self.edges[sl], (self.grad[0][sl], self.grad[1][sl])
+
+def get_union_bounds(bounds_all):
+    """ Outputs the bounding box of several windows' bounds (see
+    get_window_bounds).
+    Input:
+        list bounds_all: [(int x0, int y0, int x1, int y1), ...]
+    Output:
+        (int x0, int y0, int x1, int y1)
+    """
+    x0s, y0s, x1s, y1s = zip(*bounds_all)
+    return (min(x0s), min(y0s), max(x1s), max(y1s))
+
+def detect_edges_pyramid(Iwin, threshold1, threshold2, apertureSize=3,
+                         pyr_level=0, max_edges=None, mask=None):
+    """ Runs Canny on Iwin downsampled pyr_level times, or more (up to
+    MAX_PYR_LEVEL, while the window is at least MIN_PYR_SIZE pixels
+    wide/high) until there are at most max_edges edge pixels.
+    Input:
+        nparray Iwin
+        float threshold1, threshold2
+        int apertureSize
+        int pyr_level
+        int max_edges
+        nparray mask
+            Boolean array the size of Iwin (subsampled along with it).
+    Output:
+        (int level, nparray Ilvl, nparray edges, nparray edges_full)
+    Where Ilvl, edges are the window and its edgemap at the pyramid
+    level used, and edges_full is the full resolution edgemap if it was
+    computed along the way (or None).
+    """
+    level, Ilvl = 0, Iwin
+    for _ in xrange(pyr_level):
+        if level >= MAX_PYR_LEVEL or min(Ilvl.shape[0:2]) < 2*MIN_PYR_SIZE:
+            break
+        Ilvl = cv2.pyrDown(Ilvl)
+        level += 1
+    edges_full = None
+    while True:
+        edges = cv2.Canny(Ilvl, threshold1, threshold2, apertureSize=apertureSize)
+        if mask is not None:
+            # pyrDown outputs ceil(n/2) pixels, like mask[::2]
+            edges[~mask[::2**level, ::2**level]] = 0
+        if level == 0:
+            edges_full = edges
+        if (max_edges is None or level >= MAX_PYR_LEVEL
+                or min(Ilvl.shape[0:2]) < 2*MIN_PYR_SIZE
+                or np.count_nonzero(edges) <= max_edges):
+            return level, Ilvl, edges, edges_full
+        Ilvl = cv2.pyrDown(Ilvl)
+        level += 1
+
+def pyramid_to_full_line(line, level):
+    """ Converts a line found at a pyramid level to full resolution
+    coords. (cv2.pyrDown keeps every other pixel: pixel x at level L is
+    at x*s at full resolution, with s = 2^L, as in the mask subsampling
+    of detect_edges_pyramid.)
+    Input:
+        nparray line: (a, b, c)
+        int level
+    Output:
+        nparray line_out: (a, b, c)
+    """
+    s = float(2**level)
+    a, b, c = line
+    return np.array([a, b, s*c])
+
+def refit_line_band(edges, line, band, line_estimator, params, rng=None):
+    """ Re-estimates line from only the edge pixels of edges within band
+    pixels of it. Since the band holds few edges, and mostly inliers,
+    this is much cheaper than searching the whole edgemap. The line is
+    output as-is if no line is found within the band.
+    Input:
+        nparray edges
+        nparray line: (a, b, c)
+        float band
+        function line_estimator
+        dict params
+            The line estimation backend (see get_line_estimator).
+        rng
+    Output:
+        nparray line_out: (a, b, c)
+    """
+    ys, xs = np.nonzero(edges)
+    dists = np.abs(line[0]*xs + line[1]*ys + line[2]) / np.hypot(line[0], line[1])
+    outside = dists > band
+    edges_band = edges.copy()
+    edges_band[ys[outside], xs[outside]] = 0
+    res = line_estimator(edges_band, rng=rng, **params)
+    if res is None or res[0] is None:
+        return line
+    return res[0]
+
+def get_band_bounds(line, band, shape, margin=0):
+    """ Computes the bounding box of the pixels of an image that are within
+    band pixels of line, padded by margin pixels.
+    Input:
+        nparray line: (a, b, c)
+        float band
+        tuple shape: (int h, int w, ...)
+        int margin
+    Output:
+        (int x0, int y0, int x1, int y1)
+            The region is I[y0:y1, x0:x1]. Empty if the band is outside
+            of the image.
+    """
+    h, w = shape[:2]
+    a, b, c = line
+    norm = np.hypot(a, b)
+    if abs(a) >= abs(b):
+        # Mostly vertical: bound the band's columns at the top/bottom rows
+        xs = -(b*np.array([0, h-1]) + c) / a
+        halfwidth = band * norm / abs(a)
+        x0 = int(np.floor(xs.min() - halfwidth)) - margin
+        x1 = int(np.ceil(xs.max() + halfwidth)) + 1 + margin
+        y0, y1 = 0, h
     else:
-        line2_out = None
-    return line1_out, line2_out
+        ys = -(a*np.array([0, w-1]) + c) / b
+        halfwidth = band * norm / abs(b)
+        y0 = int(np.floor(ys.min() - halfwidth)) - margin
+        y1 = int(np.ceil(ys.max() + halfwidth)) + 1 + margin
+        x0, x1 = 0, w
+    x0, x1 = min(max(x0, 0), w), min(max(x1, 0), w)
+    y0, y1 = min(max(y0, 0), h), min(max(y1, 0), h)
+    return x0, y0, max(x0, x1), max(y0, y1)
+
+def get_line_estimator(name, params=None):
+    """ Looks up a line estimation backend in LINE_ESTIMATORS.
+    Input:
+        str name
+        dict params
+            If given, overrides the backend's default parameters.
+    Output:
+        (function estimator, dict params)
+    """
+    if name not in LINE_ESTIMATORS:
+        raise Exception("Unknown line estimator: {0} (Must be one of: {1})".format(
+            name, sorted(LINE_ESTIMATORS.keys())))
+    estimator, params_default = LINE_ESTIMATORS[name]
+    params_out = dict(params_default)
+    if params:
+        params_out.update(params)
+    return estimator, params_out
+
+def window_to_image_line(line, x0, y0):
+    """ Converts a line found within a window, whose upper-left corner is
+    at (x0, y0), to image coordinates. The line is normalized s.t. b=1
+    (unless b=0).
+    Input:
+        nparray line: (a, b, c)
+        int x0, y0
+    Output:
+        nparray line_out: (a, b, c)
+    """
+    if line is None:
+        return None
+    if line[1] != 0:
+        line = np.array([line[0] / line[1], 1, line[2] / line[1]])
+    a, b, c = line
+    return np.array([a, b, -a*x0 - b*y0 + c])
+
+def get_window_bounds(win, w, h):
+    """ Computes the pixel extent of a search window.
+    Input:
+        tuple win: (float x, float y, float width, float height)
+            Window center+size, in percentages of image size.
+        int w, h
+            Image dimensions.
+    Output:
+        (int x0, int y0, int x1, int y1)
+    The window is I[y0:y1, x0:x1].
+    """
+    x = intrnd(win[0]*w)
+    y = intrnd(win[1]*h)
+    w_win = intrnd(win[2]*w)
+    h_win = intrnd(win[3]*h)
+    if w_win % 2 == 0:
+        w_win += 1
+    if h_win % 2 == 0:
+        h_win += 1
+    return (x-(w_win/2), y-(h_win/2), x+(w_win/2), y+(h_win/2))
+
+def guess_lane_angle(win, vanishing_pt, w, h):
+    """ Guesses the direction of a lane passing through a window, by
+    assuming that it runs from the window center to the vanishing point.
+    Input:
+        tuple win: (float x, float y, float width, float height)
+        tuple vanishing_pt: (float x, float y)
+            Both in percentages of image size.
+        int w, h
+            Image dimensions.
+    Output:
+        float angle
+            In radians (image coords).
+    """
+    return np.arctan2((vanishing_pt[1] - win[1])*h, (vanishing_pt[0] - win[0])*w)
+
+def compute_gradients(I, apertureSize=3):
+    """ Computes the x/y image gradients of I.
+    Input:
+        nparray I
+        int apertureSize
+            Size of the Sobel filter.
+    Output:
+        (nparray gx, nparray gy)
+    """
+    gx = cv2.Sobel(I, cv2.CV_32F, 1, 0, ksize=apertureSize)
+    gy = cv2.Sobel(I, cv2.CV_32F, 0, 1, ksize=apertureSize)
+    return gx, gy
 
 def draw_subwindow(Irgb, win, colour=(125, 125, 0)):
     """ Draws subwindow on Irgb.
@@ -128,7 +544,8 @@ def draw_subwindow(Irgb, win, colour=(125, 125, 0)):
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("imgsdir", help="Directory of street images (or a single imagepath).")
+    parser.add_argument("imgsdir", help="Directory of street images (or a single imagepath, \
+a video file, or - for raw frames on stdin).")
     parser.add_argument("--Tlow", type=int, help="LowThreshold (Canny).",
                         default=100)
     parser.add_argument("--ksize", type=int, help="Size of Sobel filter (Canny).",
@@ -140,7 +557,31 @@ value is in range [0.0,1.0]",
     parser.add_argument("--win2", nargs=4, type=float, metavar=("X", "Y", "W", "H"),
                         help="Right subwindow. (See --win1)",
                         default=(0.62, 0.60, 0.2, 0.25))
+    parser.add_argument("--estimator", choices=sorted(LINE_ESTIMATORS.keys()),
+                        default='ransac',
+                        help="Line estimation backend.")
+    parser.add_argument("--pyr_level", type=int, default=0,
+                        help="Detect edges on each window downsampled this \
+many times (for large frames), refitting the lanes at full resolution.")
+    parser.add_argument("--max_edges", type=int,
+                        help="Downsample each window further (see \
+--pyr_level) until it has at most this many edge pixels.")
+    parser.add_argument("--window_set", choices=sorted(WINDOW_SETS.keys()),
+                        help="Search the windows of this window set (e.g. \
+'adjacent' for the neighbouring lanes too) concurrently, instead of \
+--win1/--win2.")
+    parser.add_argument("--threads", type=int,
+                        help="Threads for --window_set (default: one per \
+window, up to the number of cores).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed the line estimators (reproducible lines).")
     parser.add_argument("--n", type=int, help="Number of images to process.")
+    parser.add_argument("--raw_size", nargs=2, type=int, metavar=("W", "H"),
+                        help="Frame size, if imgsdir is '-' (raw frames on \
+stdin).")
+    parser.add_argument("--raw_channels", type=int, choices=(1, 3), default=3,
+                        help="Channels of the raw frames on stdin (1: gray, \
+3: BGR).")
     return parser.parse_args()
 
 def main():
@@ -149,30 +590,47 @@ def main():
     threshold2 = 2 * args.Tlow    # Canny recommends a ratio of 1:2
     win1 = args.win1
     win2 = args.win2
-    imgsdir = args.imgsdir
-    if not os.path.isdir(imgsdir):
-        imgpaths = [imgsdir]
-    else:
-        imgpaths = util.get_imgpaths(imgsdir, n=args.n)
-    for i, imgpath in enumerate(imgpaths):
-        print("({0}/{1}): Image={2}".format(i+1, len(imgpaths), imgpath))
-        I = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-        line1, line2 = detect_lanes(I, threshold1=threshold1, threshold2=threshold2, apertureSize=args.ksize)
-        if line1 == None and line2 == None:
+    frames = frame_source.open_frame_source(args.imgsdir, n=args.n, raw_size=args.raw_size,
+                                            raw_channels=args.raw_channels)
+    nb_frames = frames.nb_frames if frames.nb_frames is not None else '?'
+    for i, (name, Irgb) in enumerate(frames):
+        print("({0}/{1}): Image={2}".format(i+1, nb_frames, name))
+        I = cv2.cvtColor(Irgb, cv2.COLOR_BGR2GRAY)
+        if args.window_set:
+            results = detect_lanes_multi(I, args.window_set, threshold1=threshold1,
+                                         threshold2=threshold2, apertureSize=args.ksize,
+                                         estimator=args.estimator, pyr_level=args.pyr_level,
+                                         max_edges=args.max_edges, nb_threads=args.threads,
+                                         seed=None if args.seed is None else (args.seed, i))
+            for j, res in enumerate(results):
+                colour = WINDOW_COLOURS[j % len(WINDOW_COLOURS)]
+                if res.line is None:
+                    print("    Error: Couldn't find lane {0}".format(res.name))
+                else:
+                    Irgb = util_camera.draw_line(Irgb, res.line, colour)
+                Irgb = draw_subwindow(Irgb, res.win, colour=colour)
+                print "    {0}: {1} ({2} edges, {3:.2f}ms)".format(res.name, res.line,
+                                                                  res.nb_edges, res.dur*1e3)
+            cv2.imwrite('{0}_lines.png'.format(name), Irgb)
+            continue
+        line1, line2 = detect_lanes(I, threshold1=threshold1, threshold2=threshold2, apertureSize=args.ksize,
+                                    estimator=args.estimator, pyr_level=args.pyr_level,
+                                    max_edges=args.max_edges,
+                                    seed=None if args.seed is None else (args.seed, i))
+        if line1 is None and line2 is None:
             print("    Error: Couldn't find lanes.")
             continue
-        if line1 == None:
+        if line1 is None:
             print("    Error: Couldn't find left lane")
-        if line2 == None:
+        if line2 is None:
             print("    Error: Couldn't find right lane.")
         #Irgb = plot_lines(I, line1, line2)
-        Irgb = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_COLOR)
         Irgb = util_camera.draw_line(Irgb, line1, (255, 0, 0))
         Irgb = util_camera.draw_line(Irgb, line2, (0, 255, 0))
         # Draw subwindows on image
         Irgb = draw_subwindow(Irgb, win1, colour=(255, 0, 0))
         Irgb = draw_subwindow(Irgb, win2, colour=(0, 255, 0))
-        cv2.imwrite('{0}_lines.png'.format(util.get_filename(imgpath)), Irgb)
+        cv2.imwrite('{0}_lines.png'.format(name), Irgb)
         print "    LeftLane: {0}    RightLane: {1}".format(line1, line2)
     print("Done.")
 
@@ -0,0 +1,210 @@
+"""
+A curved-lane alternative to estimate_line.estimate_line: robustly fits
+a parabola (second-order approximation of a clothoid) to an edgemap.
+
+Lanes are near-vertical in the image, so curves are parameterized as x
+as a function of y:
+    x = a*y^2 + b*y + c
+Hypotheses are the parabolas through 3 edge pixels (the minimal sample),
+scored in vectorized batches like estimate_line, and the final curve is
+a weighted least-squares fit to the inliers.
+"""
+
+import numpy as np
+
+from estimate_line import get_edge_pts, compute_nb_iters, get_rng
+
+def estimate_curve(edgemap, MAX_ITERS=300, T=1.0, ALPHA=6, BATCH_SIZE=64,
+                   ADAPTIVE=False, CONFIDENCE=0.99, stats=None, rng=None):
+    """ Given an edgemap, robustly determine the most dominant parabola
+    x = a*y^2 + b*y + c.
+    Input:
+        nparray edgemap
+        int MAX_ITERS
+        float T
+            Distance threshold between a point and a curve (see
+            curve_distances).
+        int ALPHA
+            Min. number of inliers required for a model to be considered.
+        int BATCH_SIZE
+            Number of hypotheses scored per vectorized batch.
+        bool ADAPTIVE
+        float CONFIDENCE
+            Confidence-based early termination, as in estimate_line
+            (with samples of 3 points).
+        dict stats
+            If given, then stats['nb_iters'] is set to the number of
+            hypotheses tried, stats['best_iter'] to the iteration at which
+            the returned model was found, and stats['scores'] to the nb.
+            of inliers of each hypothesis.
+        rng
+            Random number generator, or seed (see estimate_line.get_rng).
+    Output:
+        (nparray curve, nparray inliers)
+    Where curve := (float a, float b, float c), and inliers are indices
+    into the edge pixels of edgemap (see get_edge_pts). Outputs None if
+    edgemap has no edges, and (None, None) if no curve was found.
+    """
+    pts = get_edge_pts(edgemap)
+    nb_active = len(pts)
+    if stats is not None:
+        stats['nb_iters'] = 0
+        stats['best_iter'] = 0
+        stats['scores'] = np.zeros(0, dtype='int')
+    if nb_active == 0:
+        return None # Couldn't detect any edges!
+
+    best_nb_inliers = -np.inf
+    best_curve = None
+    best_inliers = None
+    best_iter = 0
+
+    idxs = get_rng(rng).randint(0, nb_active, size=(MAX_ITERS, 3))
+    nb_iters = 0
+    scores = []
+    while nb_iters < MAX_ITERS:
+        curves = hypothesize_curves(pts, idxs[nb_iters:nb_iters+BATCH_SIZE])
+        dists = curve_distances(pts, curves)
+        nb_inliers = np.sum(dists <= T, axis=1)
+        nb_batch = len(curves)
+        if ADAPTIVE:
+            nb_best = np.where(nb_inliers >= ALPHA, nb_inliers, 0)
+            nb_best = np.maximum.accumulate(np.maximum(nb_best, max(best_nb_inliers, 0)))
+            nb_needed = compute_nb_iters(nb_best / float(nb_active), CONFIDENCE, sample_size=3)
+            done = np.flatnonzero(nb_iters + np.arange(1, nb_batch + 1) >= nb_needed)
+            if len(done) > 0:
+                nb_batch = done[0] + 1
+                nb_inliers = nb_inliers[:nb_batch]
+        j = np.argmax(nb_inliers)
+        if nb_inliers[j] > best_nb_inliers and nb_inliers[j] >= ALPHA:
+            best_nb_inliers = nb_inliers[j]
+            best_curve = curves[j]
+            best_inliers = np.flatnonzero(dists[j] <= T)
+            best_iter = nb_iters + j + 1
+        if stats is not None:
+            scores.append(nb_inliers)
+        nb_iters += nb_batch
+        if nb_batch < len(curves):
+            break
+    if stats is not None:
+        stats['nb_iters'] = nb_iters
+        stats['best_iter'] = best_iter
+        stats['scores'] = np.concatenate(scores) if scores else np.zeros(0, dtype='int')
+    if best_inliers is None:
+        return None, None
+    curve = fit_curve(pts[best_inliers], curve_init=best_curve)
+    return curve, best_inliers
+
+def hypothesize_curves(pts, idxs):
+    """ Computes the parabola x = a*y^2 + b*y + c through each triplet of
+    points indexed by idxs (by divided differences).
+    Input:
+        nparray pts: N x 2
+        nparray idxs: M x 3
+    Output:
+        nparray curves: M x 3
+            Rows (a, b, c). Triplets with repeated y's are degenerate, and
+            are set to (0, 0, inf) so that no point lies near them.
+    """
+    x0, y0 = pts[idxs[:, 0], 0], pts[idxs[:, 0], 1]
+    x1, y1 = pts[idxs[:, 1], 0], pts[idxs[:, 1], 1]
+    x2, y2 = pts[idxs[:, 2], 0], pts[idxs[:, 2], 1]
+    degenerate = (y0 == y1) | (y1 == y2) | (y0 == y2)
+    dy01 = np.where(degenerate, 1.0, y1 - y0)
+    dy12 = np.where(degenerate, 1.0, y2 - y1)
+    dy02 = np.where(degenerate, 1.0, y2 - y0)
+    d01 = (x1 - x0) / dy01
+    d12 = (x2 - x1) / dy12
+    curves = np.empty((len(idxs), 3))
+    curves[:, 0] = (d12 - d01) / dy02
+    curves[:, 1] = d01 - curves[:, 0]*(y0 + y1)
+    curves[:, 2] = x0 - curves[:, 0]*y0*y0 - curves[:, 1]*y0
+    curves[degenerate] = (0.0, 0.0, np.inf)
+    return curves
+
+def curve_distances(pts, curves):
+    """ Computes the (approximate) distance from every point to every
+    curve: the horizontal residual, scaled by the curve's local slope,
+        |x - x(y)| / sqrt(1 + x'(y)^2)
+    which is the exact point-to-line distance for straight lines (a=0).
+    Input:
+        nparray pts: N x 2
+        nparray curves: M x 3
+    Output:
+        nparray dists: M x N
+    """
+    ys = pts[:, 1]
+    a, b, c = curves[:, 0:1], curves[:, 1:2], curves[:, 2:3]
+    resid = pts[:, 0] - ((a*ys + b)*ys + c)
+    slope = 2*a*ys + b
+    return np.abs(resid) / np.sqrt(1.0 + slope*slope)
+
+def fit_curve(pts, curve_init=None, weights=None):
+    """ Fits a parabola x = a*y^2 + b*y + c to pts by weighted least
+    squares on the horizontal residuals.
+    Input:
+        nparray pts: N x 2 (N >= 3)
+        nparray curve_init
+            If given (and weights isn't), each point is weighted by
+            1 / (1 + x'(y)^2) of this curve, so that the fit minimizes
+            the (approximate) squared distances of curve_distances.
+        nparray weights
+            Per-point weights.
+    Output:
+        nparray curve: (a, b, c)
+    """
+    pts = np.asarray(pts, dtype='float64')
+    if len(pts) < 3:
+        raise Exception("Can't fit a curve with less than 3 points!")
+    ys = pts[:, 1]
+    if weights is None:
+        if curve_init is not None:
+            slope = 2*curve_init[0]*ys + curve_init[1]
+            weights = 1.0 / (1.0 + slope*slope)
+        else:
+            weights = np.ones(len(pts))
+    # Center+scale y, for a well-conditioned Vandermonde system
+    ym = ys.mean()
+    ys_scale = max(np.abs(ys - ym).max(), 1.0)
+    u = (ys - ym) / ys_scale
+    sw = np.sqrt(weights)
+    A = np.column_stack((u*u, u, np.ones(len(pts)))) * sw[:, np.newaxis]
+    (p2, p1, p0), _, rank, _ = np.linalg.lstsq(A, pts[:, 0] * sw, rcond=-1)
+    if rank < 3:
+        # All points on <= 2 rows: fall back to the straight line
+        A = A[:, 1:3]
+        (p1, p0), _, rank, _ = np.linalg.lstsq(A, pts[:, 0] * sw, rcond=-1)
+        p2 = 0.0
+    # x = p2*u^2 + p1*u + p0, with u = (y - ym) / ys_scale
+    a = p2 / ys_scale**2
+    b = p1 / ys_scale - 2*a*ym
+    c = p0 - p1*ym/ys_scale + a*ym*ym
+    return np.array([a, b, c])
+
+def curve_tangent_line(curve, y):
+    """ Outputs the tangent line (a, b, c) (ax + by + c = 0) of curve at
+    row y.
+    """
+    a, b, c = curve
+    slope = 2*a*y + b
+    x = (a*y + b)*y + c
+    return np.array([1.0, -slope, -(x - slope*y)])
+
+def compute_curve_x(curve, y):
+    """ x = a*y^2 + b*y + c """
+    return (curve[0]*y + curve[1])*y + curve[2]
+
+def estimate_line_curve(edgemap, TANGENT_ROW=0.5, **params):
+    """ Line estimation backend (see detect_lanes.LINE_ESTIMATORS) using
+    the curved lane model: fits a parabola with estimate_curve, and
+    outputs its tangent line at row TANGENT_ROW*(h-1) of the edgemap
+    (e.g. 1.0 for the bottom row, nearest to the car).
+    Output:
+        (nparray line, nparray inliers)
+    Same as estimate_line.estimate_line.
+    """
+    res = estimate_curve(edgemap, **params)
+    if res is None or res[0] is None:
+        return res
+    curve, inliers = res
+    return curve_tangent_line(curve, TANGENT_ROW*(edgemap.shape[0] - 1)), inliers
@@ -1,9 +1,15 @@
-import sys, os, pdb, time, argparse, random
+import sys, os, pdb, time, argparse
 import numpy as np, numpy.linalg as linalg
 import cv2
 
-def estimate_line(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8):
+def estimate_line(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8, BATCH_SIZE=64,
+                  ADAPTIVE=False, CONFIDENCE=0.99, SAMPLER='uniform',
+                  grad=None, LANE_ANGLE=None, PROSAC_TN=1000, REFINE_ITERS=0,
+                  stats=None, rng=None):
     """ Given an edgemap, robustly determine the most dominant line.
+    Hypotheses are scored in batches: the point-to-line distances of
+    all edge pixels to BATCH_SIZE candidate lines are evaluated at once
+    as a (BATCH_SIZE x N) matrix.
     Input:
         nparray edgemap
         int MAX_ITERS
@@ -11,9 +17,309 @@ def estimate_line(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8):
             Distance threshold between a candidate point and a line
         int ALPHA
             Min. number of inliers required for a model to be considered
+        int BATCH_SIZE
+            Number of hypotheses scored per vectorized batch.
+        bool ADAPTIVE
+            If True, then after each hypothesis the number of iterations
+            needed is re-estimated from the best inlier ratio so far
+            (see compute_nb_iters), and we stop as soon as that many
+            hypotheses were tried. MAX_ITERS remains an upper bound.
+        float CONFIDENCE
+            Desired probability (for ADAPTIVE) of drawing at least one
+            all-inlier sample.
+        str SAMPLER
+            How point pairs are drawn. One of:
+                'uniform': Uniformly over all edge pixels.
+                'prosac': PROSAC-style, from a pool of the best-ranked
+                          edge pixels (see rank_edge_pts) that grows
+                          with the iteration count.
+        tuple grad: (nparray gx, nparray gy)
+            Image gradients, same shape as edgemap. Required for
+            SAMPLER='prosac'.
+        float LANE_ANGLE
+            Expected direction of the line (in radians, image coords)
+            used to rank edge pixels for SAMPLER='prosac'. If None, then
+            vertical-ish lines are preferred.
+        int PROSAC_TN
+            Number of PROSAC samples after which the sampling pool
+            spans all edge pixels.
+        int REFINE_ITERS
+            Max. number of refinement rounds of the final model (see
+            refine_line). With 0 (the default), the output is the fit to
+            the best hypothesis's inliers. (benchmark_lanes.py --bench
+            refine compares the two.)
+        dict stats
+            If given, then stats['nb_iters'] is set to the number of
+            hypotheses actually tried, stats['best_iter'] to the
+            iteration (1-indexed) at which the returned model was found,
+            and stats['scores'] to the nb. of inliers of each hypothesis.
+        rng
+            Random number generator (see get_rng): with a seed or a
+            RandomState, the output is reproducible. All of the samples
+            are drawn up front, in one call.
     Output:
-        tuple line := (float a, float b, float c)
-    Where each a,b,c satisfies: ax + by + c = 0
+        (nparray line, nparray inliers)
+    Where line := (float a, float b, float c) satisfies: ax + by + c = 0,
+    and inliers are indices into the edge pixels of edgemap (in the
+    row-major order given by get_edge_pts).
+    """
+    pts = get_edge_pts(edgemap)
+    nb_active = len(pts)
+    if stats is not None:
+        stats['nb_iters'] = 0
+        stats['best_iter'] = 0
+        stats['scores'] = np.zeros(0, dtype='int')
+    if nb_active == 0:
+        return None # Couldn't detect any edges!
+
+    best_nb_inliers = -np.inf
+    best_line = None
+    best_inliers = None
+    best_iter = 0
+
+    rng = get_rng(rng)
+    if SAMPLER == 'uniform':
+        idxs = rng.randint(0, nb_active, size=(MAX_ITERS, 2))
+    elif SAMPLER == 'prosac':
+        if grad is None:
+            raise Exception("SAMPLER='prosac' requires the image gradients!")
+        order = rank_edge_pts(pts, grad[0], grad[1], LANE_ANGLE)
+        idxs = order[sample_prosac(nb_active, MAX_ITERS, PROSAC_TN, rng=rng)]
+    else:
+        raise Exception("Unknown SAMPLER: {0}".format(SAMPLER))
+    nb_iters = 0
+    scores = []
+    while nb_iters < MAX_ITERS:
+        lines = hypothesize_lines(pts, idxs[nb_iters:nb_iters+BATCH_SIZE])
+        dists = line_distances(pts, lines)
+        nb_inliers = np.sum(dists <= T, axis=1)
+        nb_batch = len(lines)
+        if ADAPTIVE:
+            # Best model size after each hypothesis of this batch
+            nb_best = np.where(nb_inliers >= ALPHA, nb_inliers, 0)
+            nb_best = np.maximum.accumulate(np.maximum(nb_best, max(best_nb_inliers, 0)))
+            nb_needed = compute_nb_iters(nb_best / float(nb_active), CONFIDENCE)
+            done = np.flatnonzero(nb_iters + np.arange(1, nb_batch + 1) >= nb_needed)
+            if len(done) > 0:
+                nb_batch = done[0] + 1
+                nb_inliers = nb_inliers[:nb_batch]
+        j = np.argmax(nb_inliers) # First occurrence, as in a serial scan
+        if nb_inliers[j] > best_nb_inliers and nb_inliers[j] >= ALPHA:
+            best_nb_inliers = nb_inliers[j]
+            best_inliers = np.flatnonzero(dists[j] <= T)
+            best_iter = nb_iters + j + 1
+        if stats is not None:
+            scores.append(nb_inliers)
+        nb_iters += nb_batch
+        if nb_batch < len(lines):
+            break
+    if stats is not None:
+        stats['nb_iters'] = nb_iters
+        stats['best_iter'] = best_iter
+        stats['scores'] = np.concatenate(scores) if scores else np.zeros(0, dtype='int')
+    if best_inliers is not None:
+        best_line, best_inliers = refine_line(pts, best_inliers, T, max(ALPHA, 2),
+                                              nb_iters=REFINE_ITERS)
+    return best_line, best_inliers
+
+def refine_line(pts, inliers, T, min_inliers=2, nb_iters=3):
+    """ Fits a line to pts[inliers], then alternates between re-selecting
+    the inliers (the points within T of the fit) and refitting, until
+    the inliers stop changing. Each refit only adds/removes the points
+    whose status changed (see LineFitter), rather than refitting all of
+    the inliers from scratch.
+    Input:
+        nparray pts: N x 2
+        nparray inliers
+            Indices into pts.
+        float T
+        int min_inliers
+            Stop (keeping the current fit) if fewer points are within T.
+        int nb_iters
+            Max. number of refinement rounds.
+    Output:
+        (nparray line, nparray inliers)
+    """
+    fitter = LineFitter(pts[inliers])
+    line, residual = fitter.fit()
+    is_inlier = np.zeros(len(pts), dtype='bool')
+    is_inlier[inliers] = True
+    for _ in xrange(nb_iters):
+        is_inlier_new = line_distances(pts, line[np.newaxis])[0] <= T
+        if np.count_nonzero(is_inlier_new) < min_inliers:
+            break
+        added = is_inlier_new & ~is_inlier
+        removed = is_inlier & ~is_inlier_new
+        if not (added.any() or removed.any()):
+            break
+        fitter.add(pts[added])
+        fitter.remove(pts[removed])
+        is_inlier = is_inlier_new
+        line, residual = fitter.fit()
+    return line, np.flatnonzero(is_inlier)
+
+def get_rng(rng=None):
+    """ Outputs the random number generator to draw RANSAC samples from.
+    Input:
+        rng
+            None for NumPy's global generator (np.random), an int seed
+            (or a sequence of ints, e.g. (seed, frame_index)), or a
+            generator (np.random or a np.random.RandomState), which is
+            output as-is. Thus get_rng(get_rng(rng)) is get_rng(rng).
+    Output:
+        An object with the methods of np.random.RandomState.
+    """
+    if rng is None or rng is np.random:
+        return np.random
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.RandomState(rng)
+
+def compute_nb_iters(inlier_ratio, confidence, sample_size=2):
+    """ Computes the number of RANSAC iterations k needed so that, with
+    probability confidence, at least one of the k samples contains only
+    inliers:
+        k = log(1 - confidence) / log(1 - inlier_ratio^sample_size)
+    Input:
+        float inlier_ratio
+            Can also be an nparray of ratios.
+        float confidence
+        int sample_size
+    Output:
+        float k
+    Where k is inf if inlier_ratio is 0.
+    """
+    p_good = np.power(inlier_ratio, sample_size)
+    with np.errstate(divide='ignore'):
+        k = np.log(1.0 - confidence) / np.log(1.0 - np.minimum(p_good, 1.0))
+    return np.where(p_good > 0, k, np.inf)
+
+def rank_edge_pts(pts, gx, gy, lane_angle=None, nb_bins=20):
+    """ Ranks edge pixels by how likely they are to lie on a lane line.
+    Pixels are ranked first by orientation consistency, i.e. how close
+    their gradient is to being perpendicular to the expected lane
+    direction (quantized into nb_bins levels), and then by gradient
+    magnitude.
+    Input:
+        nparray pts: N x 2
+        nparray gx, gy
+            Image gradients (e.g. from cv2.Sobel).
+        float lane_angle
+            Expected lane direction, in radians. If None, then assumes
+            vertical lanes (i.e. prefers horizontal gradients).
+        int nb_bins
+    Output:
+        nparray order: N
+            Indices into pts, best-ranked first.
+    """
+    xs = pts[:, 0].astype('int')
+    ys = pts[:, 1].astype('int')
+    gx_pts = gx[ys, xs].astype('float64')
+    gy_pts = gy[ys, xs].astype('float64')
+    if lane_angle is None:
+        lane_angle = np.pi / 2
+    mag = np.sqrt(gx_pts**2 + gy_pts**2)
+    # |sin| of angle between gradient and lane direction
+    consistency = np.abs(gx_pts*np.sin(lane_angle) - gy_pts*np.cos(lane_angle))
+    consistency /= np.maximum(mag, 1e-9)
+    consistency = np.floor(consistency * nb_bins)
+    return np.lexsort((-mag, -consistency))
+
+def sample_prosac(N, nb_samples, T_N=1000, rng=None):
+    """ Draws point pairs following the PROSAC schedule (Chum and Matas,
+    2005): the t-th sample is the n_t-th best point plus a point drawn
+    uniformly from the n_t - 1 better-ranked ones, where the pool size
+    n_t grows such that, after T_N samples, the pool is all N points.
+    Samples beyond that are drawn uniformly.
+    Input:
+        int N
+            Number of (ranked) points.
+        int nb_samples
+        int T_N
+        rng
+            (See get_rng)
+    Output:
+        nparray idxs: nb_samples x 2
+            Indices into the ranking (0 is the best-ranked point).
+    """
+    rng = get_rng(rng)
+    m = 2 # Sample size
+    if N <= m:
+        return rng.randint(0, N, size=(nb_samples, 2))
+    # T_n: expected number of samples drawn only from the top n points
+    ns = np.arange(m, N + 1)
+    T_n = T_N * (ns * (ns - 1.0)) / (N * (N - 1.0))
+    # T'_n: iteration at which the pool grows from n to n+1
+    Tp_n = np.ones(len(ns))
+    Tp_n[1:] += np.cumsum(np.ceil(np.diff(T_n)))
+    ts = np.arange(1, nb_samples + 1)
+    pool = m + np.searchsorted(Tp_n[:-1], ts, side='left')
+    idxs = np.empty((nb_samples, 2), dtype='int')
+    idxs[:, 0] = pool - 1
+    idxs[:, 1] = (rng.random_sample(nb_samples) * (pool - 1)).astype('int')
+    beyond = ts > Tp_n[-1]
+    idxs[beyond] = rng.randint(0, N, size=(np.count_nonzero(beyond), 2))
+    return idxs
+
+def get_edge_pts(edgemap):
+    """ Returns the coords of the "ON" pixels of edgemap.
+    Input:
+        nparray edgemap
+    Output:
+        nparray pts: N x 2
+            Rows of pixel coords (x, y), as a contiguous float array.
+    """
+    ys, xs = np.nonzero(edgemap == 255)
+    pts = np.empty((len(xs), 2))
+    pts[:, 0] = xs
+    pts[:, 1] = ys
+    return pts
+
+def hypothesize_lines(pts, idxs):
+    """ Computes the line through each pair of points indexed by idxs.
+    Input:
+        nparray pts: N x 2
+        nparray idxs: M x 2
+            Each row (i, j) selects the point pair (pts[i], pts[j]).
+    Output:
+        nparray lines: M x 3
+            Rows (a, b, c) with a^2 + b^2 = 1. Rows where pts[i] and
+            pts[j] coincide are degenerate, and are set to (0, 0, inf)
+            so that no point lies within any distance of them.
+    """
+    pt1 = pts[idxs[:, 0]]
+    pt2 = pts[idxs[:, 1]]
+    lines = np.empty((len(idxs), 3))
+    lines[:, 0] = pt1[:, 1] - pt2[:, 1]
+    lines[:, 1] = pt2[:, 0] - pt1[:, 0]
+    norms = np.sqrt(lines[:, 0]**2 + lines[:, 1]**2)
+    degenerate = norms == 0
+    norms[degenerate] = 1.0
+    lines[:, 0] /= norms
+    lines[:, 1] /= norms
+    lines[:, 2] = -lines[:, 0]*pt1[:, 0] - lines[:, 1]*pt1[:, 1]
+    lines[degenerate, 2] = np.inf
+    return lines
+
+def line_distances(pts, lines):
+    """ Computes the distance from every point to every line.
+    Input:
+        nparray pts: N x 2
+        nparray lines: M x 3
+            Rows (a, b, c), normalized such that a^2 + b^2 = 1.
+    Output:
+        nparray dists: M x N
+    """
+    dists = np.dot(lines[:, 0:2], pts.T)
+    dists += lines[:, 2:3]
+    return np.abs(dists, out=dists)
+
+def estimate_line_naive(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8, rng=None):
+    """ Reference implementation of estimate_line() that scores each
+    hypothesis with a per-pixel Python loop. Kept around to benchmark
+    and sanity-check the vectorized version against. With the same rng
+    seed, it tries the same hypotheses as estimate_line (uniform
+    sampling).
     """
     best_nb_inliers = -np.inf
     best_line = None
@@ -26,10 +332,10 @@ def estimate_line(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8):
     if nb_active == 0:
         return None # Couldn't detect any edges!
     
+    idxs = get_rng(rng).randint(0, nb_active, size=(MAX_ITERS, 2))
     cnt_iter = 0
     while cnt_iter < MAX_ITERS:
-        idx1 = random.randint(0, nb_active - 1)
-        idx2 = random.randint(0, nb_active - 1)
+        idx1, idx2 = idxs[cnt_iter]
         if idx1 == idx2:
             cnt_iter += 1
             continue    # Degenerate case
@@ -64,13 +370,20 @@ def estimate_line(edgemap, MAX_ITERS=400, T=3.0, ALPHA=8):
     return best_line, best_inliers
 
 def fit_line(pts):
-    """ Fits a 2D line through 2D points in pts.
+    """ Fits a 2D line through 2D points in pts, minimizing the sum of
+    squared (perpendicular) point-to-line distances.
     Input:
         tuple pts: ((int x_i, int y_i), ...)
+            Can also be an N x 2 nparray.
     Output:
-        tuple line: (float a, float b, float c)
+        (nparray line, float residual)
+    Where line := (float a, float b, float c), and residual is the
+    norm of the vector of point-to-line distances (the geometric error,
+    with a^2 + b^2 = 1). Note: before LineFitter, this was the algebraic
+    error ||A*v|| of the SVD solution with ||(a, b, c)|| = 1, whose
+    value depends on the position of the points.
     """
-    if not pts or len(pts) <= 1:
+    if pts is None or len(pts) <= 1:
         raise Exception("Can't fit line with less than 2 points!")
     if len(pts) == 2:
         # Solve analytically
@@ -80,15 +393,68 @@ def fit_line(pts):
         c = -a*pt1[0] - b*pt1[1]
         return np.array([a, b, c]), 0.0
     else:
-        # Solve min || Ap || via SVD of A
-        n = len(pts)
-        A = np.zeros((n, 3))
-        for i, pt in enumerate(pts):
-            A[i, :] = (pt[0], pt[1], 1)
-        U, S, V = linalg.svd(A) 
-        v = V[-1, :]
-        residual = linalg.norm(np.dot(A, v.T))
-        return v, residual
+        return LineFitter(pts).fit()
+
+class LineFitter(object):
+    """ Streaming total-least-squares line fitter. Only the first and
+    second moments of the points are kept:
+        n, Sx, Sy, Sxx, Sxy, Syy
+    so points can be added and removed in O(1) per point, and the fit
+    is a closed-form solve of the 2x2 scatter-matrix eigenproblem.
+    Note: removing most of the points that were added can lose
+    precision (the moments are differences of large sums).
+    """
+    def __init__(self, pts=None):
+        self.n = 0
+        self.sx, self.sy = 0.0, 0.0
+        self.sxx, self.sxy, self.syy = 0.0, 0.0, 0.0
+        if pts is not None:
+            self.add(pts)
+
+    def add(self, pts, sign=1):
+        """ Adds points to the fit.
+        Input:
+            nparray pts: N x 2
+                (Or a single point (x, y).)
+            int sign
+                +1 to add the points, -1 to remove them.
+        """
+        pts = np.asarray(pts, dtype='float64').reshape(-1, 2)
+        xs, ys = pts[:, 0], pts[:, 1]
+        self.n += sign * len(pts)
+        self.sx += sign * xs.sum()
+        self.sy += sign * ys.sum()
+        self.sxx += sign * np.dot(xs, xs)
+        self.sxy += sign * np.dot(xs, ys)
+        self.syy += sign * np.dot(ys, ys)
+
+    def remove(self, pts):
+        """ Removes points (that were previously added) from the fit. """
+        self.add(pts, sign=-1)
+
+    def fit(self):
+        """ Computes the best-fit line.
+        Output:
+            (nparray line, float residual)
+        Where line := (a, b, c) with a^2 + b^2 = 1, and residual is the
+        norm of the vector of point-to-line distances.
+        """
+        if self.n <= 1:
+            raise Exception("Can't fit line with less than 2 points!")
+        mx = self.sx / self.n
+        my = self.sy / self.n
+        # Centered scatter matrix [[cxx, cxy], [cxy, cyy]]
+        cxx = self.sxx - self.sx*mx
+        cxy = self.sxy - self.sx*my
+        cyy = self.syy - self.sy*my
+        # Line direction is the major eigenvector, at angle theta
+        theta = 0.5 * np.arctan2(2*cxy, cxx - cyy)
+        a, b = -np.sin(theta), np.cos(theta)
+        c = -a*mx - b*my
+        # Smallest eigenvalue := sum of squared distances to the line
+        lambda_min = 0.5*(cxx + cyy) - np.sqrt((0.5*(cxx - cyy))**2 + cxy**2)
+        residual = np.sqrt(max(lambda_min, 0.0))
+        return np.array([a, b, c]), residual
 
 def test_fitline():
     cases = [((1, 1), (2, 2)),
@@ -103,8 +469,26 @@ def test_fitline():
         print("({0}/{1}) Line: {2}".format(i+1, len(cases), line))
         print("    Residual: {0}".format(residual))
 
+def test_linefitter():
+    """ Checks that incrementally adding/removing points matches a
+    fit_line() from scratch.
+    """
+    pts = np.random.random_sample((200, 2)) * 100
+    pts[:, 1] = 0.5 * pts[:, 0] + 3 + np.random.standard_normal(200)
+    fitter = LineFitter(pts[:150])
+    fitter.add(pts[150:])
+    fitter.remove(pts[:50])
+    line_inc, res_inc = fitter.fit()
+    line, residual = fit_line(pts[50:])
+    print("LineFitter (incremental): {0} (residual={1})".format(line_inc, res_inc))
+    print("fit_line (from scratch): {0} (residual={1})".format(line, residual))
+    # (a,b,c) and (-a,-b,-c) are the same line
+    err = min(linalg.norm(line_inc - line), linalg.norm(line_inc + line))
+    print("    Difference: {0}".format(err))
+
 def main():
     test_fitline()
+    test_linefitter()
     print("Done.")
 
 if __name__ == '__main__':
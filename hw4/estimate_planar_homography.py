@@ -3,7 +3,14 @@ import util_camera, util
 import numpy as np, numpy.linalg, cv2
 
 from util import intrnd
-from util_camera import compute_x, compute_y, pt2homo, homo2pt
+from util_camera import compute_x, compute_y, pt2homo, homo2pt, \
+    sample_lane_pairs, get_lane_rows
+
+CAMERA_HEIGHT = 2.1798 # Height of camera is 2.1798 meters
+# K matrix given by the Caltech Lanes dataset (CameraInfo.txt)
+K_CALTECH = np.array([[309.4362,     0,        317.9034],
+                      [0,         344.2161,    256.5352],
+                      [0,            0,            1   ]])
 
 def estimate_planar_homography(I, line1, line2, K, win1, win2, lane_width):
     """ Estimates the planar homography H between the camera image
@@ -26,21 +33,8 @@ def estimate_planar_homography(I, line1, line2, K, win1, win2, lane_width):
     where H is a 3x3 homography.
     """
     h, w = I.shape[0:2]
-    x_win1 = intrnd(w * win1[0])
-    y_win1 = intrnd(h * win1[1])
-    x_win2 = intrnd(w * win2[0])
-    y_win2 = intrnd(h * win2[1])
-    
-    pts = []
-    NUM = 10
-    h_win = intrnd(h*win1[3]) # Assume window heights same btwn left/right
-    for i in xrange(NUM):
-        frac = i / float(NUM)
-        y_cur = intrnd((y_win1-(h_win/2) + frac*h_win))
-        pt_i = (compute_x(line1, y_cur), y_cur)
-        pt_j = (compute_x(line2, y_cur), y_cur)
-        pts.append((pt_i, pt_j))
-        
+    # Point pairs across the lanes, at every row of the lane windows
+    pts = sample_lane_pairs(line1, line2, get_lane_rows(h, win1))
     r1 = solve_for_r1(pts,
                       K,
                       lane_width)
@@ -50,7 +44,7 @@ def estimate_planar_homography(I, line1, line2, K, win1, win2, lane_width):
     ## DEBUG Plot points on image, save to file for visual verification
     Irgb = util.to_rgb(I)
     COLOURS = [(255, 0, 0), (0, 255, 0)]
-    for i, (pt_i, pt_j) in enumerate(pts):
+    for i, (pt_i, pt_j) in enumerate(pts[::10]):
         clr = COLOURS[i % 2]
         cv2.circle(Irgb, tuple(map(intrnd, pt_i)), 5, clr)
         cv2.circle(Irgb, tuple(map(intrnd, pt_j)), 5, clr)
@@ -60,7 +54,7 @@ def estimate_planar_homography(I, line1, line2, K, win1, win2, lane_width):
     r3 = solve_for_r3(vanishing_pt, line1, line2, K)
     T = solve_for_t(pts, K, r1, r3, lane_width)
     print "T_pre:", T
-    T = T * (2.1798 / T[1])    # Height of camera is 2.1798 meters
+    T = T * (CAMERA_HEIGHT / T[1])
     T[2] = 1 # We want the ref. frame to be directly below camera (why 1?!)
     #T = T / np.linalg.norm(T)
     print "T_post:", T
@@ -71,6 +65,33 @@ def estimate_planar_homography(I, line1, line2, K, win1, win2, lane_width):
     H[:, 2] = T
     return np.dot(K, H)
 
+def estimate_planar_homography_batch(imgsize, lines1, lines2, K, win1, win2, lane_width):
+    """ Same as estimate_planar_homography, for F frames at once (and
+    without the debug output): every linear system is solved with one
+    stacked SVD.
+    Input:
+        tuple imgsize: (int w, int h)
+        nparray lines1, lines2: F x 3
+            The left/right lanes of each frame.
+        (See estimate_planar_homography for the rest)
+    Output:
+        nparray Hs: F x 3 x 3
+    """
+    w, h = imgsize
+    lines1 = np.asarray(lines1, dtype='float64')
+    lines2 = np.asarray(lines2, dtype='float64')
+    # pts: F x N x 2 x 2 (frame, row, lane, (x, y))
+    pts = sample_lane_pairs(lines1, lines2, get_lane_rows(h, win1))
+    r1 = solve_for_r1(pts, K, lane_width)
+    vanishing_pts = np.cross(lines1, lines2)
+    vanishing_pts = vanishing_pts / vanishing_pts[:, 2:3]
+    r3 = solve_for_r3(vanishing_pts, lines1, lines2, K)
+    T = solve_for_t(pts, K, r1, r3, lane_width)
+    T = T * (CAMERA_HEIGHT / T[:, 1:2])
+    T[:, 2] = 1 # (See estimate_planar_homography)
+    Hs = np.concatenate((r1[:, :, np.newaxis], r3[:, :, np.newaxis], T[:, :, np.newaxis]), axis=2)
+    return np.einsum('ij,fjk->fik', K, Hs)
+
 def solve_for_r1(pts, K, lane_width):
     """ Solve for first column of the rotation matrix, utilizing the
     fact that we know the lane width. We require two pairs of points
@@ -78,61 +99,35 @@ def solve_for_r1(pts, K, lane_width):
     for p3, p4).
     Input:
         tuple pts: ((p1, p2), (p3, p4))
-            where each point is a pixel coord: (float x, float y)
+            where each point is a pixel coord: (float x, float y).
+            Can also be an N x 2 x 2 nparray, or a F x N x 2 x 2 stack
+            of F frames' point pairs.
         nparray K
             The 3x3 camera intrinsic matrix.
         float lane_width
             The width of the lane (e.g., 3.66 meters).
     Output:
         nparray r1
-    A 3x1 column vector consisting of the first column of R.
+    A 3x1 column vector consisting of the first column of R (F x 3 for
+    F frames).
     """
     (fx, fy, (cx, cy)) = util_camera.get_intrinsics(K)
-    # Construct data matrix A
-    Araw = np.zeros([len(pts) * 2, 4])
-    i = 0 # Actual index into A
-    for ii, (pi, pj) in enumerate(pts):
-        xi, yi = pi
-        xj, yj = pj
-        Araw[i, :]   = (0, -fy, (-cy + yj), (yi - yj))
-        Araw[i+1, :] = (fx, 0, (cx - xj), (-xj + xi))
-        #Araw[i+2, :] = (-yj*fx, xj*fy, -yj*cx + xj*cy, yj*xi - xj*yi)
-        i += 2
-    rnk = numpy.linalg.matrix_rank(Araw)
-    print "    Rank(A):", rnk
-    if rnk == 3:
-        A = Araw # Perfect! Just the rank we want.
-    elif rnk < 3:
-        raise Exception("Matrix A needs to have rank either 4 or 3! Rank was: {0}".format(rnk))
-    else:
-        # A is full rank - perform fixed-rank approx. -> rank 3
-        print "(solve_for_r1) A is full rank, performing fixed rank approx..."
-        U, S, V = numpy.linalg.svd(Araw)
-        if (np.linalg.det(V) < 0):
-            # We require U,V to have positive determinant
-            print "    U,V had negative determinant, correcting."
-            U = -U
-            V = -V
-        S_part = np.diag([S[0], S[1], S[2], 0]) # Kill last singular value
-        S_new = np.zeros([Araw.shape[0], 4])
-        S_new[0:4, :] = S_part
-        A = np.dot(U, np.dot(S_new, V))
-        print "    new rank:", np.linalg.matrix_rank(A)
-        if np.linalg.matrix_rank(A) != 3:
-            raise Exception("(solve_for_r1) What?! Fixed-rank approx. failed!")
-    U, S, V = numpy.linalg.svd(A)
-    if (np.linalg.det(V) < 0):
-        # We require U,V to have positive determinant
-        print "    U,V had negative determinant, correcting."
-        U = -U
-        V = -V
-    v = V[-1, :]
-    residual = numpy.linalg.norm(np.dot(A, v.T))
-    print "(solve_for_r1) Residual: {0}".format(residual)
-    gamma = v[-1]
-    v_norm = v / gamma
-    r11, r21, r31, _ = v_norm
-    return np.array([r11, r21, r31])
+    pts = np.asarray(pts, dtype='float64')
+    xi, yi = pts[..., 0, 0], pts[..., 0, 1]
+    xj, yj = pts[..., 1, 0], pts[..., 1, 1]
+    # Construct data matrix A: 2 rows per point pair
+    A = np.zeros(pts.shape[:-2] + (2, 4))
+    A[..., 0, 1] = -fy
+    A[..., 0, 2] = -cy + yj
+    A[..., 0, 3] = yi - yj
+    A[..., 1, 0] = fx
+    A[..., 1, 2] = cx - xj
+    A[..., 1, 3] = -xj + xi
+    #A[..., 2, :] = (-yj*fx, xj*fy, -yj*cx + xj*cy, yj*xi - xj*yi)
+    A = A.reshape(pts.shape[:-3] + (-1, 4))
+    v, residual = solve_nullspace(A, 3, 'solve_for_r1')
+    v_norm = v / v[..., -1:]
+    return v_norm[..., 0:3]
 
 def solve_for_r3(vanishing_pt, line1, line2, K):
     """ Solve for the third column r3 of the rotation matrix,
@@ -140,7 +135,7 @@ def solve_for_r3(vanishing_pt, line1, line2, K):
     Input:
         nparray vanishing_pt: [x, y, 1]
             Pixel image location of the vanishing point defined by the
-            lanes.
+            lanes (or an F x 3 stack of them).
         nparray line1, line2: [a, b, c]
             Lines vectors of the left/right lanes, in the form:
                 [a, b, c]
@@ -153,8 +148,8 @@ def solve_for_r3(vanishing_pt, line1, line2, K):
             The third column of the rotation matrix R.
     """
     Kinv = numpy.linalg.inv(K)
-    r3 = np.dot(Kinv, vanishing_pt)
-    r3_norm = r3 / r3[2]
+    r3 = np.dot(vanishing_pt, Kinv.T)
+    r3_norm = r3 / r3[..., 2:3]
     return r3_norm
 
 def solve_for_t(pts, K, r1, r3, lane_width):
@@ -173,73 +168,64 @@ def solve_for_t(pts, K, r1, r3, lane_width):
             of the rotation matrix R.
         float lane_width
             Width of the lane (in meters).
+    As in solve_for_r1, pts can be a F x N x 2 x 2 stack of F frames'
+    point pairs, in which case r1, r3 are F x 3.
     Output:
         nparray T
-            The translation vector T as a 3x1 column vector.
+            The translation vector T as a 3x1 column vector (F x 3 for
+            F frames), up to scale.
     """
     (fx, fy, (cx, cy)) = util_camera.get_intrinsics(K)
-    Kinv = numpy.linalg.inv(K)
-    r11, r21, r31 = r1
-    r13, r23, r33 = r3
+    pts = np.asarray(pts, dtype='float64')
+    r1 = np.asarray(r1)[..., np.newaxis, np.newaxis, :]
+    r3 = np.asarray(r3)[..., np.newaxis, np.newaxis, :]
     ww = lane_width / 2
-    # Construct data matrix A
-    Araw = np.zeros([len(pts) * 6, 5])
-    i = 0 # Actual index into A
-    for ii, (pi, pj) in enumerate(pts):
-        xi, yi = pi
-        xj, yj = pj
-        bi = np.array([(xi - cx) / fx,
-                       (yi - cy) / fy,
-                       1]).T
-        bj = np.array([(xj - cx) / fx,
-                       (yj - cy) / fy,
-                       1]).T
-        Araw[i, :]   = [r13, 1, 0, 0, -ww*r11 - bi[0]]
-        Araw[i+1, :] = [r23, 0, 1, 0, -ww*r21 - bi[1]]
-        Araw[i+2, :] = [r33, 0, 0, 1, -ww*r31 - bi[2]]
+    # b := normalized image coords (x, y, 1) of every point (... x N x 2 x 3)
+    b = np.ones(pts.shape[:-1] + (3,))
+    b[..., 0] = (pts[..., 0] - cx) / fx
+    b[..., 1] = (pts[..., 1] - cy) / fy
+    # Construct data matrix A: 3 rows per point, for k=0,1,2:
+    #     [r3[k], e_k, -ww*r1[k] - b[k]]
+    A = np.zeros(b.shape + (5,))
+    A[..., 0] = r3
+    A[..., 1:4] = np.eye(3)
+    A[..., 4] = -ww*r1 - b
+    A = A.reshape(pts.shape[:-3] + (-1, 5))
+    v, residual = solve_nullspace(A, 4, 'solve_for_t')
+    # v := (Z, tx, ty, tz, gamma). For lanes seen exactly head-on, gamma
+    # is (numerically) 0, so T is output unnormalized: the caller fixes
+    # its scale anyway (via the camera height).
+    return v[..., 1:4]
 
-        Araw[i+3, :] = [r13, 1, 0, 0, -ww*r11 - bj[0]]
-        Araw[i+4, :] = [r23, 0, 1, 0, -ww*r21 - bj[1]]
-        Araw[i+5, :] = [r33, 0, 0, 1, -ww*r31 - bj[2]]
-        i += 6
-    rnk = np.linalg.matrix_rank(Araw)
-    if rnk == 4:
-        A = Araw # Perfect! Just the rank we want.
-    elif rnk < 4:
-        raise Exception("(solve_for_r3) Matrix rank needs to be either 5 or 4 (was: {0})".format(rnk))
-    else:
-        # Perform fixed-rank approx on Araw (want rank 4)
-        print "(solve_for_t): Araw has full rank, performing fixed_rank approx..."
-        U, S, V = np.linalg.svd(Araw)
-        if np.linalg.svd(V) < 0:
-            U = -U
-            V = -V
-        S_new = np.zeros([U.shape[0], 5])
-        for i in xrange(4):
-            S_new[i,i] = S[i]
-        A = np.dot(U, np.dot(S_new, V))
-        print np.allclose(Araw, A)
-        print Araw[0,:]
-        print '=='
-        print A[0,:]
-        
-    print "(solve_for_t): Rank(A):", np.linalg.matrix_rank(A)
-    U, S, V = numpy.linalg.svd(A)
-    if np.linalg.det(V) < 0:
-        U = -U
-        V = -V
-    v = V[-1, :]
-    print "    residual: {0}".format(np.linalg.norm(np.dot(A, v)))
-    gamma = v[-1]
-    v_norm = v / gamma
-    Z, tx, ty, tz, _ = v_norm
-    return np.array([tx, ty, tz]).T
+def solve_nullspace(A, rank, name):
+    """ Solves A*v = 0 (with |v| = 1) in the least-squares sense, given
+    that A should have rank either rank+1 (noisy) or rank (exact). With
+    a single SVD of A, this:
+        - checks the rank of A (same tolerance as np.linalg.matrix_rank),
+        - outputs the right singular vector of the smallest singular
+          value, i.e. the null vector of the best rank-`rank`
+          approximation of A.
+    Input:
+        nparray A: M x N
+            Can also be a stack (F x M x N) of systems.
+        int rank
+        str name
+            Name of the caller, for error messages.
+    Output:
+        (nparray v, float residual)
+    Where residual = |A*v| is the smallest singular value of A (F-vectors
+    for a stack of systems).
+    """
+    U, S, Vt = np.linalg.svd(A, full_matrices=False)
+    tol = S[..., 0:1] * max(A.shape[-2:]) * np.finfo(S.dtype).eps
+    rnk = np.sum(S > tol, axis=-1)
+    if np.any(rnk < rank):
+        raise Exception("({0}) Matrix A needs to have rank either {1} or {2}! Rank was: {3}".format(
+            name, rank+1, rank, np.min(rnk)))
+    return Vt[..., -1, :], S[..., -1]
 
 def main():
-    # K matrix given by the Caltech Lanes dataset (CameraInfo.txt)
-    K = np.array([[309.4362,     0,        317.9034],
-                  [0,         344.2161,    256.5352],
-                  [0,            0,            1   ]])
+    K = K_CALTECH
     line1 = np.array([  1.30459272,     1.,     -589.16024465])
     line2 = np.array([  -1.26464497,    1.,     228.18829664])
     win1 = (0.4, 0.60, 0.2, 0.25)
@@ -0,0 +1,180 @@
+"""
+Frame sources for the lane pipeline: image directories, video files
+(cv2.VideoCapture), and raw frames piped on stdin, e.g.:
+
+    $ ffmpeg -i drive.mp4 -f rawvideo -pix_fmt bgr24 - | \\
+          python demo_full_pipeline.py --imgsdir - --raw_size 640 480
+
+Every source is iterated as a generator of (str name, nparray Irgb),
+where Irgb is a BGR uint8 image. open_frame_source wraps the source in a
+PrefetchReader, so that frames are decoded on a background thread while
+the caller processes the previous ones. Only a bounded number of frames
+is ever held in memory.
+"""
+
+import sys, os, threading, Queue
+import numpy as np, cv2, cv
+
+import util
+
+VIDEO_EXTS = ('.avi', '.mp4', '.mov', '.mkv', '.mpg', '.mpeg', '.m4v')
+
+def isvideoext(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTS
+
+class ImageDirSource(object):
+    """ The images of a directory (see util.get_imgpaths), or a single
+    image path.
+    """
+    def __init__(self, imgsdir, n=None):
+        if os.path.isdir(imgsdir):
+            self.imgpaths = util.get_imgpaths(imgsdir, n=n)
+        else:
+            self.imgpaths = [imgsdir]
+        self.nb_frames = len(self.imgpaths)
+
+    def __iter__(self):
+        for imgpath in self.imgpaths:
+            Irgb = cv2.imread(imgpath, cv2.CV_LOAD_IMAGE_COLOR)
+            if Irgb is None:
+                raise Exception("Couldn't read image: {0}".format(imgpath))
+            yield util.get_filename(imgpath), Irgb
+
+class VideoSource(object):
+    """ The frames of a video file, decoded with cv2.VideoCapture. """
+    def __init__(self, vidpath, n=None):
+        self.vidpath = vidpath
+        self.n = n
+        cap = cv2.VideoCapture(vidpath)
+        if not cap.isOpened():
+            raise Exception("Couldn't open video: {0}".format(vidpath))
+        nb_frames = int(cap.get(cv.CV_CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if nb_frames <= 0:
+            self.nb_frames = None # Unknown (e.g. some containers)
+        elif n is not None:
+            self.nb_frames = min(n, nb_frames)
+        else:
+            self.nb_frames = nb_frames
+
+    def __iter__(self):
+        cap = cv2.VideoCapture(self.vidpath)
+        name = util.get_filename(self.vidpath)
+        try:
+            i = 0
+            while self.n is None or i < self.n:
+                ok, Irgb = cap.read()
+                if not ok:
+                    break
+                yield "{0}_{1:06d}".format(name, i), Irgb
+                i += 1
+        finally:
+            cap.release()
+
+class RawPipeSource(object):
+    """ Raw uint8 frames of a fixed size, read back-to-back from a file
+    object (by default, stdin). Channels are BGR (3) or grayscale (1).
+    """
+    def __init__(self, w, h, channels=3, f=None, n=None):
+        if channels not in (1, 3):
+            raise Exception("Raw frames must have 1 or 3 channels, not {0}".format(channels))
+        self.w, self.h, self.channels = w, h, channels
+        self.f = f if f is not None else sys.stdin
+        self.n = n
+        self.nb_frames = None
+
+    def __iter__(self):
+        framesize = self.w * self.h * self.channels
+        i = 0
+        while self.n is None or i < self.n:
+            buf = bytearray(framesize) # Writable, unlike a str buffer
+            if self.f.readinto(buf) < framesize:
+                break # End of stream (a trailing partial frame is dropped)
+            I = np.frombuffer(buf, dtype='uint8').reshape(self.h, self.w, self.channels)
+            if self.channels == 1:
+                Irgb = cv2.cvtColor(I, cv2.COLOR_GRAY2BGR)
+            else:
+                Irgb = I
+            yield "stdin_{0:06d}".format(i), Irgb
+            i += 1
+
+class PrefetchReader(object):
+    """ Iterates over a frame source on a background thread, keeping at
+    most maxsize decoded frames ready in a queue. Errors raised by the
+    source are re-raised by the consumer, with their traceback.
+    """
+    _END = object()
+    # Max. seconds to wait for the reader thread when the consumer quits:
+    # the thread may be blocked in a read (e.g. on stdin), and is a daemon
+    JOIN_TIMEOUT = 1.0
+
+    def __init__(self, source, maxsize=8):
+        self.source = source
+        self.nb_frames = getattr(source, 'nb_frames', None)
+        self.maxsize = maxsize
+
+    def __iter__(self):
+        queue = Queue.Queue(maxsize=self.maxsize)
+        stop = threading.Event()
+        def put(item):
+            # Blocks while the queue is full, unless the consumer quit
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def run():
+            try:
+                for frame in self.source:
+                    if not put((frame, None)):
+                        return
+                put((self._END, None))
+            except Exception:
+                put((self._END, sys.exc_info()))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                frame, exc_info = queue.get()
+                if frame is self._END:
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    break
+                yield frame
+        finally:
+            stop.set()
+            thread.join(self.JOIN_TIMEOUT)
+
+def open_frame_source(src, n=None, raw_size=None, raw_channels=3, prefetch=8):
+    """ Opens a source of frames.
+    Input:
+        str src
+            An image directory, an image path, a video path, or '-' for
+            raw frames on stdin.
+        int n
+            If given, only the first n frames are read.
+        tuple raw_size: (int w, int h)
+            Frame size, required for raw frames.
+        int raw_channels
+            1 (grayscale) or 3 (BGR), for raw frames.
+        int prefetch
+            Max. number of frames decoded ahead of the consumer. If 0,
+            frames are decoded on the calling thread.
+    Output:
+        Iterable of (str name, nparray Irgb). Its nb_frames attribute is
+        the number of frames, or None if unknown.
+    """
+    if src == '-':
+        if raw_size is None:
+            raise Exception("Reading raw frames from stdin requires the frame size.")
+        source = RawPipeSource(raw_size[0], raw_size[1], channels=raw_channels, n=n)
+    elif os.path.isfile(src) and isvideoext(src):
+        source = VideoSource(src, n=n)
+    else:
+        source = ImageDirSource(src, n=n)
+    if prefetch > 0:
+        return PrefetchReader(source, maxsize=prefetch)
+    return source
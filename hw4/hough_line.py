@@ -0,0 +1,92 @@
+"""
+A Hough-transform alternative to RANSAC (estimate_line.estimate_line)
+for finding the dominant line in an edgemap. The runtime only depends
+on the number of edge pixels and the size of the accumulator, not on
+random luck.
+
+Lines are parameterized as:
+    x*cos(theta) + y*sin(theta) = rho
+where theta is the angle of the line's normal (theta=0 is a vertical
+line, theta=+-90 a horizontal one).
+"""
+
+import numpy as np
+
+from estimate_line import get_edge_pts, fit_line
+
+def estimate_line_hough(edgemap, T=3.0, ALPHA=8, THETA_RANGE=(-70.0, 70.0),
+                        THETA_STEP=1.0, RHO_STEP=1.0, stats=None, rng=None):
+    """ Given an edgemap, determine the most dominant line via a Hough
+    accumulator, restricted to lane-plausible orientations.
+    Input:
+        nparray edgemap
+        float T
+            Distance threshold between a point and the peak line for
+            the point to be considered an inlier.
+        int ALPHA
+            Min. number of votes required for a line to be considered.
+        tuple THETA_RANGE: (float theta_min, float theta_max)
+            Range of line normal angles to vote for (in degrees). The
+            default excludes lines within 20 degrees of horizontal.
+        float THETA_STEP, RHO_STEP
+            Accumulator resolution (degrees, pixels).
+        dict stats
+            If given, then stats['nb_votes'] is set to the number of
+            votes of the peak.
+        rng
+            Unused (the Hough transform is deterministic). Accepted for
+            the interface of detect_lanes.LINE_ESTIMATORS.
+    Output:
+        (nparray line, nparray inliers)
+    Same as estimate_line.estimate_line: line := (a, b, c) such that
+    ax + by + c = 0, and inliers are indices into the edge pixels of
+    edgemap. Outputs None if edgemap has no edges.
+    """
+    pts = get_edge_pts(edgemap)
+    if stats is not None:
+        stats['nb_votes'] = 0
+    if len(pts) == 0:
+        return None # Couldn't detect any edges!
+    thetas = np.deg2rad(np.arange(THETA_RANGE[0], THETA_RANGE[1] + THETA_STEP/2.0, THETA_STEP))
+    acc, rho_min = hough_accumulate(pts, thetas, RHO_STEP, edgemap.shape)
+    i_rho, i_theta = np.unravel_index(np.argmax(acc), acc.shape)
+    nb_votes = acc[i_rho, i_theta]
+    if stats is not None:
+        stats['nb_votes'] = nb_votes
+    if nb_votes < ALPHA:
+        return None, None
+    theta = thetas[i_theta]
+    rho = rho_min + i_rho*RHO_STEP
+    line = np.array([np.cos(theta), np.sin(theta), -rho])
+    inliers = np.flatnonzero(np.abs(np.dot(pts, line[0:2]) + line[2]) <= T)
+    if len(inliers) >= 2:
+        line, residual = fit_line(pts[inliers])
+    return line, inliers
+
+def hough_accumulate(pts, thetas, rho_step, shape):
+    """ Votes every point into a (rho, theta) accumulator.
+    Input:
+        nparray pts: N x 2
+        nparray thetas: K
+            Normal angles (in radians) to vote for.
+        float rho_step
+        tuple shape: (int h, int w)
+            Dimensions of the image the points come from.
+    Output:
+        (nparray acc, float rho_min)
+    Where acc is a (nb_rhos x K) array of vote counts, and row i of acc
+    corresponds to rho = rho_min + i*rho_step.
+    """
+    rho_max = np.hypot(shape[0], shape[1])
+    nb_rhos = int(np.ceil(2*rho_max / rho_step)) + 1
+    K = len(thetas)
+    # N x K matrix of rho bins (rounded), one column per theta. Since
+    # rho + rho_max >= 0, truncation after adding 0.5 is rounding.
+    trig = np.vstack((np.cos(thetas), np.sin(thetas))) / rho_step
+    rhos = np.dot(pts, trig)
+    rhos += rho_max / rho_step + 0.5
+    bins = rhos.astype('int32')
+    bins *= K
+    bins += np.arange(K)
+    acc = np.bincount(bins.ravel(), minlength=nb_rhos*K)
+    return acc.reshape(nb_rhos, K), -rho_max
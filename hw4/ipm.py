@@ -0,0 +1,113 @@
+"""
+Inverse perspective mapping (IPM): renders the bird's-eye view of the
+road given the homography H from the image to the bird's-eye view.
+
+Rather than calling cv2.warpPerspective on every frame, IPMRenderer
+builds cv2.remap lookup tables (in fixed-point CV_16SC2 format) for H
+once, and reuses them for the next frames as long as H stays close to
+the H the tables were built for.
+"""
+
+import numpy as np, cv2
+
+import util_camera
+
+class IPMRenderer(object):
+    """ Usage:
+        renderer = IPMRenderer((1000, 700))
+        for I, H in frames:
+            Iipm = renderer.render(I, H)
+    """
+    def __init__(self, dsize, tol=0.5, interpolation=cv2.INTER_LINEAR,
+                 fixed_point=True):
+        """
+        Input:
+            tuple dsize: (int w_out, int h_out)
+                Size of the bird's-eye view.
+            float tol
+                The tables are rebuilt only if, for a new H, some corner of
+                the bird's-eye view maps more than tol pixels away (in the
+                input image) from where it mapped when the tables were
+                built. Use tol=0 to rebuild whenever H changes at all.
+            int interpolation
+            bool fixed_point
+                Convert the tables to CV_16SC2 (faster remap, 1/32 pixel
+                precision).
+        """
+        self.dsize = tuple(dsize)
+        self.tol = tol
+        self.interpolation = interpolation
+        self.fixed_point = fixed_point
+        self.maps = None
+        self.corners = None  # Input-image locations of the output corners
+        self.nb_builds = 0
+
+    def render(self, I, H, Iout=None):
+        """ Warps I (any dtype/channels supported by cv2.remap, e.g. uint8
+        BGR) to the bird's-eye view.
+        Input:
+            nparray I
+            nparray H: 3x3
+                Homography mapping I to the bird's-eye view.
+            nparray Iout
+                If given, the output is written into it.
+        Output:
+            nparray Iipm
+        """
+        self.update(H)
+        map1, map2 = self.maps
+        if Iout is None:
+            return cv2.remap(I, map1, map2, self.interpolation)
+        return cv2.remap(I, map1, map2, self.interpolation, dst=Iout)
+
+    def update(self, H):
+        """ Rebuilds the lookup tables if H moved beyond self.tol.
+        Output:
+            bool rebuilt
+        """
+        Hinv = np.linalg.inv(H)
+        w_out, h_out = self.dsize
+        corners = util_camera.transform_pts(Hinv, np.array([[0, 0], [w_out-1, 0],
+                                                            [0, h_out-1], [w_out-1, h_out-1]],
+                                                           dtype='float64'))
+        if self.maps is not None and np.all(np.isfinite(corners)):
+            if np.max(np.abs(corners - self.corners)) <= self.tol:
+                return False
+        self.maps = build_ipm_maps(Hinv, self.dsize, fixed_point=self.fixed_point)
+        self.corners = corners
+        self.nb_builds += 1
+        return True
+
+def build_ipm_maps(Hinv, dsize, fixed_point=True):
+    """ Computes the cv2.remap tables of a perspective warp.
+    Input:
+        nparray Hinv: 3x3
+            Homography mapping the output image to the input image (i.e.
+            the inverse of the warp).
+        tuple dsize: (int w_out, int h_out)
+        bool fixed_point
+    Output:
+        (nparray map1, nparray map2)
+    Either the CV_16SC2 tables (see cv2.convertMaps), or the float32
+    x, y tables. As with cv2.warpPerspective, output pixels on the
+    horizon line (Z=0) are mapped to the border value.
+    """
+    w_out, h_out = dsize
+    xs = np.arange(w_out, dtype='float32')[np.newaxis, :]
+    ys = np.arange(h_out, dtype='float32')[:, np.newaxis]
+    Hinv = Hinv.astype('float32')
+    X = Hinv[0,0]*xs + Hinv[0,1]*ys + Hinv[0,2]
+    Y = Hinv[1,0]*xs + Hinv[1,1]*ys + Hinv[1,2]
+    Z = Hinv[2,0]*xs + Hinv[2,1]*ys + Hinv[2,2]
+    horizon = Z == 0
+    Z[horizon] = 1.0
+    mapx = X / Z
+    mapy = Y / Z
+    mapx[horizon] = -1.0
+    mapy[horizon] = -1.0
+    if not fixed_point:
+        return mapx, mapy
+    # Fixed-point maps can't represent far-away coordinates
+    np.clip(mapx, -1.0, 32000.0, out=mapx)
+    np.clip(mapy, -1.0, 32000.0, out=mapy)
+    return cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
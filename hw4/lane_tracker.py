@@ -0,0 +1,219 @@
+"""
+Temporal lane tracking on top of detect_lanes.
+
+Each lane is modeled as the image line:
+    x = m*(y - y_ref) + k
+i.e. by its slope m (dx/dy) and its x-intercept k at the reference row
+y_ref (the center row of the lane's search window). (m, k) is filtered
+over frames with a Kalman filter. For each new frame, edges are only
+searched for within a narrow band around the predicted line; the full
+search window is only used when tracking is lost.
+"""
+
+import numpy as np, cv2
+
+import detect_lanes
+
+class LaneKalmanFilter(object):
+    """ A Kalman filter on the lane state s = (m, k), with a random-walk
+    motion model:
+        s_t = s_{t-1} + w,    w ~ N(0, Q)
+        z_t = s_t + v,        v ~ N(0, R)
+    """
+    def __init__(self, z0, P0, Q, R):
+        """
+        Input:
+            nparray z0: (m, k)
+                Initial measurement.
+            nparray P0, Q, R: 2x2
+                Initial state covariance, process noise and measurement
+                noise covariances.
+        """
+        self.x = np.array(z0, dtype='float64')
+        self.P = np.array(P0, dtype='float64')
+        self.Q = np.array(Q, dtype='float64')
+        self.R = np.array(R, dtype='float64')
+
+    def predict(self):
+        """ Propagates the state to the next frame. """
+        self.P = self.P + self.Q
+        return self.x
+
+    def update(self, z):
+        """ Corrects the state with a measurement z = (m, k). """
+        S = self.P + self.R
+        K = np.dot(self.P, np.linalg.inv(S))
+        self.x = self.x + np.dot(K, np.asarray(z) - self.x)
+        self.P = np.dot(np.eye(2) - K, self.P)
+        return self.x
+
+    def mahalanobis(self, z):
+        """ Squared Mahalanobis distance of z from the predicted state. """
+        d = np.asarray(z) - self.x
+        return np.dot(d, np.dot(np.linalg.inv(self.P + self.R), d))
+
+class LaneTracker(object):
+    """ Stateful lane detector: call update(I) on consecutive frames.
+    Usage:
+        tracker = LaneTracker(WIN_LEFT, WIN_RIGHT, threshold1=110, threshold2=220)
+        for I in frames:
+            line1, line2 = tracker.update(I)
+    """
+    def __init__(self, win1, win2, threshold1=50, threshold2=100,
+                 apertureSize=3, band=8, max_misses=3, gate=9.21,
+                 P0=(0.05, 25.0), Q=(0.002, 4.0), R=(0.01, 4.0),
+                 estimator='ransac', estimator_params=None,
+                 track_params=None, seed=None):
+        """
+        Input:
+            tuple win1, win2
+                Search windows of the left/right lanes (see detect_lanes).
+            float threshold1, threshold2
+            int apertureSize
+                Canny parameters (see detect_lanes).
+            int band
+                Half-width (in pixels) of the search band around the
+                predicted line.
+            int max_misses
+                Nb. of consecutive frames a lane may go undetected before
+                tracking is lost (and the full window is searched again).
+            float gate
+                Measurements whose squared Mahalanobis distance from the
+                prediction exceeds gate are rejected (9.21 is the 99%
+                quantile of chi-squared with 2 dof).
+            tuple P0, Q, R: (float var_m, float var_k)
+                Diagonals of the Kalman filter covariances.
+            str estimator
+            dict estimator_params
+                Line estimator used on the full windows.
+            dict track_params
+                Overrides estimator_params within the search band, e.g. a
+                smaller RANSAC budget. By default, adaptive RANSAC.
+            int seed
+                If given, the line estimators draw from a RandomState
+                seeded with it, so that a sequence is tracked the same
+                way on every run.
+        """
+        self.wins = (win1, win2)
+        self.threshold1 = threshold1
+        self.threshold2 = threshold2
+        self.apertureSize = apertureSize
+        self.band = band
+        self.max_misses = max_misses
+        self.gate = gate
+        self.P0 = np.diag(P0)
+        self.Q = np.diag(Q)
+        self.R = np.diag(R)
+        self.estimator = estimator
+        self.estimator_params = estimator_params
+        if track_params is None and estimator == 'ransac':
+            track_params = dict(ADAPTIVE=True)
+        self.track_params = dict(estimator_params or {})
+        self.track_params.update(track_params or {})
+        self.rng = None if seed is None else np.random.RandomState(seed)
+        self.reset()
+
+    def reset(self):
+        """ Forgets all lanes: the next frame is searched from scratch. """
+        self.filters = [None, None]
+        self.misses = [0, 0]
+        self.y_refs = [None, None]
+
+    def is_tracking(self, i):
+        """ True if lane i (0: left, 1: right) is currently tracked. """
+        return self.filters[i] is not None
+
+    def update(self, I):
+        """ Detects the lanes in the next frame I.
+        Output:
+            (line1, line2)
+        Same as detect_lanes.detect_lanes, but the lines are the filtered
+        estimates. A lane that is coasting (missed, but not yet lost)
+        outputs its predicted line.
+        """
+        h, w = I.shape[0:2]
+        lines_out = []
+        for i, win in enumerate(self.wins):
+            bounds = detect_lanes.get_window_bounds(win, w, h)
+            kf = self.filters[i]
+            if kf is not None:
+                kf.predict()
+                z = self.search_band(I, bounds, kf.x, self.y_refs[i])
+                if z is not None and kf.mahalanobis(z) <= self.gate:
+                    kf.update(z)
+                    self.misses[i] = 0
+                else:
+                    self.misses[i] += 1
+                    if self.misses[i] > self.max_misses:
+                        self.filters[i] = None # Lost track: full search
+            if self.filters[i] is None:
+                z = self.search_window(I, bounds, i)
+                if z is not None:
+                    self.filters[i] = LaneKalmanFilter(z, self.P0, self.Q, self.R)
+                    self.misses[i] = 0
+            if self.filters[i] is None:
+                lines_out.append(None)
+            else:
+                lines_out.append(state_to_line(self.filters[i].x, self.y_refs[i]))
+        return tuple(lines_out)
+
+    def search_window(self, I, bounds, i):
+        """ Full-window lane search. Sets the reference row of lane i.
+        Output:
+            nparray z: (m, k), or None if no line was found.
+        """
+        x0, y0, x1, y1 = bounds
+        self.y_refs[i] = (y0 + y1) / 2.0
+        line, edges = detect_lanes.detect_window_line(I, bounds, self.threshold1, self.threshold2,
+                                                      self.apertureSize, estimator=self.estimator,
+                                                      estimator_params=self.estimator_params,
+                                                      rng=self.rng)
+        return line_to_state(line, self.y_refs[i])
+
+    def search_band(self, I, bounds, state, y_ref):
+        """ Searches for the lane only within self.band pixels of the
+        line given by state. Canny is only run on the band's bounding box
+        (within the search window), and edges outside the band are masked
+        out before line estimation.
+        Output:
+            nparray z: (m, k), or None if no line was found.
+        """
+        x0, y0, x1, y1 = bounds
+        m, k = state
+        xs_end = m*(np.array([y0, y1]) - y_ref) + k
+        bx0 = max(x0, int(np.floor(xs_end.min())) - self.band)
+        bx1 = min(x1, int(np.ceil(xs_end.max())) + self.band + 1)
+        if bx1 - bx0 < 2:
+            return None # Predicted lane left the search window
+        ys, xs = np.ogrid[y0:y1, bx0:bx1]
+        mask = np.abs(xs - (m*(ys - y_ref) + k)) <= self.band
+        line, edges = detect_lanes.detect_window_line(I, (bx0, y0, bx1, y1), self.threshold1,
+                                                      self.threshold2, self.apertureSize,
+                                                      estimator=self.estimator,
+                                                      estimator_params=self.track_params,
+                                                      mask=mask, rng=self.rng)
+        return line_to_state(line, y_ref)
+
+def line_to_state(line, y_ref):
+    """ Converts a line (a, b, c) to the lane state (m, k):
+        x = m*(y - y_ref) + k
+    Output:
+        nparray z: (m, k), or None if line is None or horizontal.
+    """
+    if line is None or line[0] == 0:
+        return None
+    a, b, c = line
+    m = -b / a
+    k = -(b*y_ref + c) / a
+    return np.array([m, k])
+
+def state_to_line(state, y_ref):
+    """ Converts the lane state (m, k) to a line (a, b, c), normalized
+    like detect_lanes's output (b=1, unless the line is vertical).
+    """
+    m, k = state
+    # x - m*y + (m*y_ref - k) = 0
+    line = np.array([1.0, -m, m*y_ref - k])
+    if m != 0:
+        line = line / line[1]
+    return line
@@ -0,0 +1,143 @@
+"""
+Closed-form lateral offset of the camera from the center of the lane,
+directly from the two detected lanes, K and the lane width, i.e. without
+estimating (and decomposing) a homography.
+
+Each image line l_k back-projects to the plane through the camera center
+with normal n_k = K^T l_k (camera coords). Both 3D lanes lie on the road
+plane, with the same direction:
+    d = n_1 x n_2               (the lanes' vanishing direction)
+Assuming the camera has no roll (its x-axis is parallel to the road),
+the road normal N and the lateral direction g (on the road, across the
+lanes) are:
+    N = d x e_x,    g = d x N
+A point of lane k at height -c along N (c: camera height) is at lateral
+position c*r_k along g, where:
+    r_k = -(n_k . N) / (n_k . g)
+The lane width W = c*|r_2 - r_1| gives c, and thus the offset of the
+camera from the lane center:
+    xdist = -W * (r_1 + r_2) / (2 * (r_2 - r_1))
+which is invariant to the signs of l_k, N and g. The camera height is
+not needed.
+"""
+
+import numpy as np
+
+def estimate_lateral_offset(line1, line2, K, lane_width):
+    """ Estimates the lateral offset of the camera from the center of
+    the lane.
+    Input:
+        nparray line1, line2: [a, b, c]
+            The left/right lanes. Can also be F x 3 stacks, for F frames.
+        nparray K
+            The 3x3 camera intrinsic matrix.
+        float lane_width
+            Width of the lane (in meters).
+    Output:
+        float xdist
+    The offset (m) of the camera: positive if the camera is right of the
+    lane center, negative if left. None if the lanes are degenerate
+    (parallel in the image, or horizontal). For F x 3 lanes, xdist is an
+    F-vector, with NaN for degenerate frames.
+    """
+    K = np.asarray(K, dtype='float64')
+    n1 = np.dot(line1, K)   # (K^T l)^T = l^T K
+    n2 = np.dot(line2, K)
+    d = np.cross(n1, n2)
+    d0, d1, d2 = d[..., 0], d[..., 1], d[..., 2]
+    # N = d x e_x = (0, d2, -d1), g = d x N = (-(d1^2 + d2^2), d0*d1, d0*d2)
+    g0 = -(d1*d1 + d2*d2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r1 = -(n1[..., 1]*d2 - n1[..., 2]*d1) / (n1[..., 0]*g0 + d0*(n1[..., 1]*d1 + n1[..., 2]*d2))
+        r2 = -(n2[..., 1]*d2 - n2[..., 2]*d1) / (n2[..., 0]*g0 + d0*(n2[..., 1]*d1 + n2[..., 2]*d2))
+        xdist = -lane_width * (r1 + r2) / (2.0 * (r2 - r1))
+    if np.ndim(xdist) == 0:
+        return float(xdist) if np.isfinite(xdist) else None
+    xdist[~np.isfinite(xdist)] = np.nan
+    return xdist
+
+class LateralOffsetTracker(object):
+    """ Filters the lateral offset over consecutive frames, to estimate
+    the lateral velocity of the camera and its time to line crossing
+    (TLC). The state s = (xdist, xvel) follows a constant velocity
+    model, filtered with a Kalman filter:
+        s_t = F*s_{t-1} + w,    w ~ N(0, Q)
+        z_t = xdist_t + v,      v ~ N(0, r)
+    Usage:
+        tracker = LateralOffsetTracker(LANE_W)
+        for xdist in offsets:
+            xdist, xvel, tlc = tracker.update(xdist, dt=1/30.)
+    """
+    def __init__(self, lane_width, q=0.5, r=0.05**2, max_missed=5):
+        """
+        Input:
+            float lane_width
+            float q
+                Process noise: variance of the lateral acceleration
+                (m^2/s^4).
+            float r
+                Measurement noise: variance of xdist (m^2).
+            int max_missed
+                Reset after this many consecutive frames without an
+                offset.
+        """
+        self.lane_width = lane_width
+        self.q = q
+        self.r = r
+        self.max_missed = max_missed
+        self.reset()
+
+    def reset(self):
+        self.x = None   # (xdist, xvel)
+        self.P = None
+        self.nb_missed = 0
+
+    def update(self, xdist, dt):
+        """ Corrects the state with the offset of the next frame.
+        Input:
+            float xdist
+                The measured offset, or None if the lanes weren't found.
+            float dt
+                Time (s) since the previous frame.
+        Output:
+            (float xdist, float xvel, float tlc)
+        The filtered offset (m), lateral velocity (m/s, positive towards
+        the right lane), and time to line crossing (s, inf if not moving
+        towards a lane). All None if there is no state yet (e.g. at the
+        first frame).
+        """
+        if self.x is not None:
+            F = np.array([[1.0, dt], [0.0, 1.0]])
+            G = np.array([0.5*dt*dt, dt])
+            self.x = np.dot(F, self.x)
+            self.P = np.dot(F, np.dot(self.P, F.T)) + self.q*np.outer(G, G)
+        if xdist is None:
+            self.nb_missed += 1
+            if self.nb_missed > self.max_missed:
+                self.reset()
+        elif self.x is None:
+            self.x = np.array([xdist, 0.0])
+            self.P = np.diag([self.r, 1.0])
+            self.nb_missed = 0
+        else:
+            # z = H*s, H = [1, 0]
+            S = self.P[0, 0] + self.r
+            Kgain = self.P[:, 0] / S
+            self.x = self.x + Kgain * (xdist - self.x[0])
+            self.P = self.P - np.outer(Kgain, self.P[0, :])
+            self.nb_missed = 0
+        if self.x is None:
+            return None, None, None
+        xdist_f, xvel = self.x
+        return xdist_f, xvel, time_to_line_crossing(xdist_f, xvel, self.lane_width)
+
+def time_to_line_crossing(xdist, xvel, lane_width):
+    """ Outputs the time (s) until the camera crosses the lane it is
+    moving towards, at its current lateral velocity (m/s). Outputs inf
+    if it isn't moving sideways, and 0 if it already crossed it.
+    """
+    if xvel > 0:
+        return max(lane_width/2.0 - xdist, 0.0) / xvel
+    elif xvel < 0:
+        return max(lane_width/2.0 + xdist, 0.0) / -xvel
+    return float('inf')
@@ -0,0 +1,102 @@
+"""
+Lens undistortion for the lane pipeline, given the camera model from
+calibrate_camera.calibrate_camera_model (K, distCoeffs).
+
+The cv2.initUndistortRectifyMap tables are computed once per camera and
+image size (see get_undistorter), and then either:
+    - applied to whole frames with cv2.remap (undistort_image), or
+    - skipped entirely, by only undistorting the few points that matter,
+      e.g. points along the detected lanes (undistort_pts, undistort_line).
+The undistorted images/points keep the same intrinsic matrix K.
+"""
+
+import numpy as np, cv2
+
+from estimate_line import fit_line
+
+_UNDISTORTERS = {}  # (K, distCoeffs, imgsize) -> Undistorter
+
+def get_undistorter(K, distCoeffs, imgsize):
+    """ Outputs the Undistorter of this camera, creating it (and its
+    remap tables) on first use only.
+    Input:
+        nparray K: 3x3
+        nparray distCoeffs
+        tuple imgsize: (int w, int h)
+    """
+    K = np.asarray(K, dtype='float64')
+    distCoeffs = np.asarray(distCoeffs, dtype='float64').ravel()
+    key = (K.tostring(), distCoeffs.tostring(), tuple(imgsize))
+    undistorter = _UNDISTORTERS.get(key)
+    if undistorter is None:
+        undistorter = Undistorter(K, distCoeffs, imgsize)
+        _UNDISTORTERS[key] = undistorter
+    return undistorter
+
+class Undistorter(object):
+    def __init__(self, K, distCoeffs, imgsize):
+        """
+        Input:
+            nparray K: 3x3
+            nparray distCoeffs
+                (k1, k2, p1, p2[, k3]), as output by cv2.calibrateCamera.
+            tuple imgsize: (int w, int h)
+        """
+        self.K = np.asarray(K, dtype='float64')
+        self.distCoeffs = np.asarray(distCoeffs, dtype='float64').ravel()
+        self.imgsize = tuple(imgsize)
+        self._maps = None
+
+    @property
+    def maps(self):
+        """ The (CV_16SC2) remap tables, computed on first use. """
+        if self._maps is None:
+            self._maps = cv2.initUndistortRectifyMap(self.K, self.distCoeffs, None, self.K,
+                                                     self.imgsize, cv2.CV_16SC2)
+        return self._maps
+
+    def undistort_image(self, I, out=None):
+        """ Undistorts a whole frame (of size self.imgsize). """
+        if (I.shape[1], I.shape[0]) != self.imgsize:
+            raise Exception("Image size {0} doesn't match the undistortion maps' {1}".format(
+                (I.shape[1], I.shape[0]), self.imgsize))
+        map1, map2 = self.maps
+        if out is None:
+            return cv2.remap(I, map1, map2, cv2.INTER_LINEAR)
+        return cv2.remap(I, map1, map2, cv2.INTER_LINEAR, dst=out)
+
+    def undistort_pts(self, pts):
+        """ Undistorts pixel coords.
+        Input:
+            nparray pts: N x 2
+        Output:
+            nparray pts_undist: N x 2
+        """
+        pts = np.asarray(pts, dtype='float64').reshape(-1, 1, 2)
+        if len(pts) == 0:
+            return pts.reshape(0, 2)
+        return cv2.undistortPoints(pts, self.K, self.distCoeffs, P=self.K).reshape(-1, 2)
+
+    def undistort_line(self, line, ys):
+        """ Undistorts an image line (a, b, c) of the distorted image: the
+        line's points at rows ys are undistorted, and a line is refit to
+        them (in the distorted image, straight lanes are curved).
+        Input:
+            nparray line
+            nparray ys
+                Rows to sample the line at (e.g. the rows the lane was
+                detected in).
+        Output:
+            nparray line_undist
+        Normalized like detect_lanes's output (b=1, unless the line is
+        vertical). Outputs None if line is None or horizontal.
+        """
+        if line is None or line[0] == 0:
+            return None
+        ys = np.asarray(ys, dtype='float64')
+        xs = (-line[1]*ys - line[2]) / line[0]
+        pts = self.undistort_pts(np.column_stack((xs, ys)))
+        line_out, residual = fit_line(pts)
+        if line_out[1] != 0:
+            line_out = line_out / line_out[1]
+        return line_out
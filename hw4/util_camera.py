@@ -16,11 +16,61 @@ def get_intrinsics(K):
     return (K[0,0], K[1, 1], (K[0,2], K[1,2]))
 
 def compute_x(line, y):
-    """ ax + by + c = 0 => x = (-by - c) / a """
-    return (-line[1]*y - line[2]) / line[0]
+    """ ax + by + c = 0 => x = (-by - c) / a
+    line may be a stack (... x 3) of lines, and y an array (broadcast
+    against line[..., 0]).
+    """
+    line = np.asarray(line)
+    return (-line[..., 1]*y - line[..., 2]) / line[..., 0]
 def compute_y(line, x):
-    """ ax + by + c = 0 => y = (-ax - c) / b """
-    return (-line[0]*x - line[2]) / line[1]
+    """ ax + by + c = 0 => y = (-ax - c) / b
+    (See compute_x)
+    """
+    line = np.asarray(line)
+    return (-line[..., 0]*x - line[..., 2]) / line[..., 1]
+
+def sample_lane_pairs(line1, line2, ys):
+    """ Samples point pairs directly across two (lane) lines: for each
+    row y, the points of line1 and line2 at that row.
+    Input:
+        nparray line1, line2: [a, b, c]
+            Can also be F x 3 stacks of lines, e.g. the lanes of F
+            frames.
+        nparray ys
+            The N rows to sample at, e.g. every row of the lane
+            detection windows (see get_lane_rows).
+    Output:
+        nparray pts: N x 2 x 2
+    where pts[n] = ((x1, y), (x2, y)) is the n-th pair. For F x 3
+    lines, pts is F x N x 2 x 2.
+    """
+    line1 = np.asarray(line1, dtype='float64')
+    line2 = np.asarray(line2, dtype='float64')
+    ys = np.asarray(ys, dtype='float64')
+    stack = np.broadcast(line1[..., 0], line2[..., 0]).shape
+    pts = np.empty(stack + ys.shape + (2, 2))
+    pts[..., 0, 0] = compute_x(line1[..., np.newaxis, :], ys)
+    pts[..., 1, 0] = compute_x(line2[..., np.newaxis, :], ys)
+    pts[..., 1] = ys[:, np.newaxis]
+    return pts
+
+def get_lane_rows(h, win, step=1):
+    """ Outputs the image rows spanned by a lane detection window (where
+    the lanes were fit), from its top row: win's y is the window center
+    (see detect_lanes.get_window_bounds).
+    Input:
+        int h
+            Image height.
+        tuple win: (float x, float y, float w, float h)
+        int step
+            Sample every step-th row.
+    Output:
+        nparray ys
+    """
+    y_win = intrnd(h*win[1])
+    h_win = intrnd(h*win[3])
+    y0 = y_win - (h_win // 2)
+    return np.arange(y0, y0 + h_win, step, dtype='float64')
 
 def pt2homo(pt):
     """ Image point to homogeneous coords. """
@@ -37,21 +87,70 @@ def homo2pt(pt_h):
     pt = pt_h[0:2]
     return pt / pt_h[2]
 
-def normalize_coords(pts, K):
+def pts2homo(pts, out=None):
+    """ Image points to homogeneous coords.
+    Input:
+        nparray pts: N x 2
+        nparray out: N x 3
+            If given, the output is written into it.
+    Output:
+        nparray pts_h: N x 3
+    """
+    pts = np.asarray(pts)
+    if pts.ndim != 2 or pts.shape[1] != 2:
+        raise TypeError("Must pass N x 2 image coords to pts2homo: {0}".format(pts.shape))
+    if out is None:
+        out = np.empty((pts.shape[0], 3), dtype=np.result_type(pts.dtype, np.float64))
+    out[:, 0:2] = pts
+    out[:, 2] = 1.0
+    return out
+
+def homo2pts(pts_h, out=None):
+    """ Homogeneous coords to image (pixel) coords.
+    Input:
+        nparray pts_h: N x 3
+        nparray out: N x 2
+            If given, the output is written into it.
+    Output:
+        nparray pts: N x 2
+    """
+    pts_h = np.asarray(pts_h)
+    if pts_h.ndim != 2 or pts_h.shape[1] != 3:
+        raise TypeError("Must pass N x 3 vectors to homo2pts: {0}".format(pts_h.shape))
+    return np.divide(pts_h[:, 0:2], pts_h[:, 2:3], out=out)
+
+def transform_pts(H, pts, out=None):
+    """ Applies the homography H to image points.
+    Input:
+        nparray H: 3x3
+        nparray pts: N x 2
+        nparray out: N x 2
+            If given, the output is written into it.
+    Output:
+        nparray pts_out: N x 2
+    """
+    pts = np.asarray(pts)
+    pts_h = np.dot(pts, H[:, 0:2].T)
+    pts_h += H[:, 2]
+    return homo2pts(pts_h, out=out)
+
+def normalize_coords(pts, K, out=None):
     """ Normalize pixel coordinates into image coordinates with
     intrinsic matrix K.
     Input:
         nparray pts: N x 2
+        nparray out: N x 2
+            If given, the output is written into it (by default, an
+            array of the same dtype as pts).
     Output:
         nparray pts_norm: N x 2
     """
-    out = np.zeros(pts.shape, dtype=pts.dtype)
+    pts = np.asarray(pts)
+    if out is None:
+        out = np.empty(pts.shape, dtype=pts.dtype)
     Kinv = np.linalg.inv(K)
-    for i, pt in enumerate(pts):
-        pt_h = np.hstack((pt, 1.0))
-        pt_norm_h = np.dot(Kinv, pt_h)
-        pt_norm = pt_norm_h[0:2]
-        out[i, :] = pt_norm
+    # Kinv's last row is (0, 0, 1), so this is an affine map
+    out[...] = np.dot(pts, Kinv[0:2, 0:2].T) + Kinv[0:2, 2]
     return out
 
 def draw_line(Irgb, line, color=(0, 255, 0)):
@@ -84,10 +183,8 @@ def draw_points(Irgb, pts, color=(255, 0, 0)):
         nparray pts: N x 2
             Rows of pixel coords (x,y)
     """
-    for (x, y) in pts:
-        Irgb[y, x, 0] = color[0]
-        Irgb[y, x, 1] = color[1]
-        Irgb[y, x, 2] = color[2]
+    pts = np.asarray(pts).astype('int')
+    Irgb[pts[:, 1], pts[:, 0], 0:3] = color
     return Irgb
 
 def find_line_segment(line, w, h):
@@ -168,16 +265,15 @@ def normalize_det(A):
         => c = (1 / det(A)) ^ (1/n)
     Input:
         nparray A: N x N
+            Can also be a stack of matrices (... x N x N), each of which
+            is normalized.
     Output:
         nparray Anorm
             Anorm will have determinant +1.
     """
     det_A = np.linalg.det(A)
-    if det_A > 0:
-        c = np.power((1 / det_A), 1 / 3.0)
-    else:
-        c = -np.power((1 / -det_A), 1/ 3.0)
-    return A * c
+    c = np.where(det_A > 0, 1.0, -1.0) * np.power(1 / np.abs(det_A), 1 / 3.0)
+    return A * c[..., np.newaxis, np.newaxis]
 
 def decompose_H(H, pts1=None, pts2=None):
     """ Decomposes homography H into (R, (1/d)*T, N), where (R,T) is
@@ -190,81 +286,48 @@ def decompose_H(H, pts1=None, pts2=None):
             physically possible (R,T,N) by enforcing the positive
             depth constraint.
     Output:
-        (nparray R, nparray Ts, nparray N)
-    Where R is 3x3, N is a 3x1 column vector, and Ts is a 3x1 column
-    vector defined UP TO an unknown scale (1/d).
+        [(nparray R, nparray Ts, nparray N), ...]
+    The 2 decompositions with a positive depth, where R is 3x3, N is a
+    3x1 column vector, and Ts is a 3x1 column vector defined UP TO an
+    unknown scale (1/d). See decompose_H_batch.
     """
-    U, S, Vt = np.linalg.svd(np.dot(H.T, H))
-    if np.linalg.det(U) < 0:
-        # We require that U, Vt have det=+1
-        U = -U
-        Vt = -Vt
-    V = Vt.T    # Recall: svd outputs V as V.T
-    v1 = V[:, 0]
-    v2 = V[:, 1]
-    v3 = V[:, 2]
-    norm_ = np.sqrt(S[0]**2.0 - S[2]**2.0)
-    u1 = ((np.sqrt(1 - S[2]**2.0)*v1) + (np.sqrt(S[0]**2.0 - 1)*v3)) / norm_
-    u2 = ((np.sqrt(1 - S[2]**2.0)*v1) - (np.sqrt(S[0]**2.0 - 1)*v3)) / norm_
-    def make_U1():
-        U1 = np.zeros((3, 3))
-        U1[:, 0] = v2
-        U1[:, 1] = u1
-        U1[:, 2] = np.dot(make_crossprod_mat(v2), u1)
-        return U1
-    def make_U2():
-        U2 = np.zeros((3, 3))
-        U2[:, 0] = v2
-        U2[:, 1] = u2
-        U2[:, 2] = np.dot(make_crossprod_mat(v2), u2)
-        return U2
-    def make_W1():
-        W1 = np.zeros((3,3))
-        W1[:, 0] = np.dot(H, v2)
-        W1[:, 1] = np.dot(H, u1)
-        W1[:, 2] = np.dot(make_crossprod_mat(np.dot(H, v2)), np.dot(H, u1))
-        return W1
-    def make_W2():
-        W2 = np.zeros((3, 3))
-        W2[:, 0] = np.dot(H, v2)
-        W2[:, 1] = np.dot(H, u2)
-        W2[:, 2] = np.dot(make_crossprod_mat(np.dot(H, v2)), np.dot(H, u2))
-        return W2
-    U1 = make_U1()
-    U2 = make_U2()
-    W1 = make_W1()
-    W2 = make_W2()
-    
-    # Generate 4 possible solutions
-    R1 = np.dot(W1, U1.T)
-    N1 = np.dot(make_crossprod_mat(v2), u1)
-    Ts1 = np.dot((H - R1), N1)
-    
-    R2 = np.dot(W2, U2.T)
-    N2 = np.dot(make_crossprod_mat(v2), u2)
-    Ts2 = np.dot((H - R2), N2)
-    
-    R3 = R1
-    N3 = -N1
-    Ts3 = -Ts1
-    
-    R4 = R2
-    N4 = -N2
-    Ts4 = -Ts2
-    ## Remove physically impossible decomps: n3 < 0
-    decomps = []
-    if N1[2] < 0:
-        # N1 is impossible, N3 must be correct
-        R3 = normalize_det(R3)
-        decomps.append((R3, Ts3, N3))
-    else:
-        R1 = normalize_det(R1)
-        decomps.append((R1, Ts1, N1))
-    if N2[2] < 0:
-        # N2 is impossible, N4 must be correct
-        R4 = normalize_det(R4)
-        decomps.append((R4, Ts4, N4))
-    else:
-        R2 = normalize_det(R2)
-        decomps.append((R2, Ts2, N2))
-    return decomps
+    Rs, Tss, Ns = decompose_H_batch(H[np.newaxis])
+    return [(Rs[0, k], Tss[0, k], Ns[0, k]) for k in xrange(2)]
+
+def decompose_H_batch(Hs):
+    """ Decomposes a stack of F homographies at once (same as calling
+    decompose_H on each one).
+    Input:
+        nparray Hs: F x 3 x 3
+    Output:
+        (nparray Rs, nparray Tss, nparray Ns)
+    Where Rs is F x 2 x 3 x 3, and Tss, Ns are F x 2 x 3: for each H,
+    the 2 physically possible decompositions (N[2] >= 0).
+    """
+    Hs = np.asarray(Hs, dtype='float64')
+    U, S, Vt = np.linalg.svd(np.einsum('fji,fjk->fik', Hs, Hs)) # H.T * H
+    # We require that U, Vt have det=+1
+    sign = np.where(np.linalg.det(U) < 0, -1.0, 1.0)
+    V = np.transpose(Vt, (0, 2, 1)) * sign[:, np.newaxis, np.newaxis]
+    v1 = V[:, :, 0]
+    v2 = V[:, :, 1]
+    v3 = V[:, :, 2]
+    norm_ = np.sqrt(S[:, 0]**2.0 - S[:, 2]**2.0)
+    a = (np.sqrt(1 - S[:, 2]**2.0) / norm_)[:, np.newaxis]
+    b = (np.sqrt(S[:, 0]**2.0 - 1) / norm_)[:, np.newaxis]
+    # us[:, 0] is u1, us[:, 1] is u2 (F x 2 x 3)
+    us = np.concatenate(((a*v1 + b*v3)[:, np.newaxis], (a*v1 - b*v3)[:, np.newaxis]), axis=1)
+    v2s = np.repeat(v2[:, np.newaxis], 2, axis=1)
+    # U_k := [v2, u_k, v2 x u_k],  W_k := [H*v2, H*u_k, (H*v2) x (H*u_k)]
+    Ns = np.cross(v2s, us)
+    Us = np.concatenate((v2s[..., np.newaxis], us[..., np.newaxis], Ns[..., np.newaxis]), axis=3)
+    Hv2s = np.einsum('fij,fkj->fki', Hs, v2s)
+    Hus = np.einsum('fij,fkj->fki', Hs, us)
+    Ws = np.concatenate((Hv2s[..., np.newaxis], Hus[..., np.newaxis],
+                         np.cross(Hv2s, Hus)[..., np.newaxis]), axis=3)
+    Rs = np.einsum('fkij,fklj->fkil', Ws, Us) # W_k * U_k.T
+    Tss = np.einsum('fij,fkj->fki', Hs, Ns) - np.einsum('fkij,fkj->fki', Rs, Ns) # (H - R)*N
+    ## Remove physically impossible decomps: n3 < 0. For each k, the
+    ## other solution is (R, -Ts, -N).
+    flip = np.where(Ns[:, :, 2] < 0, -1.0, 1.0)[..., np.newaxis]
+    return normalize_det(Rs), Tss * flip, Ns * flip